@@ -1,210 +1,401 @@
-import mlx.core as mx
-from mlx_lm.utils import load
-import json
 import argparse
+import heapq
+import json
 import logging
+import math
+import sys
+from array import array
+
+import mlx.core as mx
+
+from mlx_lm.generate import _make_cache, _merge_caches
+from mlx_lm.utils import load
 
 DEFAULT_MODEL = "mlx-community/Qwen3-1.7B-6bit"
 
 # Simplified logs
-logging.basicConfig(level=logging.INFO, format='%(message)s')
+logging.basicConfig(level=logging.INFO, format="%(message)s")
 logger = logging.getLogger(__name__)
 
+PENDING, DONE, DELETED = 0, 1, 2
+STATUS_NAMES = {PENDING: "pending", DONE: "done", DELETED: "deleted"}
+
+
+class NodeStore:
+    """
+    Columnar storage for the nodes of the tree.
+
+    A node is an integer index into parallel arrays. The children of a node
+    are created together so they are stored contiguously and found from
+    their first index and count.
+    """
+
+    def __init__(self):
+        self.parent = array("q")
+        self.token = array("q")
+        self.depth = array("l")
+        self.probability = array("d")
+        # Log probability of the path from the root
+        self.logprob = array("d")
+        self.child_start = array("q")
+        self.child_count = array("l")
+        self.status = bytearray()
+
+    def __len__(self):
+        return len(self.parent)
+
+    def add(self, parent, token, depth, probability):
+        self.parent.append(parent)
+        self.token.append(token)
+        self.depth.append(depth)
+        self.probability.append(probability)
+        parent_logprob = self.logprob[parent] if parent >= 0 else 0.0
+        self.logprob.append(parent_logprob + math.log(max(probability, 1e-30)))
+        self.child_start.append(-1)
+        self.child_count.append(0)
+        self.status.append(PENDING)
+        return len(self.parent) - 1
+
+    def add_children(self, node, tokens, probabilities):
+        start = len(self)
+        depth = self.depth[node] + 1
+        for token, probability in zip(tokens, probabilities):
+            self.add(node, token, depth, probability)
+        self.child_start[node] = start
+        self.child_count[node] = len(tokens)
+        return range(start, len(self))
+
+    def children(self, node):
+        start = self.child_start[node]
+        return range(start, start + self.child_count[node])
+
+    def path_tokens(self, node):
+        """The generated tokens from the root to the node."""
+        tokens = []
+        while self.parent[node] >= 0:
+            tokens.append(self.token[node])
+            node = self.parent[node]
+        return tokens[::-1]
+
+
 class Loom:
-    def __init__(self, model, tokenizer, initial_prompt_text, depth, width):
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        initial_prompt_text,
+        depth,
+        width,
+        strategy="breadth",
+        max_nodes=None,
+        top_p=1.0,
+        min_probability=0.0,
+        batch_size=32,
+        max_cached_nodes=128,
+    ):
+        """
+        ``strategy`` is ``"breadth"`` to expand the tree layer by layer or
+        ``"best"`` to always expand the pending nodes with the most probable
+        paths first, ``batch_size`` of them at a time. ``max_nodes`` bounds
+        the number of nodes in the tree.
+
+        The best first strategy keeps the KV cache of the processed nodes
+        until their children are processed, at most ``max_cached_nodes`` of
+        them, so its memory grows with ``max_cached_nodes`` times the length
+        of the sequences. The caches of the least probable paths are dropped
+        first and their children are processed again from the prompt.
+
+        Each node keeps at most ``width`` children, fewer if the most likely
+        ones already reach the ``top_p`` probability mass, and none below
+        ``min_probability``.
+        """
+        if strategy not in ("breadth", "best"):
+            raise ValueError(f"Unknown strategy {strategy}")
         self.model = model
         self.tokenizer = tokenizer
         self.depth = depth
         self.width = width
-        
-        initial_ids = tokenizer.encode(initial_prompt_text)
-        
-        self.nb_layers = 0
-        first_layer = {
-            "layer": self.nb_layers,
-            "id": f"{self.nb_layers}_0",
-            "parent_id": None,
-            "token_ids": initial_ids,
-            "text": initial_prompt_text,
-            "probability": 1.0,
-            "last_token_text": "",
-            "status": "pending",
-            "children": [],
-        }
-        
-        self.layer_map = {self.nb_layers: {first_layer["id"]: first_layer}}
-        self.pending_items = [first_layer["id"]]
-        
-        # Temporary storage for items currently being processed in the batch
-        self.processing_queue = []
+        self.strategy = strategy
+        self.max_nodes = max_nodes
+        self.top_p = top_p
+        self.min_probability = min_probability
+        self.batch_size = batch_size
+        self.max_cached_nodes = max_cached_nodes
+        self.initial_prompt_text = initial_prompt_text
+        self.initial_ids = tokenizer.encode(initial_prompt_text)
 
-    def _get_layer_index(self, item_id):
-        return int(item_id.split("_")[0])
+        self.nodes = NodeStore()
+        self.root = self.nodes.add(-1, -1, 0, 1.0)
 
-    def _delete_children(self, item_id):
+        # The nodes to process next, they are all at the same depth
+        self.pending_items = [self.root]
+
+        # Batched KV cache of the last processed layer, one row per item.
+        # The children of an item start from a copy of its row so each
+        # expansion only processes the one new token of every child.
+        self.cache = None
+        self.cache_rows = {}
+
+        # For best first expansion: a heap of (-path logprob, node) and the
+        # cache of every processed node which still has pending children
+        self.frontier = [(0.0, self.root)]
+        self.node_caches = {}
+
+    def _delete_children(self, node):
         """
-        Recursively deletes all descendants of item_id.
-        Removes them from layer_map and pending_items.
+        Marks all descendants of node as deleted.
+        Deleted nodes are skipped when they come up for processing.
         """
-        layer_idx = self._get_layer_index(item_id)
-        # Check if item exists (it might have been deleted by a parent call already)
-        if item_id not in self.layer_map.get(layer_idx, {}):
-            return
+        stack = list(self.nodes.children(node))
+        while stack:
+            child = stack.pop()
+            self.nodes.status[child] = DELETED
+            stack.extend(self.nodes.children(child))
+            self.cache_rows.pop(child, None)
+        self.nodes.child_count[node] = 0
 
-        item = self.layer_map[layer_idx][item_id]
-        
-        # Iterate over a copy of the children list
-        children_to_delete = list(item["children"])
-        
-        for child_id in children_to_delete:
-            # 1. Recursively delete grandchildren first
-            self._delete_children(child_id)
-            
-            # 2. Remove child from its layer_map
-            child_layer_idx = self._get_layer_index(child_id)
-            if child_id in self.layer_map.get(child_layer_idx, {}):
-                del self.layer_map[child_layer_idx][child_id]
-            
-            # 3. Remove from pending_items if it was waiting to be processed
-            if child_id in self.pending_items:
-                self.pending_items.remove(child_id)
-
-        # Reset the children list of the current item
-        item["children"] = []
-
-    def _create_children(self):
+    def _create_children(self, batch_ids, logits):
         """
-        Takes items from self.processing_queue (which now have logits),
-        creates children, adds children to layer_map and pending_items.
+        Creates the top ``width`` children of every item of the batch from
+        its next token logits, within the probability cutoffs and the node
+        budget, and queues them for processing.
+        Returns the new nodes.
         """
-        while self.processing_queue:
-            item_id = self.processing_queue.pop(0)
-            layer_index = self._get_layer_index(item_id)
-            
-            # Check existence in case of aggressive cleanup (edge case)
-            if item_id not in self.layer_map.get(layer_index, {}):
-                continue
+        nodes = self.nodes
+        expand = [i for i, n in enumerate(batch_ids) if nodes.depth[n] < self.depth]
+        for n in batch_ids:
+            nodes.status[n] = DONE
+        if not expand:
+            return []
 
-            item = self.layer_map[layer_index][item_id]
+        # --- Top K Logic ---
+        probs = mx.softmax(logits[mx.array(expand)].astype(mx.float32), axis=-1)
+        top_indices = mx.argpartition(-probs, self.width - 1, axis=-1)[:, : self.width]
+        top_probs = mx.take_along_axis(probs, top_indices, axis=-1)
+        sort_order = mx.argsort(-top_probs, axis=-1)
+        final_indices = mx.take_along_axis(top_indices, sort_order, axis=-1).tolist()
+        final_probs = mx.take_along_axis(top_probs, sort_order, axis=-1).tolist()
 
-            if layer_index >= self.depth:
-                item["status"] = "done"
-                if "logits" in item:
-                    del item["logits"]
-                continue
-            
-            if "logits" not in item:
-                logging.error(f"Item {item_id} missing logits during processing.")
-                continue
-                
-            logits = item["logits"]
-            
-            # --- Top K Logic ---
-            probs = mx.softmax(logits, axis=-1)
-            top_indices = mx.argpartition(probs, -self.width)[-self.width:]
-            
-            top_probs_unsorted = probs[top_indices]
-            sort_order = mx.argsort(top_probs_unsorted)[::-1]
-            final_indices = top_indices[sort_order]
-            final_probs = top_probs_unsorted[sort_order]
-
-            # --- Branching ---
-            next_layer_index = layer_index + 1
-            indices_py = final_indices.tolist()
-            probs_py = final_probs.tolist()
-
-            for i in range(len(indices_py)):
-                token_id = indices_py[i]
-                token_prob = probs_py[i]
-                
-                token_text = self.tokenizer.decode([token_id])
-                new_ids = item["token_ids"] + [token_id]
-                
-                # Unique ID structure: Layer_ParentID_Index
-                new_layer_id = f"{next_layer_index}_{item_id}_{i}"
-                
-                new_item = {
-                    "layer": next_layer_index,
-                    "id": new_layer_id,
-                    "parent_id": item_id,
-                    "token_ids": new_ids,
-                    "text": item["text"] + token_text,
-                    "probability": token_prob,
-                    "last_token_text": token_text,
-                    "status": "pending",
-                    "children": [],
-                }
-                
-                self.layer_map.setdefault(next_layer_index, {})[new_layer_id] = new_item
-                item["children"].append(new_layer_id)
-                self.pending_items.append(new_layer_id)
-
-            del item["logits"]
-            item["status"] = "done"
+        # --- Branching ---
+        new_nodes = []
+        for i, tokens, token_probs in zip(expand, final_indices, final_probs):
+            # Nucleus and minimum probability cutoffs, keep at least one child
+            keep = 1
+            mass = token_probs[0]
+            while (
+                keep < len(tokens)
+                and (self.top_p >= 1.0 or mass < self.top_p)
+                and token_probs[keep] >= self.min_probability
+            ):
+                mass += token_probs[keep]
+                keep += 1
+            if self.max_nodes is not None:
+                keep = min(keep, self.max_nodes - len(nodes))
+                if keep <= 0:
+                    break
+            children = nodes.add_children(
+                batch_ids[i], tokens[:keep], token_probs[:keep]
+            )
+            new_nodes.extend(children)
+
+        for n in new_nodes:
+            if nodes.depth[n] >= self.depth:
+                # Leaves don't need to be processed
+                nodes.status[n] = DONE
+            elif self.strategy == "best":
+                heapq.heappush(self.frontier, (-nodes.logprob[n], n))
+            else:
+                self.pending_items.append(n)
+        return new_nodes
 
     def _run_batch_generation(self):
         """
-        Identifies a batch of items at the SAME layer/depth.
+        Runs the model on the pending items, which are all at the same depth.
         Cleans up their children (in case of re-run).
-        Runs the model.
+        Returns the processed items and their next token logits.
         """
-        if not self.pending_items:
-            return
+        batch_ids = [n for n in self.pending_items if self.nodes.status[n] == PENDING]
+        self.pending_items = []
+        if not batch_ids:
+            return [], None
+
+        # CLEANUP: Before we generate, delete any existing children
+        # to prevent inconsistent tree state
+        for n in batch_ids:
+            self._delete_children(n)
+
+        # All items in this batch are at the same depth -> same length
+        parent_rows = [self.cache_rows.get(self.nodes.parent[n]) for n in batch_ids]
+        if self.cache is None or None in parent_rows:
+            # No cache for the parents (root or re-run) so process the full sequences
+            input_tensor = mx.array(
+                [self.initial_ids + self.nodes.path_tokens(n) for n in batch_ids]
+            )
+            cache = _make_cache(self.model, [0] * len(batch_ids))
+        else:
+            # Fork the parent rows and only process the new token of each child
+            input_tensor = mx.array([[self.nodes.token[n]] for n in batch_ids])
+            cache = self.cache
+            rows = mx.array(parent_rows, mx.int32)
+            for c in cache:
+                c.filter(rows)
+
+        logging.info(
+            f"Processing Layer {self.nodes.depth[batch_ids[0]]}: {len(batch_ids)} items"
+        )
 
-        # 1. Find the minimum layer present in pending items
-        min_layer = min([self._get_layer_index(pid) for pid in self.pending_items])
-        
-        # 2. Extract ONLY items at this layer
+        logits = self.model(input_tensor, cache=cache)
+        next_token_logits = logits[:, -1, :]
+        mx.eval(next_token_logits, [c.state for c in cache])
+
+        # The parents' cache has been forked into the children
+        self.cache = cache
+        self.cache_rows = {n: i for i, n in enumerate(batch_ids)}
+        return batch_ids, next_token_logits
+
+    def _run_best_first_batch(self):
+        """
+        Runs the model on the ``batch_size`` pending nodes with the most
+        probable paths. Each node starts from a copy of its parent's cache
+        and only processes its own token, or processes its whole sequence if
+        the parent's cache was dropped.
+        Returns the processed nodes and their next token logits.
+        """
+        nodes = self.nodes
         batch_ids = []
-        remaining_items = []
-        
-        for pid in self.pending_items:
-            if self._get_layer_index(pid) == min_layer:
-                batch_ids.append(pid)
+        while self.frontier and len(batch_ids) < self.batch_size:
+            _, n = heapq.heappop(self.frontier)
+            if nodes.status[n] == PENDING:
+                batch_ids.append(n)
+        if not batch_ids:
+            return [], None
+
+        # Nodes whose parent cache was dropped are processed from the prompt,
+        # grouped by depth so that the sequences have the same length
+        groups = {}
+        for n in batch_ids:
+            if nodes.parent[n] in self.node_caches:
+                groups.setdefault(None, []).append(n)
             else:
-                remaining_items.append(pid)
-        
-        # Update pending items to exclude the current batch
-        self.pending_items = remaining_items
-        
-        # 3. Prepare Batch & Cleanup Children
-        batch_input_ids = []
-        
-        for item_id in batch_ids:
-            # CLEANUP: Before we generate, delete any existing children 
-            # to prevent inconsistent tree state
-            self._delete_children(item_id)
-            
-            item = self.layer_map[min_layer][item_id]
-            batch_input_ids.append(mx.array(item["token_ids"]))
-            self.processing_queue.append(item_id)
-
-        if not batch_input_ids:
-            return
+                groups.setdefault(nodes.depth[n], []).append(n)
 
-        # 4. Run Model
-        # All items in this batch are guaranteed to be at min_layer -> same length
-        input_tensor = mx.stack(batch_input_ids)
+        logging.info(
+            f"Processing {len(batch_ids)} items, "
+            f"best path logprob {nodes.logprob[batch_ids[0]]:.3f}"
+        )
 
-        logging.info(f"Processing Layer {min_layer}: {len(batch_ids)} items")
-        
-        logits = self.model(input_tensor) 
-        next_token_logits = logits[:, -1, :]
+        batch_ids = []
+        next_token_logits = []
+        for depth, group in groups.items():
+            if depth is None:
+                input_tensor = mx.array([[nodes.token[n]] for n in group])
+                cache = _merge_caches(
+                    [self.node_caches[nodes.parent[n]] for n in group]
+                )
+            else:
+                input_tensor = mx.array(
+                    [self.initial_ids + nodes.path_tokens(n) for n in group]
+                )
+                cache = _make_cache(self.model, [0] * len(group))
+            logits = self.model(input_tensor, cache=cache)
+            for i, n in enumerate(group):
+                self.node_caches[n] = [c.extract(i) for c in cache]
+            batch_ids.extend(group)
+            next_token_logits.append(logits[:, -1, :])
+
+        next_token_logits = mx.concatenate(next_token_logits)
+        mx.eval(
+            next_token_logits,
+            [c.state for n in batch_ids for c in self.node_caches[n]],
+        )
+        return batch_ids, next_token_logits
+
+    def _release_node_caches(self, batch_ids):
+        """
+        Drops the caches of the processed nodes and of their parents once
+        they have no pending children left.
+        """
+        nodes = self.nodes
+        for n in set(batch_ids) | set(nodes.parent[n] for n in batch_ids):
+            if not any(nodes.status[c] == PENDING for c in nodes.children(n)):
+                self.node_caches.pop(n, None)
+
+        # Keep the caches of the most probable paths within the budget
+        excess = len(self.node_caches) - self.max_cached_nodes
+        if excess > 0:
+            for n in heapq.nsmallest(
+                excess, self.node_caches, key=lambda n: nodes.logprob[n]
+            ):
+                del self.node_caches[n]
+
+    def node_record(self, node):
+        """A JSON serializable description of a node."""
+        nodes = self.nodes
+        token = nodes.token[node]
+        parent = nodes.parent[node]
+        return {
+            "id": node,
+            "parent_id": parent if parent >= 0 else None,
+            "layer": nodes.depth[node],
+            "token_id": token if token >= 0 else None,
+            "probability": nodes.probability[node],
+            "last_token_text": self.tokenizer.decode([token]) if token >= 0 else "",
+        }
+
+    def stream(self):
+        """
+        Builds the tree and yields the record of every node as soon as it is
+        created, starting with the root.
+        """
+        yield self.node_record(self.root)
+        if self.strategy == "best":
+            while self.frontier:
+                if self.max_nodes is not None and len(self.nodes) >= self.max_nodes:
+                    break
+                batch_ids, logits = self._run_best_first_batch()
+                if batch_ids:
+                    for node in self._create_children(batch_ids, logits):
+                        yield self.node_record(node)
+                    self._release_node_caches(batch_ids)
+            self.node_caches = {}
+            return
 
-        # 5. Assign logits
-        for i, item_id in enumerate(batch_ids):
-            self.layer_map[min_layer][item_id]["logits"] = next_token_logits[i]
+        while self.pending_items:
+            batch_ids, logits = self._run_batch_generation()
+            if batch_ids:
+                for node in self._create_children(batch_ids, logits):
+                    yield self.node_record(node)
 
     def start(self):
-        while len(self.pending_items) > 0:
-            self._run_batch_generation()
-            self._create_children()
-    
+        for _ in self.stream():
+            pass
+
+    def write_ndjson(self, file):
+        """Builds the tree writing one JSON line per node to ``file``."""
+        for record in self.stream():
+            file.write(json.dumps(record) + "\n")
+            file.flush()
+
     def to_json(self):
-        def default(o):
-            if isinstance(o, mx.array):
-                return o.tolist()
-        return json.dumps(self.layer_map, indent=2, default=default)
+        """The whole tree grouped by layer, with the text of every node."""
+        layer_map = {}
+        texts = {}
+        for node in range(len(self.nodes)):
+            status = self.nodes.status[node]
+            if status == DELETED:
+                continue
+            record = self.node_record(node)
+            parent = record["parent_id"]
+            if parent is None:
+                texts[node] = self.initial_prompt_text
+            else:
+                texts[node] = texts[parent] + record["last_token_text"]
+            record["text"] = texts[node]
+            record["status"] = STATUS_NAMES[status]
+            record["children"] = list(self.nodes.children(node))
+            layer_map.setdefault(record["layer"], {})[node] = record
+        return json.dumps(layer_map, indent=2)
+
 
 def main():
     parser = argparse.ArgumentParser(description="LLM Loom")
@@ -212,23 +403,75 @@ def main():
     parser.add_argument("--prompt", type=str, default="The meaning of life is")
     parser.add_argument("--depth", type=int, default=3)
     parser.add_argument("--width", type=int, default=3)
+    parser.add_argument(
+        "--ndjson",
+        action="store_true",
+        help="Stream one JSON line per node as the tree is built",
+    )
+    parser.add_argument(
+        "--strategy",
+        choices=["breadth", "best"],
+        default="breadth",
+        help="Expand layer by layer or the most probable paths first",
+    )
+    parser.add_argument(
+        "--max-nodes",
+        type=int,
+        default=None,
+        help="Maximum number of nodes in the tree",
+    )
+    parser.add_argument(
+        "--top-p",
+        type=float,
+        default=1.0,
+        help="Stop adding children once they cover this probability mass",
+    )
+    parser.add_argument(
+        "--min-prob",
+        type=float,
+        default=0.0,
+        help="Minimum probability of a child, the most likely one is always kept",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=32,
+        help="Number of nodes processed at once by the best first strategy",
+    )
+    parser.add_argument(
+        "--max-cached-nodes",
+        type=int,
+        default=128,
+        help="Maximum number of node KV caches kept by the best first strategy. "
+        "Memory grows with this times the sequence length, nodes whose parent "
+        "cache was dropped are processed again from the prompt",
+    )
     args = parser.parse_args()
 
     logging.info(f"Loading model {args.model}...")
     model, tokenizer = load(args.model)
-    
+
     loom = Loom(
-        model=model, 
-        tokenizer=tokenizer, 
-        initial_prompt_text=args.prompt, 
-        depth=args.depth, 
-        width=args.width
+        model=model,
+        tokenizer=tokenizer,
+        initial_prompt_text=args.prompt,
+        depth=args.depth,
+        width=args.width,
+        strategy=args.strategy,
+        max_nodes=args.max_nodes,
+        top_p=args.top_p,
+        min_probability=args.min_prob,
+        batch_size=args.batch_size,
+        max_cached_nodes=args.max_cached_nodes,
     )
-    
+
     logging.info("Starting Loom...")
-    loom.start()
-    
-    print(loom.to_json())
+    if args.ndjson:
+        loom.write_ndjson(sys.stdout)
+    else:
+        loom.start()
+        print(loom.to_json())
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -98,10 +98,14 @@ class MLXLM(LM):
     def _process_prompt(self, prompt, step_size: int = 2048):
         prompt = mx.array(prompt)[None]
         cache = make_prompt_cache(self._model)
-        for i in range(0, prompt.shape[1], step_size):
-            logits = self._model(prompt[:, i : i + step_size], cache=cache)
+        # Only the logits of the last token are needed
+        for i in range(0, prompt.shape[1] - 1, step_size):
+            self._model(
+                prompt[:, i : min(i + step_size, prompt.shape[1] - 1)], cache=cache
+            )
             mx.eval([c.state for c in cache])
             mx.clear_cache()
+        logits = self._model(prompt[:, -1:], cache=cache)
         logprobs = nn.log_softmax(logits[:, -1, :].astype(mx.float32))
         return logprobs, cache
 
@@ -6,11 +6,12 @@ import functools
 import json
 import sys
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
 from functools import partial
 from typing import (
     Any,
     Callable,
+    Dict,
     Generator,
     List,
     Optional,
@@ -27,14 +28,21 @@ from .models import cache
 from .models.cache import (
     ArraysCache,
     BatchKVCache,
+    BatchQuantizedKVCache,
     BatchRotatingKVCache,
     CacheList,
     KVCache,
+    PagedKVCache,
     QuantizedKVCache,
     RotatingKVCache,
+    StaticKVCache,
     load_prompt_cache,
 )
-from .sample_utils import make_sampler
+from .sample_utils import (
+    make_batch_logits_processors,
+    make_batch_sampler,
+    make_sampler,
+)
 from .tokenizer_utils import TokenizerWrapper
 from .utils import does_model_support_input_embeddings, load
 
@@ -210,6 +218,25 @@ def setup_arg_parser():
         help="Number of tokens to draft when using speculative decoding.",
         default=3,
     )
+    parser.add_argument(
+        "--max-draft-tokens",
+        type=int,
+        help="Adapt the number of draft tokens to the acceptance rate, "
+        "starting from --num-draft-tokens and up to this value.",
+        default=None,
+    )
+    parser.add_argument(
+        "--prompt-lookup",
+        action="store_true",
+        help="Use prompt lookup decoding: draft tokens by matching n-grams "
+        "against the prompt and the generated text instead of a draft model.",
+    )
+    parser.add_argument(
+        "--ngram-size",
+        type=int,
+        help="The largest n-gram to match with --prompt-lookup.",
+        default=3,
+    )
     return parser
 
 
@@ -257,6 +284,31 @@ def wired_limit(model: nn.Module, streams: Optional[List[mx.Stream]] = None):
             mx.set_wired_limit(old_limit)
 
 
+@dataclass
+class DraftStats:
+    """
+    Statistics of the draft tokens in speculative decoding.
+
+    Args:
+        num_draft_tokens (int): The number of tokens drafted in the last round.
+        drafted_tokens (int): The total number of drafted tokens.
+        accepted_tokens (int): The total number of accepted draft tokens.
+    """
+
+    num_draft_tokens: int = 0
+    drafted_tokens: int = 0
+    accepted_tokens: int = 0
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted_tokens / max(self.drafted_tokens, 1)
+
+    def update(self, num_draft: int, num_accept: int):
+        self.num_draft_tokens = num_draft
+        self.drafted_tokens += num_draft
+        self.accepted_tokens += num_accept
+
+
 @dataclass
 class GenerationResponse:
     """
@@ -273,6 +325,8 @@ class GenerationResponse:
         generation_tps (float): The tokens-per-second for generation.
         peak_memory (float): The peak memory used so far in GB.
         finish_reason (str): The reason the response is being sent: "length", "stop" or `None`
+        draft_stats (DraftStats, optional): The draft token statistics so far
+          when using speculative decoding.
     """
 
     text: str
@@ -285,6 +339,7 @@ class GenerationResponse:
     generation_tps: float
     peak_memory: float
     finish_reason: Optional[str] = None
+    draft_stats: Optional[DraftStats] = None
 
 
 def maybe_quantize_kv_cache(prompt_cache, quantized_kv_start, kv_group_size, kv_bits):
@@ -295,6 +350,41 @@ def maybe_quantize_kv_cache(prompt_cache, quantized_kv_start, kv_group_size, kv_
             prompt_cache[e] = c.to_quantized(group_size=kv_group_size, bits=kv_bits)
 
 
+class _CompiledStep:
+    """
+    A decoding step of a model compiled with ``mx.compile``.
+
+    The KV caches are viewed through :obj:`StaticKVCache` so the graph keeps
+    the same shapes from one token to the next and the compiled function is
+    reused. Only caches made of non-empty :obj:`KVCache` or
+    :obj:`BatchKVCache` layers are supported.
+    """
+
+    def __init__(self, model: nn.Module):
+        def step(inputs, state):
+            prompt_cache = [StaticKVCache.from_state(s, "") for s in state]
+            logits = model(inputs, cache=prompt_cache)
+            return logits, [c.state for c in prompt_cache]
+
+        self._step = mx.compile(step)
+
+    @staticmethod
+    def supports(prompt_cache: List[Any]) -> bool:
+        return all(
+            type(c) in (KVCache, BatchKVCache) and c.keys is not None
+            for c in prompt_cache
+        )
+
+    def __call__(self, inputs: mx.array, prompt_cache: List[Any]) -> mx.array:
+        num_tokens = inputs.shape[1]
+        static_cache = [StaticKVCache(c, num_tokens) for c in prompt_cache]
+        logits, state = self._step(inputs, [c.state for c in static_cache])
+        for c, s in zip(static_cache, state):
+            c.state = s
+            c.write_back(num_tokens)
+        return logits
+
+
 def generate_step(
     prompt: mx.array,
     model: nn.Module,
@@ -310,6 +400,8 @@ def generate_step(
     quantized_kv_start: int = 0,
     prompt_progress_callback: Optional[Callable[[int, int], None]] = None,
     input_embeddings: Optional[mx.array] = None,
+    compile_decode: bool = False,
+    compiled_step: Optional[_CompiledStep] = None,
 ) -> Generator[Tuple[mx.array, mx.array], None, None]:
     """
     A generator producing token ids based on the given prompt from the model.
@@ -338,6 +430,12 @@ def generate_step(
            prompt tokens processed so far and the total number of prompt tokens.
         input_embeddings (mx.array, optional): Input embeddings to use instead of or in
           conjunction with prompt tokens. Default: ``None``.
+        compile_decode (bool): Compile the decoding steps with ``mx.compile``.
+          Only applies to models whose cache is made of ``KVCache`` layers,
+          other caches run eagerly. Default: ``False``.
+        compiled_step (_CompiledStep, optional): The compiled decoding step of
+          ``model`` from an earlier call to reuse instead of compiling it
+          again. Implies ``compile_decode``. Default: ``None``.
 
     Yields:
         Tuple[mx.array, mx.array]: One token and a vector of log probabilities.
@@ -375,6 +473,8 @@ def generate_step(
     )
 
     sampler = sampler or (lambda x: mx.argmax(x, axis=-1))
+    if compiled_step is None and compile_decode:
+        compiled_step = _CompiledStep(model)
 
     def _model_call(input_tokens: mx.array, input_embeddings: Optional[mx.array]):
         if input_embeddings is not None:
@@ -388,12 +488,19 @@ def generate_step(
         nonlocal tokens
 
         with mx.stream(generation_stream):
-            logits = _model_call(
-                input_tokens=input_tokens[None],
-                input_embeddings=(
-                    input_embeddings[None] if input_embeddings is not None else None
-                ),
-            )
+            if (
+                compiled_step is not None
+                and input_embeddings is None
+                and compiled_step.supports(prompt_cache)
+            ):
+                logits = compiled_step(input_tokens[None], prompt_cache)
+            else:
+                logits = _model_call(
+                    input_tokens=input_tokens[None],
+                    input_embeddings=(
+                        input_embeddings[None] if input_embeddings is not None else None
+                    ),
+                )
 
             logits = logits[:, -1, :]
 
@@ -430,6 +537,8 @@ def generate_step(
                 ),
             )
             quantize_cache_fn(prompt_cache)
+            # Only the cache is evaluated so the LM head of the prefill
+            # chunk is never computed
             mx.eval([c.state for c in prompt_cache])
             prompt_processed_tokens += n_to_process
             prompt_progress_callback(prompt_processed_tokens, total_prompt_tokens)
@@ -461,12 +570,60 @@ def generate_step(
         n += 1
 
 
+class _DraftLength:
+    """
+    The number of tokens to draft in each round of speculative decoding.
+
+    If ``max_draft_tokens`` is set, the draft length follows the running
+    acceptance rate ``a``, the fraction of draft tokens which match the
+    model averaged with an exponential decay. A run of accepted tokens is
+    ``a / (1 - a)`` tokens long on average, and one more token is drafted so
+    the run can end on a draft token.
+    """
+
+    def __init__(
+        self,
+        num_draft_tokens: int,
+        max_draft_tokens: Optional[int] = None,
+        decay: float = 0.8,
+    ):
+        if max_draft_tokens is not None:
+            if max_draft_tokens < 1:
+                raise ValueError(
+                    f"max_draft_tokens must be positive but got {max_draft_tokens}."
+                )
+            # Draft at least one token so that the acceptance rate is known
+            num_draft_tokens = min(max(num_draft_tokens, 1), max_draft_tokens)
+        self.value = num_draft_tokens
+        self.max_draft_tokens = max_draft_tokens
+        self.decay = decay
+        # Start from the acceptance rate which gives ``num_draft_tokens``
+        self._accepted = num_draft_tokens - 1
+        self._trials = num_draft_tokens
+
+    def update(self, num_draft: int, num_accept: int):
+        if self.max_draft_tokens is None or num_draft == 0:
+            return
+        # Tokens after the first rejected one are not compared
+        trials = num_accept + (num_accept < num_draft)
+        self._accepted = self.decay * self._accepted + num_accept
+        self._trials = self.decay * self._trials + trials
+        rate = self._accepted / self._trials
+        if rate < 1:
+            value = round(rate / (1 - rate)) + 1
+        else:
+            value = self.max_draft_tokens
+        self.value = min(max(value, 1), self.max_draft_tokens)
+
+
 def speculative_generate_step(
     prompt: mx.array,
     model: nn.Module,
     draft_model: nn.Module,
     *,
     num_draft_tokens: int = 2,
+    max_draft_tokens: Optional[int] = None,
+    draft_stats: Optional[DraftStats] = None,
     max_tokens: int = 256,
     sampler: Optional[Callable[[mx.array], mx.array]] = None,
     logits_processors: Optional[List[Callable[[mx.array, mx.array], mx.array]]] = None,
@@ -485,6 +642,12 @@ def speculative_generate_step(
         draft_model (nn.Module): The draft model for speculative decoding.
         num_draft_tokens (int, optional): The number of draft tokens for
           speculative decoding. Default: ``2``.
+        max_draft_tokens (int, optional): If set, the number of draft tokens
+          adapts to the running acceptance rate, starting from
+          ``num_draft_tokens`` and up to ``max_draft_tokens``.
+          Default: ``None``.
+        draft_stats (DraftStats, optional): Statistics of the draft tokens,
+          updated in place when provided. Default: ``None``.
         max_tokens (int): The maximum number of tokens. Use``-1`` for an infinite
           generator. Default: ``256``.
         sampler (Callable[[mx.array], mx.array], optional): A sampler for sampling a
@@ -508,6 +671,7 @@ def speculative_generate_step(
 
     y = prompt.astype(mx.uint32)
     prev_tokens = None
+    draft_length = _DraftLength(num_draft_tokens, max_draft_tokens)
 
     # Create the KV cache for generation
     if prompt_cache is None:
@@ -560,11 +724,14 @@ def speculative_generate_step(
                 return _process_and_sample(None, logits.squeeze(0))
 
     def _prefill(model, cache, y):
-        while y.size > prefill_step_size:
-            model(y[:prefill_step_size][None], cache=cache)
+        # Leave only the last token for the first step so the logits (and
+        # the LM head) are computed for that position alone
+        while y.size > 1:
+            n_to_process = min(prefill_step_size, y.size - 1)
+            model(y[:n_to_process][None], cache=cache)
             quantize_cache_fn(cache)
             mx.eval([c.state for c in cache])
-            y = y[prefill_step_size:]
+            y = y[n_to_process:]
             mx.clear_cache()
         return y
 
@@ -592,7 +759,7 @@ def speculative_generate_step(
     n = 0
     try:
         while True:
-            num_draft = min(max_tokens - ntoks, num_draft_tokens)
+            num_draft = min(max_tokens - ntoks, draft_length.value)
             draft_tokens = _draft_generate(draft_y, num_draft)
             if prev_tokens is not None:
                 prev_tokens = prev_tokens[: prev_tokens.size - y.size - num_draft + 1]
@@ -601,14 +768,21 @@ def speculative_generate_step(
             mx.eval(tokens, draft_tokens)
             draft_tokens = draft_tokens.tolist()
             tokens = tokens.tolist()
+            num_accept = 0
+            while (
+                num_accept < num_draft
+                and tokens[num_accept] == draft_tokens[num_accept]
+            ):
+                num_accept += 1
+            draft_length.update(num_draft, num_accept)
+            if draft_stats is not None:
+                draft_stats.update(num_draft, num_accept)
+
             n = 0
-            while n < num_draft:
-                tn, dtn, lpn = tokens[n], draft_tokens[n], logprobs[n]
-                if tn != dtn:
-                    break
+            while n < num_accept:
                 n += 1
                 ntoks += 1
-                yield tn, lpn, True
+                yield tokens[n - 1], logprobs[n - 1], True
                 if ntoks == max_tokens:
                     break
             if ntoks < max_tokens:
@@ -636,12 +810,195 @@ def speculative_generate_step(
         _rewind_cache(num_draft, n)
 
 
+class _PromptLookup:
+    """
+    Propose draft tokens by matching the trailing n-gram of the tokens seen
+    so far against their most recent earlier occurrence.
+
+    Args:
+        tokens (List[int]): The initial tokens, usually the prompt.
+        ngram_size (int): The largest n-gram to match. Smaller n-grams are
+          tried when the largest one is not found.
+    """
+
+    def __init__(self, tokens: List[int], ngram_size: int):
+        self.tokens = []
+        self.ngram_size = ngram_size
+        # Map every n-gram to the position of the token following it
+        self._index = [{} for _ in range(ngram_size)]
+        self.extend(tokens)
+
+    def extend(self, tokens: List[int]):
+        for t in tokens:
+            p = len(self.tokens)
+            self.tokens.append(t)
+            for n in range(1, min(self.ngram_size, p) + 1):
+                self._index[n - 1][tuple(self.tokens[p - n : p])] = p
+
+    def draft(self, num_draft: int) -> List[int]:
+        for n in range(min(self.ngram_size, len(self.tokens)), 0, -1):
+            start = self._index[n - 1].get(tuple(self.tokens[-n:]))
+            if start is not None:
+                return self.tokens[start : start + num_draft]
+        return []
+
+
+def prompt_lookup_generate_step(
+    prompt: mx.array,
+    model: nn.Module,
+    *,
+    num_draft_tokens: int = 3,
+    ngram_size: int = 3,
+    max_draft_tokens: Optional[int] = None,
+    draft_stats: Optional[DraftStats] = None,
+    max_tokens: int = 256,
+    sampler: Optional[Callable[[mx.array], mx.array]] = None,
+    logits_processors: Optional[List[Callable[[mx.array, mx.array], mx.array]]] = None,
+    prompt_cache: Optional[Any] = None,
+    prefill_step_size: int = 512,
+    kv_bits: Optional[int] = None,
+    kv_group_size: int = 64,
+    quantized_kv_start: int = 0,
+) -> Generator[Tuple[mx.array, mx.array, bool], None, None]:
+    """
+    A generator producing token ids based on the given prompt from the model
+    using prompt lookup decoding.
+
+    The draft tokens are the continuation of the most recent earlier
+    occurrence of the trailing n-gram in the prompt and the generated
+    tokens. They are verified by the model in a single step as in
+    :func:`speculative_generate_step`, so no draft model is needed.
+
+    Args:
+        prompt (mx.array): The input prompt.
+        model (nn.Module): The model to use for generation.
+        num_draft_tokens (int, optional): The maximum number of draft tokens
+          per step. Default: ``3``.
+        ngram_size (int, optional): The largest n-gram to look up. Default: ``3``.
+        max_draft_tokens (int, optional): If set, the maximum number of draft
+          tokens adapts to the running acceptance rate, starting from
+          ``num_draft_tokens`` and up to ``max_draft_tokens``.
+          Default: ``None``.
+        draft_stats (DraftStats, optional): Statistics of the draft tokens,
+          updated in place when provided. Default: ``None``.
+        max_tokens (int): The maximum number of tokens. Use``-1`` for an infinite
+          generator. Default: ``256``.
+        sampler (Callable[[mx.array], mx.array], optional): A sampler for sampling a
+          token from a vector of log probabilities. Default: ``None``.
+        logits_processors (List[Callable[[mx.array, mx.array], mx.array]], optional):
+          A list of functions that take tokens and logits and return the processed
+          logits. Default: ``None``.
+        prompt_cache (List[Any], optional): A pre-computed prompt cache. Note, if
+          provided, the cache will be updated in place. The cache must be trimmable.
+        prefill_step_size (int): Step size for processing the prompt.
+        kv_bits (int, optional): Number of bits to use for KV cache quantization.
+          None implies no cache quantization. Default: ``None``.
+        kv_group_size (int): Group size for KV cache quantization. Default: ``64``.
+        quantized_kv_start (int): Step to begin using a quantized KV cache.
+           when ``kv_bits`` is non-None. Default: ``0``.
+
+    Yields:
+        Tuple[mx.array, mx.array, bool]: One token, a vector of log probabilities,
+          and a bool indicating if the token was drafted by the prompt lookup
+    """
+    if ngram_size < 1:
+        raise ValueError(f"ngram_size must be positive but got {ngram_size}.")
+
+    y = prompt.astype(mx.uint32)
+    lookup = _PromptLookup(y.tolist(), ngram_size)
+    draft_length = _DraftLength(num_draft_tokens, max_draft_tokens)
+    # The logits processors see the tokens from the last prompt token on
+    history_start = y.size - 1
+
+    if prompt_cache is None:
+        prompt_cache = cache.make_prompt_cache(model)
+    if not _can_rewind(prompt_cache):
+        raise ValueError(
+            "Prompt lookup decoding is only supported with full attention KV caches."
+        )
+
+    sampler = sampler or (lambda x: mx.argmax(x, axis=-1))
+
+    quantize_cache_fn = functools.partial(
+        maybe_quantize_kv_cache,
+        quantized_kv_start=quantized_kv_start,
+        kv_group_size=kv_group_size,
+        kv_bits=kv_bits,
+    )
+
+    def _step(y):
+        with mx.stream(generation_stream):
+            logits = model(y[None], cache=prompt_cache)[0]
+            quantize_cache_fn(prompt_cache)
+            if logits_processors:
+                prev_tokens = mx.array(lookup.tokens[history_start:-1], mx.uint32)
+                processed = []
+                for i in range(y.size):
+                    tokens = mx.concatenate([prev_tokens, y[: i + 1]])
+                    logits_i = logits[i : i + 1]
+                    for processor in logits_processors:
+                        logits_i = processor(tokens, logits_i)
+                    processed.append(logits_i)
+                logits = mx.concatenate(processed, axis=0)
+            logprobs = logits - mx.logsumexp(logits, axis=-1, keepdims=True)
+            return sampler(logprobs), logprobs
+
+    with mx.stream(generation_stream):
+        # Leave only the last token for the first step so the logits (and
+        # the LM head) are computed for that position alone
+        while y.size > 1:
+            n_to_process = min(prefill_step_size, y.size - 1)
+            model(y[:n_to_process][None], cache=prompt_cache)
+            quantize_cache_fn(prompt_cache)
+            mx.eval([c.state for c in prompt_cache])
+            y = y[n_to_process:]
+            mx.clear_cache()
+
+    ntoks = 0
+    # Set these so the finally block doesn't raise
+    num_draft = 0
+    n = 0
+    try:
+        while True:
+            draft_tokens = lookup.draft(min(max_tokens - ntoks, draft_length.value))
+            num_draft = len(draft_tokens)
+            y = mx.concatenate([y, mx.array(draft_tokens, mx.uint32)])
+            tokens, logprobs = _step(y)
+            mx.eval(tokens)
+            tokens = tokens.tolist()
+            num_accept = 0
+            while (
+                num_accept < num_draft
+                and tokens[num_accept] == draft_tokens[num_accept]
+            ):
+                num_accept += 1
+            draft_length.update(num_draft, num_accept)
+            if draft_stats is not None:
+                draft_stats.update(num_draft, num_accept)
+            lookup.extend(tokens[: num_accept + 1])
+            # The cache keeps the inputs up to the last yielded token
+            for n in range(num_accept + 1):
+                ntoks += 1
+                yield tokens[n], logprobs[n], n < num_accept
+                if ntoks == max_tokens:
+                    break
+            if ntoks == max_tokens:
+                break
+
+            y = mx.array([tokens[n]], mx.uint32)
+            cache.trim_prompt_cache(prompt_cache, num_draft - n)
+            num_draft = n = 0
+    finally:
+        cache.trim_prompt_cache(prompt_cache, num_draft - n)
+
+
 def stream_generate(
     model: nn.Module,
     tokenizer: Union[PreTrainedTokenizer, TokenizerWrapper],
     prompt: Union[str, mx.array, List[int]],
     max_tokens: int = 256,
     draft_model: Optional[nn.Module] = None,
+    prompt_lookup: bool = False,
     **kwargs,
 ) -> Generator[GenerationResponse, None, None]:
     """
@@ -657,6 +1014,9 @@ def stream_generate(
         draft_model (Optional[nn.Module]): An optional draft model. If provided
           then speculative decoding is used. The draft model must use the same
           tokenizer as the main model. Default: ``None``.
+        prompt_lookup (bool): Use prompt lookup decoding, drafting tokens from
+          the prompt and the generated text instead of a draft model. See
+          :func:`prompt_lookup_generate_step`. Default: ``False``.
         kwargs: The remaining options get passed to :func:`generate_step`.
           See :func:`generate_step` for more details.
 
@@ -680,8 +1040,14 @@ def stream_generate(
 
     kwargs["max_tokens"] = max_tokens
 
-    if draft_model is None:
+    if draft_model is not None and prompt_lookup:
+        raise ValueError("Prompt lookup decoding does not use a draft model.")
+
+    draft_stats = None
+    if draft_model is None and not prompt_lookup:
         kwargs.pop("num_draft_tokens", None)
+        kwargs.pop("max_draft_tokens", None)
+        kwargs.pop("ngram_size", None)
         token_generator = generate_step(prompt, model, **kwargs)
         # from_draft always false for non-speculative generation
         token_generator = (
@@ -690,9 +1056,16 @@ def stream_generate(
     else:
         kwargs.pop("max_kv_size", None)
         kwargs.pop("prompt_progress_callback", None)
-        token_generator = speculative_generate_step(
-            prompt, model, draft_model, **kwargs
-        )
+        kwargs.pop("compile_decode", None)
+        kwargs.pop("compiled_step", None)
+        draft_stats = kwargs["draft_stats"] = DraftStats()
+        if prompt_lookup:
+            token_generator = prompt_lookup_generate_step(prompt, model, **kwargs)
+        else:
+            kwargs.pop("ngram_size", None)
+            token_generator = speculative_generate_step(
+                prompt, model, draft_model, **kwargs
+            )
     with wired_limit(model, [generation_stream]):
         tic = time.perf_counter()
         for n, (token, logprobs, from_draft) in enumerate(token_generator):
@@ -718,6 +1091,7 @@ def stream_generate(
                 generation_tps=(n + 1) / (time.perf_counter() - tic),
                 peak_memory=mx.get_peak_memory() / 1e9,
                 finish_reason=None,
+                draft_stats=replace(draft_stats) if draft_stats else None,
             )
 
         detokenizer.finalize()
@@ -732,6 +1106,7 @@ def stream_generate(
             generation_tps=(n + 1) / (time.perf_counter() - tic),
             peak_memory=mx.get_peak_memory() / 1e9,
             finish_reason="stop" if token in tokenizer.eos_token_ids else "length",
+            draft_stats=replace(draft_stats) if draft_stats else None,
         )
 
 
@@ -777,6 +1152,12 @@ def generate(
             f"Generation: {response.generation_tokens} tokens, "
             f"{response.generation_tps:.3f} tokens-per-sec"
         )
+        if response.draft_stats is not None:
+            stats = response.draft_stats
+            print(
+                f"Draft: {stats.accepted_tokens}/{stats.drafted_tokens} tokens "
+                f"accepted ({stats.acceptance_rate:.1%})"
+            )
         print(f"Peak memory: {response.peak_memory:.3f} GB")
     return text
 
@@ -832,6 +1213,17 @@ class BatchResponse:
     caches: Optional[List[List[Any]]]
 
 
+def _pad_tokens(tokens, size, width):
+    """
+    Left-pad a ``(B, context)`` token history with ``-1`` to ``width``.
+    """
+    if tokens is None:
+        return mx.full((size, width), -1, mx.int32)
+    if tokens.shape[1] < width:
+        return mx.pad(tokens, [(0, 0), (width - tokens.shape[1], 0)], -1)
+    return tokens
+
+
 @dataclass
 class Batch:
     uids: List[int]
@@ -840,23 +1232,53 @@ class Batch:
     max_tokens: List[int]
     num_tokens: List[int]
     cache: List[Any]
+    prev_y: Optional[mx.array] = None
+    sampling: List[Optional[Dict[str, Any]]] = field(default_factory=list)
+    sampler: Optional[Callable[[mx.array], mx.array]] = None
+    logits_params: List[Optional[Dict[str, Any]]] = field(default_factory=list)
+    logits_processors: Optional[List[Callable]] = None
+    tokens: Optional[mx.array] = None
 
     def __len__(self):
         return len(self.uids)
 
     def filter(self, keep_idx: List[int]):
         self.uids = [self.uids[k] for k in keep_idx]
+        self.sampling = [self.sampling[k] for k in keep_idx]
+        self.sampler = None
+        self.logits_params = [self.logits_params[k] for k in keep_idx]
+        self.logits_processors = None
         self.logprobs = [self.logprobs[k] for k in keep_idx]
         self.max_tokens = [self.max_tokens[k] for k in keep_idx]
         self.num_tokens = [self.num_tokens[k] for k in keep_idx]
         keep_idx = mx.array(keep_idx, mx.int32)
         self.y = self.y[keep_idx]
+        if self.prev_y is not None:
+            self.prev_y = self.prev_y[keep_idx]
+        if self.tokens is not None:
+            self.tokens = self.tokens[keep_idx]
         for c in self.cache:
             c.filter(keep_idx)
 
     def extend(self, other):
+        if self.tokens is not None or other.tokens is not None:
+            width = max(
+                t.shape[1] for t in (self.tokens, other.tokens) if t is not None
+            )
+            self.tokens = mx.concatenate(
+                [
+                    _pad_tokens(self.tokens, len(self), width),
+                    _pad_tokens(other.tokens, len(other), width),
+                ]
+            )
         self.uids.extend(other.uids)
+        self.sampling.extend(other.sampling)
+        self.sampler = None
+        self.logits_params.extend(other.logits_params)
+        self.logits_processors = None
         self.y = mx.concatenate([self.y, other.y])
+        if self.prev_y is not None:
+            self.prev_y = mx.concatenate([self.prev_y, other.prev_y])
         self.logprobs.extend(other.logprobs)
         self.num_tokens.extend(other.num_tokens)
         self.max_tokens.extend(other.max_tokens)
@@ -867,15 +1289,64 @@ class Batch:
         return [c.extract(idx) for c in self.cache]
 
 
-def _make_cache(model, left_padding):
+@dataclass
+class PrefillBatch:
+    uids: List[int]
+    inputs: mx.array
+    last_inputs: Optional[mx.array]
+    lengths: List[int]
+    max_tokens: List[int]
+    cache: List[Any]
+    sampling: List[Optional[Dict[str, Any]]]
+    logits_params: List[Optional[Dict[str, Any]]]
+    tokens: Optional[mx.array]
+    processed_tokens: int = 0
+    boundaries: List[int] = field(default_factory=list)
+    removed: set = field(default_factory=set)
+
+    def __len__(self):
+        return len(self.uids)
+
+    @property
+    def done(self):
+        return self.inputs.shape[1] <= 1
+
+    def filter(self, keep_idx: List[int]):
+        self.uids = [self.uids[k] for k in keep_idx]
+        self.lengths = [self.lengths[k] for k in keep_idx]
+        self.max_tokens = [self.max_tokens[k] for k in keep_idx]
+        self.sampling = [self.sampling[k] for k in keep_idx]
+        self.logits_params = [self.logits_params[k] for k in keep_idx]
+        keep_idx = mx.array(keep_idx, mx.int32)
+        self.inputs = self.inputs[keep_idx]
+        if self.last_inputs is not None:
+            self.last_inputs = self.last_inputs[keep_idx]
+        if self.tokens is not None:
+            self.tokens = self.tokens[keep_idx]
+        for c in self.cache:
+            c.filter(keep_idx)
+
+
+def _make_cache(
+    model, left_padding, kv_block_size=None, kv_bits=None, kv_group_size=64
+):
     """
     Convert a list of regular caches into their corresponding
     batch-aware caches.
     """
 
+    def make_kv_cache():
+        if kv_bits is not None:
+            return BatchQuantizedKVCache(
+                left_padding, group_size=kv_group_size, bits=kv_bits
+            )
+        elif kv_block_size is not None:
+            return PagedKVCache(left_padding, block_size=kv_block_size)
+        return BatchKVCache(left_padding)
+
     def to_batch_cache(c):
         if type(c) is KVCache:
-            return BatchKVCache(left_padding)
+            return make_kv_cache()
         elif isinstance(c, ArraysCache):
             c.left_padding = mx.array(left_padding)
             return c
@@ -892,23 +1363,60 @@ def _make_cache(model, left_padding):
         cache = model.make_cache()
         return [to_batch_cache(c) for c in cache]
     else:
-        return [BatchKVCache(left_padding) for _ in model.layers]
+        return [make_kv_cache() for _ in model.layers]
 
 
-def _merge_caches(caches):
-    batch_cache = []
-    for i in range(len(caches[0])):
-        cache = None
-        if isinstance(caches[0][i], KVCache):
-            cache = BatchKVCache.merge([c[i] for c in caches])
-        elif isinstance(caches[0][i], RotatingKVCache):
-            cache = BatchRotatingKVCache.merge([c[i] for c in caches])
+def _merge_caches(caches, kv_block_size=None, kv_bits=None, kv_group_size=64):
+    def merge(layer):
+        if isinstance(layer[0], (KVCache, QuantizedKVCache)) and kv_bits is not None:
+            return BatchQuantizedKVCache.merge(
+                layer, group_size=kv_group_size, bits=kv_bits
+            )
+        elif isinstance(layer[0], QuantizedKVCache):
+            return BatchQuantizedKVCache.merge(
+                layer, group_size=layer[0].group_size, bits=layer[0].bits
+            )
+        elif isinstance(layer[0], KVCache) and kv_block_size is not None:
+            return PagedKVCache.merge(layer, block_size=kv_block_size)
+        elif isinstance(layer[0], KVCache):
+            return BatchKVCache.merge(layer)
+        elif isinstance(layer[0], RotatingKVCache):
+            return BatchRotatingKVCache.merge(layer)
+        elif isinstance(layer[0], ArraysCache):
+            return ArraysCache.merge(layer)
+        elif isinstance(layer[0], CacheList):
+            return CacheList(
+                *(merge([c[j] for c in layer]) for j in range(len(layer[0].caches)))
+            )
         else:
             raise ValueError(
-                f"{type(caches[0][i])} does not yet support batching with history"
+                f"{type(layer[0])} does not yet support batching with history"
             )
-        batch_cache.append(cache)
-    return batch_cache
+
+    return [merge([c[i] for c in caches]) for i in range(len(caches[0]))]
+
+
+def _has_state(c):
+    if isinstance(c, ArraysCache):
+        return any(s is not None for s in c.cache)
+    elif isinstance(c, CacheList):
+        return any(_has_state(sub_c) for sub_c in c.caches)
+    return len(c) > 0
+
+
+def _has_arrays_cache(c):
+    if isinstance(c, CacheList):
+        return any(_has_arrays_cache(sub_c) for sub_c in c.caches)
+    return isinstance(c, ArraysCache)
+
+
+def _can_rewind(prompt_cache):
+    """
+    Whether a prompt cache, or its batched version, can drop the rejected
+    draft tokens of speculative decoding at any length. Rotating caches can't
+    once they are full and recurrent states can't at all.
+    """
+    return all(type(c) in (KVCache, QuantizedKVCache) for c in prompt_cache)
 
 
 class BatchGenerator:
@@ -933,8 +1441,21 @@ class BatchGenerator:
         prompt_progress_callback: Optional[
             Callable[[List[Tuple[int, int, int]]], None]
         ] = None,
+        kv_block_size: Optional[int] = None,
+        kv_bits: Optional[int] = None,
+        kv_group_size: int = 64,
+        prefill_token_budget: Optional[int] = None,
+        draft_model: Optional[nn.Module] = None,
+        num_draft_tokens: int = 2,
+        compile_decode: bool = False,
+        compiled_step: Optional[_CompiledStep] = None,
     ):
         self.model = model
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+        if compiled_step is None and compile_decode:
+            compiled_step = _CompiledStep(model)
+        self._compiled_step = compiled_step
         self.unprocessed_prompts = []
         self.max_tokens = max_tokens
         self.stop_tokens = stop_tokens or set()
@@ -944,9 +1465,25 @@ class BatchGenerator:
         self.prefill_batch_size = prefill_batch_size
         self.completion_batch_size = max(completion_batch_size, prefill_batch_size)
         self.prompt_progress_callback = prompt_progress_callback or (lambda *_: None)
+        if kv_bits is not None and kv_block_size is not None:
+            raise ValueError("Paged KV caches can't be quantized.")
+        if draft_model is not None and not all(
+            _can_rewind(cache.make_prompt_cache(m)) for m in (model, draft_model)
+        ):
+            raise ValueError(
+                "Speculative decoding is only supported with full "
+                "attention KV caches."
+            )
+        self.kv_block_size = kv_block_size
+        self.kv_bits = kv_bits
+        self.kv_group_size = kv_group_size
+        self.prefill_token_budget = prefill_token_budget
         self._stats = BatchStats()
+        # The uids of the extra samples of each prompt
+        self._samples = {}
 
         self.active_batch = None
+        self.prefill_batch = None
 
         if mx.metal.is_available():
             self._old_wired_limit = mx.set_wired_limit(
@@ -955,8 +1492,12 @@ class BatchGenerator:
         else:
             self._old_wired_limit = None
 
+    @property
+    def _cache_options(self):
+        return self.kv_block_size, self.kv_bits, self.kv_group_size
+
     def close(self):
-        if self._old_wired_limit is not None:
+        if getattr(self, "_old_wired_limit", None) is not None:
             mx.synchronize(generation_stream)
             mx.set_wired_limit(self._old_wired_limit)
             self._old_wired_limit = None
@@ -965,23 +1506,79 @@ class BatchGenerator:
         self.close()
 
     def insert(
-        self, prompts, max_tokens: Union[List[int], int, None] = None, caches=None
+        self,
+        prompts,
+        max_tokens: Union[List[int], int, None] = None,
+        caches=None,
+        sampling: Optional[List[Optional[Dict[str, Any]]]] = None,
+        logits_params: Optional[List[Optional[Dict[str, Any]]]] = None,
+        num_samples: Union[List[int], int, None] = None,
     ):
+        """
+        Add prompts to be processed.
+
+        Args:
+            prompts (List[List[int]]): The input prompts.
+            max_tokens (Union[List[int], int], optional): Maximum number of
+              output tokens, either per prompt or for all of them.
+            caches (List[List[Any]], optional): Pre-computed prompt caches for
+              each prompt.
+            sampling (List[Dict[str, Any]], optional): The sampling parameters
+              for each prompt given as a dictionary with the ``temp``,
+              ``top_p``, ``min_p`` and ``top_k`` keywords of
+              :func:`make_sampler`. Prompts without parameters use the
+              ``sampler`` of the generator.
+            logits_params (List[Dict[str, Any]], optional): The logits
+              processing parameters for each prompt given as a dictionary with
+              the ``logit_bias``, ``repetition_penalty`` and
+              ``repetition_context_size`` keywords of
+              :func:`make_logits_processors`.
+            num_samples (Union[List[int], int], optional): The number of
+              sequences to generate, either per prompt or for all of them. The
+              prompt is processed once and its cache is copied for each
+              sequence. Default: ``1``.
+
+        Returns:
+            List[int]: The uid of each sequence. The sequences of a prompt have
+            consecutive uids.
+        """
         uids = []
 
         if max_tokens is None or isinstance(max_tokens, int):
             max_tokens = [max_tokens or self.max_tokens] * len(prompts)
+        if sampling is None:
+            sampling = [None] * len(prompts)
+        if num_samples is None or isinstance(num_samples, int):
+            num_samples = [num_samples or 1] * len(prompts)
+        if logits_params is None:
+            logits_params = [None] * len(prompts)
+        elif self.draft_model is not None and any(logits_params):
+            raise ValueError(
+                "Logits processors are not supported with speculative decoding."
+            )
 
         if caches is None:
             caches = [None] * len(prompts)
         for i in range(len(prompts)):
             if caches[i] is None:
                 caches[i] = cache.make_prompt_cache(self.model)
+                if self.draft_model is not None:
+                    caches[i] += cache.make_prompt_cache(self.draft_model)
+            elif self.draft_model is not None and not _can_rewind(caches[i]):
+                raise ValueError(
+                    "Speculative decoding is only supported with full "
+                    "attention KV caches."
+                )
 
-        for p, m, c in zip(prompts, max_tokens, caches):
-            self.unprocessed_prompts.append((self.uid_count, p, m, c))
-            uids.append(self.uid_count)
-            self.uid_count += 1
+        for p, m, c, s, l, n in zip(
+            prompts, max_tokens, caches, sampling, logits_params, num_samples
+        ):
+            self.unprocessed_prompts.append((self.uid_count, p, m, c, s, l))
+            sample_uids = list(range(self.uid_count, self.uid_count + n))
+            if n > 1:
+                self._samples[self.uid_count] = sample_uids[1:]
+            uids.extend(sample_uids)
+            self.uid_count += n
         # Sort in ascending order of length
         self.unprocessed_prompts = sorted(
             self.unprocessed_prompts, key=lambda x: len(x[1]) + cache.cache_length(x[3])
@@ -998,43 +1595,92 @@ class BatchGenerator:
             else:
                 self.active_batch = None
 
+        for uid in list(self._samples):
+            self._samples[uid] = [s for s in self._samples[uid] if s not in uids]
+
         for i in reversed(range(len(self.unprocessed_prompts))):
-            if self.unprocessed_prompts[i][0] in uids:
-                self.unprocessed_prompts.pop(i)
+            uid, *prompt = self.unprocessed_prompts[i]
+            if uid in uids:
+                # Process the prompt for its remaining samples if any
+                samples = self._samples.pop(uid, [])
+                if samples:
+                    self.unprocessed_prompts[i] = (samples[0], *prompt)
+                    self._samples[samples[0]] = samples[1:]
+                else:
+                    self.unprocessed_prompts.pop(i)
+
+        if self.prefill_batch is not None:
+            self._remove_from_prefill(uids)
+
+    def _remove_from_prefill(self, uids):
+        prefill = self.prefill_batch
+        prefill.removed.update(uids)
+
+        # Prompts with samples left are still needed for the samples
+        keep_idx = [
+            e
+            for e, uid in enumerate(prefill.uids)
+            if uid not in prefill.removed or self._samples.get(uid)
+        ]
+        if len(keep_idx) == len(prefill):
+            return
+        for uid in prefill.uids:
+            if uid in prefill.removed and not self._samples.get(uid):
+                self._samples.pop(uid, None)
+        if len(keep_idx) == 0:
+            self.prefill_batch = None
+            return
 
-    def _process_prompts(self, prompts):
-        uids, inputs, max_tokens, caches = zip(*prompts)
+        # Stop processing the removed prompts right away if the caches are
+        # left padded and already hold the padding that filtering trims.
+        # Otherwise they are dropped once the prefill is done.
+        max_length = prefill.processed_tokens + prefill.inputs.shape[1]
+        min_padding = min(max_length - prefill.lengths[k] for k in keep_idx)
+        if (
+            prefill.last_inputs is None
+            and 0 < prefill.processed_tokens
+            and min_padding <= prefill.processed_tokens
+        ):
+            prefill.filter(keep_idx)
+
+    def _start_prefill(self, prompts):
+        uids, inputs, max_tokens, caches, sampling, logits_params = zip(*prompts)
 
-        cache_lengths = [cache.cache_length(c) for c in caches]
-        max_cache_length = max(cache_lengths)
         lengths = [len(p) for p in inputs]
         max_length = max(lengths)
         padding = [max_length - l for l in lengths]
 
         self._stats.prompt_tokens += sum(lengths)
 
-        processed_tokens = 0
+        # The token history for the repetition penalty starts at the last
+        # prompt token as in generate_step
+        width = max(
+            (
+                p.get("repetition_context_size", 20)
+                for p in logits_params
+                if p and p.get("repetition_penalty")
+            ),
+            default=0,
+        )
+        tokens = None
+        if width > 0:
+            tokens = mx.array(
+                [[-1] * (width - len(p[-1:])) + list(p[-1:]) for p in inputs],
+                mx.int32,
+            )
 
         # New prompts so
         #   1. Left-pad the inputs
         #   2. Process
-        if max_cache_length == 0:
+        boundaries = []
+        if not any(_has_state(layer) for c in caches for layer in c):
             inputs = _left_pad_prompts(inputs, max_length=max_length)
-            prompt_cache = _make_cache(self.model, padding)
-
-            while inputs.shape[1] > 1:
-                n_to_process = min(self.prefill_step_size, inputs.shape[1] - 1)
-                self.model(inputs[:, :n_to_process], cache=prompt_cache)
-                mx.eval([c.state for c in prompt_cache])
-                inputs = inputs[:, n_to_process:]
-                processed_tokens += n_to_process
-                self.prompt_progress_callback(
-                    [
-                        (uid, processed_tokens, length)
-                        for uid, length in zip(uids, lengths)
-                    ]
+            prompt_cache = _make_cache(self.model, padding, *self._cache_options)
+            if self.draft_model is not None:
+                prompt_cache += _make_cache(
+                    self.draft_model, padding, *self._cache_options
                 )
-                mx.clear_cache()
+            last_inputs = None
 
         # Further prompt processing so we need to
         #   1. Merge the KV caches and prepare for right padded prompts
@@ -1044,44 +1690,329 @@ class BatchGenerator:
         else:
             last_inputs = mx.array([p[-1:] for p in inputs])
             inputs = _right_pad_prompts(inputs, max_length=max_length)
-            prompt_cache = _merge_caches(caches)
+            prompt_cache = _merge_caches(caches, *self._cache_options)
 
             for c in prompt_cache:
                 c.prepare(lengths=lengths, right_padding=padding)
 
-            while inputs.shape[1] > 1:
-                n_to_process = min(self.prefill_step_size, inputs.shape[1] - 1)
-                self.model(inputs[:, :n_to_process], cache=prompt_cache)
-                mx.eval([c.state for c in prompt_cache])
-                inputs = inputs[:, n_to_process:]
-                processed_tokens += n_to_process
-                self.prompt_progress_callback(
-                    [
-                        (uid, processed_tokens, length)
-                        for uid, length in zip(uids, lengths)
-                    ]
-                )
-                mx.clear_cache()
+            # Recurrent states can't be rolled after the fact so stop the
+            # prefill at the end of every prompt to save them
+            if any(_has_arrays_cache(c) for c in prompt_cache):
+                boundaries = sorted(set(l - 1 for l in lengths if l > 1))
+
+        return PrefillBatch(
+            list(uids),
+            inputs,
+            last_inputs,
+            lengths,
+            list(max_tokens),
+            prompt_cache,
+            list(sampling),
+            list(logits_params),
+            tokens,
+            boundaries=boundaries,
+        )
 
+    def _prefill(self, prefill, num_tokens):
+        """Process up to ``num_tokens`` tokens of each prompt."""
+        n_to_process = min(
+            num_tokens,
+            prefill.inputs.shape[1] - 1,
+            *(b - prefill.processed_tokens for b in prefill.boundaries),
+        )
+        model_cache, draft_cache = self._split_cache(prefill.cache)
+        self.model(prefill.inputs[:, :n_to_process], cache=model_cache)
+        if self.draft_model is not None:
+            self.draft_model(prefill.inputs[:, :n_to_process], cache=draft_cache)
+        for c in prefill.cache:
+            if hasattr(c, "advance"):
+                c.advance(n_to_process)
+        prefill.boundaries = [
+            b for b in prefill.boundaries if b > prefill.processed_tokens + n_to_process
+        ]
+        mx.eval([c.state for c in prefill.cache])
+        prefill.inputs = prefill.inputs[:, n_to_process:]
+        prefill.processed_tokens += n_to_process
+        self.prompt_progress_callback(
+            [
+                (uid, prefill.processed_tokens, length)
+                for uid, length in zip(prefill.uids, prefill.lengths)
+            ]
+        )
+        mx.clear_cache()
+
+    def _finish_prefill(self, prefill):
+        inputs, prompt_cache = prefill.inputs, prefill.cache
+        if prefill.last_inputs is not None:
             for c in prompt_cache:
                 c.finalize()
             mx.eval([c.state for c in prompt_cache])
             mx.clear_cache()
-            inputs = last_inputs
-
-        y, logprobs = self._step(inputs, prompt_cache)
+            inputs = prefill.last_inputs
+
+        # Copy the prompts with several samples
+        if any(uid in self._samples for uid in prefill.uids):
+            idx = []
+            uids = []
+            for e, uid in enumerate(prefill.uids):
+                samples = [uid] + self._samples.pop(uid, [])
+                idx.extend([e] * len(samples))
+                uids.extend(samples)
+            prefill.uids = uids
+            prefill.max_tokens = [prefill.max_tokens[e] for e in idx]
+            prefill.sampling = [prefill.sampling[e] for e in idx]
+            prefill.logits_params = [prefill.logits_params[e] for e in idx]
+            idx = mx.array(idx, mx.int32)
+            inputs = inputs[idx]
+            if prefill.tokens is not None:
+                prefill.tokens = prefill.tokens[idx]
+            for c in prompt_cache:
+                c.filter(idx)
+
+        sampler = self._make_sampler(prefill.sampling)
+        logits_processors = self._make_logits_processors(prefill.logits_params)
+        y, logprobs = self._step(
+            inputs,
+            self._split_cache(prompt_cache)[0],
+            sampler,
+            logits_processors,
+            prefill.tokens,
+        )
         mx.async_eval(y, logprobs)
-        return Batch(
-            list(uids), y, logprobs, list(max_tokens), [0] * len(uids), prompt_cache
+        batch = Batch(
+            prefill.uids,
+            y,
+            logprobs,
+            prefill.max_tokens,
+            [0] * len(prefill),
+            prompt_cache,
+            sampling=prefill.sampling,
+            sampler=sampler,
+            logits_params=prefill.logits_params,
+            logits_processors=logits_processors,
+            tokens=prefill.tokens,
         )
+        if self.draft_model is not None:
+            # The draft model has yet to process the last prompt token
+            batch.prev_y = inputs[:, -1]
+        if prefill.removed:
+            keep_idx = [
+                e for e, uid in enumerate(batch.uids) if uid not in prefill.removed
+            ]
+            if len(keep_idx) == 0:
+                return None
+            batch.filter(keep_idx)
+        return batch
 
-    def _step(self, input_tokens: mx.array, prompt_cache: List[Any]):
-        logits = self.model(input_tokens, cache=prompt_cache)
+    def _process_prompts(self, prompts):
+        prefill = self._start_prefill(prompts)
+        while not prefill.done:
+            self._prefill(prefill, self.prefill_step_size)
+        return self._finish_prefill(prefill)
+
+    def _take_prompts(self, num_to_add, num_active):
+        """
+        Take up to ``prefill_batch_size`` unprocessed prompts whose sequences,
+        counting all the samples of each prompt, fit in ``num_to_add`` rows.
+        A prompt with more samples than that is taken alone once the batch
+        is empty.
+        """
+        num_prompts = 0
+        num_rows = 0
+        for uid, *_ in self.unprocessed_prompts[: self.prefill_batch_size]:
+            num_rows += 1 + len(self._samples.get(uid, []))
+            if num_rows > num_to_add and (num_prompts > 0 or num_active > 0):
+                break
+            num_prompts += 1
+        prompts = self.unprocessed_prompts[:num_prompts]
+        self.unprocessed_prompts = self.unprocessed_prompts[num_prompts:]
+        return prompts
+
+    def _interleave_prefill(self, num_active):
+        """
+        Process at most ``prefill_token_budget`` prompt tokens so that the
+        active batch can take its next decoding step. Returns ``True`` if any
+        prompt was processed.
+        """
+        if self.prefill_batch is None:
+            num_to_add = self.completion_batch_size - num_active
+            if num_to_add < self.prefill_batch_size:
+                return False
+            prompts = self._take_prompts(num_to_add, num_active)
+            if not prompts:
+                return False
+            self.prefill_batch = self._start_prefill(prompts)
+
+        prefill = self.prefill_batch
+        if num_active == 0:
+            # Nothing is waiting on the prompts so process them at once
+            while not prefill.done:
+                self._prefill(prefill, self.prefill_step_size)
+        elif not prefill.done:
+            num_tokens = max(self.prefill_token_budget // len(prefill), 1)
+            self._prefill(prefill, min(num_tokens, self.prefill_step_size))
+
+        if prefill.done:
+            self.prefill_batch = None
+            batch = self._finish_prefill(prefill)
+            if batch is not None and self.active_batch is None:
+                self.active_batch = batch
+            elif batch is not None:
+                self.active_batch.extend(batch)
+        return True
+
+    def _split_cache(self, prompt_cache):
+        """
+        Split the cache into the model and the draft model caches.
+        """
+        if self.draft_model is None:
+            return prompt_cache, []
+        n = len(self.model.layers)
+        return prompt_cache[:n], prompt_cache[n:]
+
+    def _make_sampler(self, sampling):
+        """
+        Make a sampler for a batch with the given sampling parameters for
+        each sequence.
+        """
+        if not any(sampling):
+            return self.sampler
+
+        params = [s or {} for s in sampling]
+        sampler = make_batch_sampler(
+            [p.get("temp", 0.0) for p in params],
+            [p.get("top_p", 0.0) for p in params],
+            [p.get("min_p", 0.0) for p in params],
+            [p.get("top_k", 0) for p in params],
+        )
+        if all(sampling):
+            return sampler
+
+        # Sequences without parameters use the default sampler
+        use_default = mx.array([s is None for s in sampling])
+
+        def mixed_sampler(logprobs):
+            return mx.where(use_default, self.sampler(logprobs), sampler(logprobs))
+
+        return mixed_sampler
+
+    def _batch_sampler(self, batch):
+        if batch.sampler is None:
+            batch.sampler = self._make_sampler(batch.sampling)
+        return batch.sampler
+
+    def _make_logits_processors(self, logits_params):
+        """
+        Make the logits processors for a batch with the given parameters for
+        each sequence.
+        """
+        if not any(logits_params):
+            return []
+        params = [p or {} for p in logits_params]
+        return make_batch_logits_processors(
+            [p.get("logit_bias") for p in params],
+            [p.get("repetition_penalty") for p in params],
+            [p.get("repetition_context_size", 20) for p in params],
+        )
+
+    def _batch_logits_processors(self, batch):
+        if batch.logits_processors is None:
+            batch.logits_processors = self._make_logits_processors(batch.logits_params)
+        return batch.logits_processors
+
+    def _step(
+        self,
+        input_tokens: mx.array,
+        prompt_cache: List[Any],
+        sampler,
+        logits_processors=None,
+        tokens=None,
+    ):
+        if self._compiled_step is not None and self._compiled_step.supports(
+            prompt_cache
+        ):
+            logits = self._compiled_step(input_tokens, prompt_cache)
+        else:
+            logits = self.model(input_tokens, cache=prompt_cache)
         logits = logits[:, -1, :]
+        for processor in logits_processors or []:
+            logits = processor(tokens, logits)
         logprobs = logits - mx.logsumexp(logits, axis=-1, keepdims=True)
-        sampled = self.sampler(logprobs)
+        sampled = sampler(logprobs)
         return sampled, list(logprobs)
 
+    def _speculative_step(self, batch):
+        """
+        Draft ``num_draft_tokens`` tokens for every sequence with the draft
+        model and verify them with the model in a single forward pass.
+
+        Returns the tokens and log probabilities to emit for each sequence.
+        Each sequence emits its pending token followed by the draft tokens
+        which were accepted, so the number of tokens varies per sequence.
+        The caches are not rewound here since the amount depends on which
+        sequences finish, see :meth:`_rewind`.
+        """
+        model_cache, draft_cache = self._split_cache(batch.cache)
+        sampler = self._batch_sampler(batch)
+        num_draft = self.num_draft_tokens
+        y = batch.y[:, None]
+
+        # The draft model is one token behind so it also processes the
+        # previous token
+        draft_y = mx.concatenate([batch.prev_y[:, None], y], axis=1)
+        draft_tokens = []
+        for _ in range(num_draft):
+            logits = self.draft_model(draft_y, cache=draft_cache)[:, -1, :]
+            logprobs = logits - mx.logsumexp(logits, axis=-1, keepdims=True)
+            draft_y = sampler(logprobs)[:, None]
+            mx.async_eval(draft_y)
+            draft_tokens.append(draft_y)
+        draft_tokens = mx.concatenate(draft_tokens, axis=1)
+
+        logits = self.model(
+            mx.concatenate([y, draft_tokens], axis=1), cache=model_cache
+        )
+        logprobs = logits - mx.logsumexp(logits, axis=-1, keepdims=True)
+        B, L, _ = logprobs.shape
+        tokens = mx.stack([sampler(logprobs[:, i]) for i in range(L)], axis=1)
+        mx.eval(tokens, draft_tokens)
+
+        y = batch.y.tolist()
+        tokens = tokens.tolist()
+        draft_tokens = draft_tokens.tolist()
+        out_tokens, out_logprobs = [], []
+        for e in range(B):
+            n = 0
+            while n < num_draft and tokens[e][n] == draft_tokens[e][n]:
+                n += 1
+            out_tokens.append([y[e]] + draft_tokens[e][:n])
+            out_logprobs.append([batch.logprobs[e]] + list(logprobs[e, :n]))
+            batch.logprobs[e] = logprobs[e, n]
+            tokens[e] = tokens[e][n]
+        batch.y = mx.array(tokens, mx.uint32)
+        batch.prev_y = mx.array([t[-1] for t in out_tokens], mx.uint32)
+        return out_tokens, out_logprobs
+
+    def _rewind(self, batch, num_emitted, finished):
+        """
+        Rewind the caches after a speculative step to drop the rejected
+        draft tokens.
+
+        The model cache keeps the tokens emitted by each sequence while the
+        draft cache stays one token behind. Finished sequences keep the same
+        number of tokens in both caches when possible.
+        """
+        model_cache, draft_cache = self._split_cache(batch.cache)
+        num_draft = self.num_draft_tokens
+        model_trim = [num_draft + 1 - n for n in num_emitted]
+        draft_trim = list(model_trim)
+        for e in finished:
+            draft_trim[e] = max(model_trim[e] - 1, 0)
+        for c in model_cache:
+            c.rewind(model_trim)
+        for c in draft_cache:
+            c.rewind(draft_trim)
+
     def stats(self):
         self._stats.prompt_tps = self._stats.prompt_tokens / self._stats.prompt_time
         self._stats.generation_tps = (
@@ -1097,8 +2028,19 @@ class BatchGenerator:
         batch = self.active_batch
         num_active = len(batch) if batch else 0
         num_to_add = self.completion_batch_size - num_active
+        if self.prefill_token_budget is not None:
+            # Chunks of prompts alternate with decoding steps
+            if self._interleave_prefill(num_active):
+                while self.active_batch is None and self._interleave_prefill(0):
+                    pass
+                self._stats.prompt_time += time.perf_counter() - tic
+                tic = time.perf_counter()
+            if self.active_batch is None:
+                return []
+            num_to_add = 0
+
         while num_to_add >= self.prefill_batch_size:
-            prompts = self.unprocessed_prompts[: self.prefill_batch_size]
+            prompts = self._take_prompts(num_to_add, num_active)
             # Finish processing the last examples of the last batch
             if len(prompts) == 0 and num_active > 0:
                 break
@@ -1114,9 +2056,6 @@ class BatchGenerator:
                 tic = time.perf_counter()
 
             batch = self._process_prompts(prompts)
-            self.unprocessed_prompts = self.unprocessed_prompts[
-                self.prefill_batch_size :
-            ]
             prompt_processing = True
             # If there was no active batch, set it
             if self.active_batch is None:
@@ -1128,11 +2067,25 @@ class BatchGenerator:
             num_to_add -= len(batch)
 
         batch = self.active_batch
-        y, logprobs = batch.y, batch.logprobs
-        batch.y, batch.logprobs = self._step(y[:, None], batch.cache)
-        mx.async_eval(batch.y, batch.logprobs)
+        if self.draft_model is not None:
+            y, logprobs = self._speculative_step(batch)
+        else:
+            y, logprobs = batch.y, batch.logprobs
+            if batch.tokens is not None:
+                batch.tokens = mx.concatenate(
+                    [batch.tokens[:, 1:], y[:, None].astype(mx.int32)], axis=1
+                )
+            batch.y, batch.logprobs = self._step(
+                y[:, None],
+                batch.cache,
+                self._batch_sampler(batch),
+                self._batch_logits_processors(batch),
+                batch.tokens,
+            )
+            mx.async_eval(batch.y, batch.logprobs)
+            y = [[t] for t in y.tolist()]
+            logprobs = [[lp] for lp in logprobs]
 
-        y = y.tolist()
         toc = time.perf_counter()
         if prompt_processing:
             self._stats.prompt_time += toc - tic
@@ -1141,25 +2094,37 @@ class BatchGenerator:
         keep_idx = []
         end_idx = []
         responses = []
+        finished = []
+        num_emitted = []
 
-        for e, (t, uid, num_tok, max_tok) in enumerate(
+        for e, (tokens, uid, num_tok, max_tok) in enumerate(
             zip(y, batch.uids, batch.num_tokens, batch.max_tokens)
         ):
-            cache = None
-            num_tok += 1
+            emitted = 0
+            for t, lp in zip(tokens, logprobs[e]):
+                emitted += 1
+                num_tok += 1
+                if t in self.stop_tokens:
+                    finish_reason = "stop"
+                elif num_tok >= max_tok:
+                    finish_reason = "length"
+                else:
+                    finish_reason = None
+                responses.append(self.Response(uid, t, lp, finish_reason, None))
+                if finish_reason is not None:
+                    break
             batch.num_tokens[e] = num_tok
-            if t in self.stop_tokens:
-                finish_reason = "stop"
-                end_idx.append(e)
-            elif num_tok >= max_tok:
-                finish_reason = "length"
+            num_emitted.append(emitted)
+            if finish_reason is not None:
                 end_idx.append(e)
+                finished.append(len(responses) - 1)
             else:
-                finish_reason = None
                 keep_idx.append(e)
-            if finish_reason is not None:
-                cache = batch.extract_cache(e)
-            responses.append(self.Response(uid, t, logprobs[e], finish_reason, cache))
+
+        if self.draft_model is not None:
+            self._rewind(batch, num_emitted, end_idx)
+        for e, r in zip(end_idx, finished):
+            responses[r].prompt_cache = batch.extract_cache(e)
 
         # Remove any finished completions
         if len(end_idx):
@@ -1248,6 +2213,129 @@ def batch_generate(
     return BatchResponse(texts, stats, caches)
 
 
+@dataclass
+class BeamSearchResponse:
+    """
+    The output of :func:`beam_search`.
+
+    Args:
+        texts (List[str]): The generated text of each beam, best first.
+        tokens (List[List[int]]): The generated tokens of each beam.
+        scores (List[float]): The score of each beam, its log probability
+          divided by ``length ** length_penalty``.
+    """
+
+    texts: List[str]
+    tokens: List[List[int]]
+    scores: List[float]
+
+
+def beam_search(
+    model: nn.Module,
+    tokenizer: Union[PreTrainedTokenizer, TokenizerWrapper],
+    prompt: List[int],
+    num_beams: int = 4,
+    max_tokens: int = 128,
+    length_penalty: float = 1.0,
+    prefill_step_size: int = 2048,
+) -> BeamSearchResponse:
+    """
+    Generate the ``num_beams`` most likely continuations of the prompt with
+    beam search.
+
+    The prompt is processed once and its batch cache is copied into one row
+    per beam. After every step the rows are reordered to follow the best
+    beams.
+
+    Args:
+        model (nn.Module): The language model.
+        tokenizer (PreTrainedTokenizer): The tokenizer.
+        prompt (List[int]): The input prompt.
+        num_beams (int): The number of beams. Default: ``4``.
+        max_tokens (int): The maximum number of tokens per beam.
+          Default: ``128``.
+        length_penalty (float): The exponent of the length the beam scores
+          are divided by. Larger values favor longer sequences. Default: ``1.0``.
+        prefill_step_size (int): Step size for processing the prompt.
+
+    Returns:
+        BeamSearchResponse: The beams and their scores, best first.
+    """
+    if not isinstance(tokenizer, TokenizerWrapper):
+        tokenizer = TokenizerWrapper(tokenizer)
+    if num_beams < 1:
+        raise ValueError(f"num_beams must be positive but got {num_beams}.")
+
+    def normalize(score, length):
+        return score / (length**length_penalty)
+
+    prompt_cache = _make_cache(model, [0])
+    y = mx.array([prompt], mx.uint32)
+    with mx.stream(generation_stream):
+        while y.shape[1] > 1:
+            n_to_process = min(prefill_step_size, y.shape[1] - 1)
+            model(y[:, :n_to_process], cache=prompt_cache)
+            mx.eval([c.state for c in prompt_cache])
+            y = y[:, n_to_process:]
+            mx.clear_cache()
+
+    beams = [[]]
+    scores = mx.zeros((1,))
+    finished = []
+    for length in range(1, max_tokens + 1):
+        with mx.stream(generation_stream):
+            logits = model(y, cache=prompt_cache)[:, -1, :].astype(mx.float32)
+            logprobs = logits - mx.logsumexp(logits, axis=-1, keepdims=True)
+            candidates = (scores[:, None] + logprobs).flatten()
+            # Twice the beams so enough of them don't end the sequence
+            k = min(2 * num_beams, candidates.size)
+            top = mx.argpartition(-candidates, kth=k - 1)[:k]
+            top = top[mx.argsort(-candidates[top])]
+            top_scores = candidates[top]
+        vocab_size = logprobs.shape[-1]
+        top, top_scores = top.tolist(), top_scores.tolist()
+
+        rows, tokens, next_scores = [], [], []
+        for rank, (i, score) in enumerate(zip(top, top_scores)):
+            row, token = divmod(i, vocab_size)
+            if token in tokenizer.eos_token_ids:
+                if rank < num_beams:
+                    finished.append((normalize(score, length), beams[row]))
+                continue
+            rows.append(row)
+            tokens.append(token)
+            next_scores.append(score)
+            if len(rows) == num_beams:
+                break
+
+        # Stop once the running beams can't beat the finished ones
+        finished = sorted(finished, key=lambda x: -x[0])[:num_beams]
+        if not rows or (
+            len(finished) == num_beams
+            and normalize(next_scores[0], length) <= finished[-1][0]
+        ):
+            beams = []
+            break
+
+        if rows != list(range(len(beams))):
+            rows_idx = mx.array(rows, mx.int32)
+            for c in prompt_cache:
+                c.filter(rows_idx)
+        beams = [beams[r] + [t] for r, t in zip(rows, tokens)]
+        scores = mx.array(next_scores)
+        y = mx.array(tokens, mx.uint32)[:, None]
+
+    finished.extend(
+        (normalize(score, len(b)), b) for score, b in zip(scores.tolist(), beams)
+    )
+    finished = sorted(finished, key=lambda x: -x[0])[:num_beams]
+    return BeamSearchResponse(
+        [tokenizer.decode(b) for _, b in finished],
+        [b for _, b in finished],
+        [s for s, _ in finished],
+    )
+
+
 def main():
     parser = setup_arg_parser()
     args = parser.parse_args()
@@ -1343,6 +2431,8 @@ def main():
     else:
         prompt = tokenizer.encode(prompt)
 
+    if args.draft_model is not None and args.prompt_lookup:
+        raise ValueError("Use either --draft-model or --prompt-lookup, not both.")
     if args.draft_model is not None:
         draft_model, draft_tokenizer = load(args.draft_model)
         if draft_tokenizer.vocab_size != tokenizer.vocab_size:
@@ -1373,6 +2463,9 @@ def main():
         quantized_kv_start=args.quantized_kv_start,
         draft_model=draft_model,
         num_draft_tokens=args.num_draft_tokens,
+        max_draft_tokens=args.max_draft_tokens,
+        prompt_lookup=args.prompt_lookup,
+        ngram_size=args.ngram_size,
     )
     if not args.verbose:
         print(response)
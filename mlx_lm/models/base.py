@@ -80,6 +80,9 @@ def quantized_scaled_dot_product_attention(
         queries = mx.reshape(queries, (B, n_kv_heads, n_repeats, L, D))
         q_keys = tree_map(lambda x: mx.expand_dims(x, axis=-3), q_keys)
         q_values = tree_map(lambda x: mx.expand_dims(x, axis=-3), q_values)
+        if isinstance(mask, mx.array) and mask.ndim == 4:
+            # Batched masks have a head axis of size 1
+            mask = mx.expand_dims(mask, axis=-3)
 
     scores = mx.quantized_matmul(
         queries, *q_keys, transpose=True, group_size=group_size, bits=bits
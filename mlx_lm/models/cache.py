@@ -551,6 +551,9 @@ class ArraysCache(_BaseCache):
     def __init__(self, size, left_padding: Optional[List[int]] = None):
         self.cache = [None] * size
         self.left_padding = mx.array(left_padding) if left_padding else None
+        self._lengths = None
+        self._processed = 0
+        self._snapshots = {}
 
     def __setitem__(self, idx, value):
         self.cache[idx] = value
@@ -586,6 +589,99 @@ class ArraysCache(_BaseCache):
         else:
             return None
 
+    def prepare(self, *, left_padding=None, lengths=None, right_padding=None):
+        """
+        Prepare the cache for a batched prompt.
+
+        Recurrent states can't be rolled like keys and values so for right
+        padded prompts the state of each sequence is saved when it reaches
+        the end of its prompt (see :meth:`advance`) and restored in
+        :meth:`finalize`. The last token of every prompt is processed after
+        finalizing, hence a sequence ends after ``length - 1`` tokens.
+        """
+        if left_padding is not None:
+            if self.cache[0] is not None:
+                raise ValueError(
+                    "Left padding can only be added to an empty ArraysCache"
+                )
+            left_padding = mx.array(left_padding)
+            if self.left_padding is not None:
+                left_padding = left_padding + self.left_padding
+            self.left_padding = left_padding
+
+        if right_padding is not None and max(right_padding) > 0:
+            self._lengths = [l - 1 for l in lengths]
+            self._processed = 0
+            self._snapshots = {}
+            self.advance(0)
+
+    def advance(self, n: int):
+        """
+        Record that ``n`` more tokens of a right padded prompt were processed.
+
+        The caller is expected to stop at every sequence end so that the
+        state of each sequence can be saved exactly.
+        """
+        if self._lengths is None:
+            return
+        self._processed += n
+        for i, l in enumerate(self._lengths):
+            if l == self._processed and i not in self._snapshots:
+                self._snapshots[i] = [
+                    None if c is None else c[i : i + 1] for c in self.cache
+                ]
+
+    def finalize(self):
+        if self._lengths is None:
+            return
+        for j, c in enumerate(self.cache):
+            if c is None:
+                continue
+            rows = []
+            for i in range(c.shape[0]):
+                s = self._snapshots.get(i)
+                if s is None:
+                    rows.append(c[i : i + 1])
+                elif s[j] is None:
+                    rows.append(mx.zeros_like(c[i : i + 1]))
+                else:
+                    rows.append(s[j])
+            self.cache[j] = mx.concatenate(rows)
+        self._lengths = None
+        self._processed = 0
+        self._snapshots = {}
+
+    def extract(self, idx):
+        cache = type(self).__new__(type(self))
+        cache.cache = [
+            None if c is None else mx.contiguous(c[idx : idx + 1]) for c in self.cache
+        ]
+        cache.left_padding = None
+        cache._lengths = None
+        cache._processed = 0
+        cache._snapshots = {}
+        return cache
+
+    @classmethod
+    def merge(cls, caches):
+        """
+        Merge the caches of several sequences into one batched cache. Missing
+        states are replaced by zeros which is what the models start from.
+        """
+        cache = caches[0].extract(0)
+        for j in range(len(cache.cache)):
+            ref = next((c.cache[j] for c in caches if c.cache[j] is not None), None)
+            if ref is None:
+                cache.cache[j] = None
+                continue
+            cache.cache[j] = mx.concatenate(
+                [
+                    mx.zeros_like(ref[:1]) if c.cache[j] is None else c.cache[j]
+                    for c in caches
+                ]
+            )
+        return cache
+
 
 class MambaCache(ArraysCache):
     def __init__(self, left_padding: Optional[List[int]] = None):
@@ -659,6 +755,10 @@ class CacheList(_BaseCache):
             m = c.trim(n)
         return m
 
+    def rewind(self, n):
+        for c in self.caches:
+            c.rewind(n)
+
     @property
     def state(self):
         return [s for c in self.caches for s in c.state]
@@ -686,6 +786,22 @@ class CacheList(_BaseCache):
         for c, o in zip(self.caches, other.caches):
             c.extend(o)
 
+    def prepare(self, **kwargs):
+        for c in self.caches:
+            c.prepare(**kwargs)
+
+    def advance(self, n: int):
+        for c in self.caches:
+            if hasattr(c, "advance"):
+                c.advance(n)
+
+    def finalize(self):
+        for c in self.caches:
+            c.finalize()
+
+    def extract(self, idx):
+        return CacheList(*(c.extract(idx) for c in self.caches))
+
 
 def dynamic_roll(x, shifts, axis):
     n = x.shape[axis]
@@ -798,6 +914,23 @@ class BatchKVCache(_BaseCache):
         self.offset -= n
         return n
 
+    def rewind(self, n):
+        """
+        Trim ``n[i]`` tokens from the end of the ``i``-th sequence.
+
+        The sequences which trim more than the minimum are rolled right so
+        that every sequence still ends at the same index. The trimmed entries
+        wrap around to the front and become left padding.
+        """
+        n = mx.array(n)
+        shift = n - n.min()
+        if shift.max().item() > 0:
+            self.keys = dynamic_roll(self.keys, shift[:, None], axis=2)
+            self.values = dynamic_roll(self.values, shift[:, None], axis=2)
+            self.left_padding += shift
+        self._idx -= n.min().item()
+        self.offset -= n
+
     def make_mask(self, N: int, return_array: bool = False, **kwargs):
         return create_causal_mask(
             N, offset=self._idx, left_padding=self.left_padding, **kwargs
@@ -871,6 +1004,8 @@ class BatchKVCache(_BaseCache):
         keys = mx.zeros((B, H, max_length, Dk), dtype=dt)
         values = mx.zeros((B, H, max_length, Dv), dtype=dt)
         for i, (p, c) in enumerate(zip(padding, caches)):
+            if c.offset == 0:
+                continue
             keys[i : i + 1, :, p : p + c.offset] = c.keys[..., : c.offset, :]
             values[i : i + 1, :, p : p + c.offset] = c.values[..., : c.offset, :]
 
@@ -883,6 +1018,673 @@ class BatchKVCache(_BaseCache):
         return cache
 
 
+class BatchQuantizedKVCache(_BaseCache):
+    step = 256
+
+    def __init__(self, left_padding: List[int], group_size: int = 64, bits: int = 8):
+        """
+        A :obj:`BatchKVCache` which stores the keys and values quantized like
+        :obj:`QuantizedKVCache`. The inputs are left-padded in the same way.
+        """
+        self.keys = None
+        self.values = None
+        self.left_padding = mx.array(left_padding)
+        self.offset = mx.array([-l for l in left_padding])
+        self._idx = 0
+        self.group_size = group_size
+        self.bits = bits
+
+        self._right_padding = None
+
+    def _roll(self, shifts):
+        self.keys, self.values = tree_map(
+            lambda x: dynamic_roll(x, shifts[:, None], axis=2),
+            (self.keys, self.values),
+        )
+
+    def update_and_fetch(self, keys, values):
+        B, n_kv_heads, num_steps, k_head_dim = keys.shape
+        v_head_dim = values.shape[-1]
+        prev = self._idx
+
+        if self.keys is None or (prev + num_steps) > self.keys[0].shape[-2]:
+            el_per_int = 8 * mx.uint32.size // self.bits
+            new_steps = (self.step + num_steps - 1) // self.step * self.step
+            shape = (B, n_kv_heads, new_steps)
+
+            def init_quant(dim):
+                return (
+                    mx.zeros((*shape, dim // el_per_int), dtype=mx.uint32),
+                    mx.zeros((*shape, dim // self.group_size), dtype=keys.dtype),
+                    mx.zeros((*shape, dim // self.group_size), dtype=keys.dtype),
+                )
+
+            def expand_quant(x):
+                new_x = mx.zeros((*shape, x.shape[-1]), dtype=x.dtype)
+                return mx.concatenate([x, new_x], axis=-2)
+
+            if self.keys is not None:
+                if prev % self.step != 0:
+                    self.keys, self.values = tree_map(
+                        lambda x: x[..., :prev, :], (self.keys, self.values)
+                    )
+
+                self.keys, self.values = tree_map(
+                    expand_quant, (self.keys, self.values)
+                )
+            else:
+                self.keys, self.values = init_quant(k_head_dim), init_quant(v_head_dim)
+
+        self.offset += num_steps
+        self._idx += num_steps
+
+        keys = mx.quantize(keys, group_size=self.group_size, bits=self.bits)
+        values = mx.quantize(values, group_size=self.group_size, bits=self.bits)
+        for i in range(len(self.keys)):
+            self.keys[i][..., prev : self._idx, :] = keys[i]
+            self.values[i][..., prev : self._idx, :] = values[i]
+
+        return tree_map(lambda x: x[..., : self._idx, :], (self.keys, self.values))
+
+    def __len__(self):
+        return self._idx
+
+    def prepare(self, *, left_padding=None, lengths=None, right_padding=None):
+        if left_padding is not None:
+            if self.keys is not None:
+                raise ValueError(
+                    "Left padding can only be added to an empty BatchQuantizedKVCache"
+                )
+            left_padding = mx.array(left_padding)
+            self.left_padding += left_padding
+            self.offset -= left_padding
+
+        if right_padding is not None and max(right_padding) > 0:
+            self._right_padding = mx.array(right_padding)
+
+    def finalize(self):
+        if self._right_padding is not None:
+            padding = self._right_padding
+            self._roll(padding)
+            self.offset -= padding
+            self.left_padding += padding
+            self._right_padding = None
+
+    @property
+    def state(self):
+        k, v = self.keys, self.values
+        if self._idx < k[0].shape[2]:
+            k, v = tree_map(lambda x: x[..., : self._idx, :], (k, v))
+        return k, v, self.offset, self.left_padding
+
+    @state.setter
+    def state(self, v):
+        self.keys, self.values, self.offset, self.left_padding = v
+        self._idx = self.keys[0].shape[2]
+
+    @property
+    def meta_state(self):
+        return tuple(map(str, (self.group_size, self.bits)))
+
+    @meta_state.setter
+    def meta_state(self, v):
+        self.group_size, self.bits = map(int, v)
+
+    def is_trimmable(self):
+        return True
+
+    def trim(self, n):
+        n = min(self._idx, n)
+        self._idx -= n
+        self.offset -= n
+        return n
+
+    def rewind(self, n):
+        """
+        Trim ``n[i]`` tokens from the end of the ``i``-th sequence, see
+        :meth:`BatchKVCache.rewind`.
+        """
+        n = mx.array(n)
+        shift = n - n.min()
+        if shift.max().item() > 0:
+            self._roll(shift)
+            self.left_padding += shift
+        self._idx -= n.min().item()
+        self.offset -= n
+
+    def make_mask(self, N: int, return_array: bool = False, **kwargs):
+        return create_causal_mask(
+            N, offset=self._idx, left_padding=self.left_padding, **kwargs
+        )
+
+    def filter(self, batch_indices):
+        """
+        In-place filter to keep just the given indices in the cache.
+        """
+        self.keys, self.values = tree_map(
+            lambda x: x[batch_indices], (self.keys, self.values)
+        )
+        self.offset = self.offset[batch_indices]
+        self.left_padding = self.left_padding[batch_indices]
+
+        # Shift left to reduce padding
+        min_left_pad = self.left_padding.min().item()
+        if min_left_pad > 0:
+            self.keys, self.values = tree_map(
+                lambda x: x[..., min_left_pad:, :], (self.keys, self.values)
+            )
+            self._idx -= min_left_pad
+            self.left_padding -= min_left_pad
+
+    def extend(self, other):
+        """
+        In-place extend this cache with the other cache.
+        """
+        max_idx = max(self._idx, other._idx)
+        max_size = max(self.keys[0].shape[2], other.keys[0].shape[2])
+
+        # Pad the keys and values so they are right-justified
+        # with the index and the same size
+        def pad(c):
+            left = max_idx - c._idx
+            right = max_size - c.keys[0].shape[2] - left
+
+            def pad_quant(x):
+                if right < 0:
+                    x = x[..., :right, :]
+                if left != 0 or right > 0:
+                    x = mx.pad(x, [(0, 0), (0, 0), (left, max(right, 0)), (0, 0)])
+                return x
+
+            k, v = tree_map(pad_quant, (c.keys, c.values))
+            return k, v, c.offset, c.left_padding + left
+
+        (sk, sv, so, sl), (ok, ov, oo, ol) = pad(self), pad(other)
+        self.keys = tuple(mx.concatenate(x) for x in zip(sk, ok))
+        self.values = tuple(mx.concatenate(x) for x in zip(sv, ov))
+        self.offset = mx.concatenate([so, oo])
+        self.left_padding = mx.concatenate([sl, ol])
+        self._idx = max_idx
+
+    def extract(self, idx):
+        cache = QuantizedKVCache(group_size=self.group_size, bits=self.bits)
+        padding = self.left_padding[idx].item()
+        cache.keys, cache.values = tree_map(
+            lambda x: mx.contiguous(x[idx : idx + 1, :, padding : self._idx]),
+            (self.keys, self.values),
+        )
+        cache.offset = self._idx - padding
+        return cache
+
+    @classmethod
+    def merge(cls, caches, group_size: int = 64, bits: int = 8):
+        """
+        Merge the caches of several sequences. :obj:`KVCache` layers are
+        quantized and :obj:`QuantizedKVCache` layers must use the same
+        ``group_size`` and ``bits``.
+        """
+        quantized = []
+        for c in caches:
+            if isinstance(c, KVCache):
+                c = c.to_quantized(group_size=group_size, bits=bits)
+            elif c.group_size != group_size or c.bits != bits:
+                raise ValueError(
+                    f"Cannot merge a {c.bits} bits cache with group size "
+                    f"{c.group_size} into a {bits} bits cache with group "
+                    f"size {group_size}."
+                )
+            quantized.append(c)
+
+        lengths = [c.offset for c in quantized]
+        max_length = max(lengths)
+        padding = [max_length - l for l in lengths]
+        B = len(quantized)
+        ref = next(c for c in quantized if c.keys is not None)
+
+        def zeros(x):
+            return mx.zeros((B, x.shape[1], max_length, x.shape[3]), dtype=x.dtype)
+
+        keys, values = tree_map(zeros, (ref.keys, ref.values))
+        for i, (p, c) in enumerate(zip(padding, quantized)):
+            if c.offset == 0:
+                continue
+            for j in range(len(keys)):
+                keys[j][i : i + 1, :, p : p + c.offset] = c.keys[j][..., : c.offset, :]
+                values[j][i : i + 1, :, p : p + c.offset] = c.values[j][
+                    ..., : c.offset, :
+                ]
+
+        cache = cls(padding, group_size=group_size, bits=bits)
+        cache.keys = keys
+        cache.values = values
+        cache.offset += max_length
+        cache._idx = max_length
+
+        return cache
+
+
+class StaticKVCache(_BaseCache):
+    step = 256
+
+    def __init__(self, cache: Any, num_tokens: int = 1):
+        """
+        A shape-stable view of a :obj:`KVCache` or :obj:`BatchKVCache` for
+        decoding steps compiled with ``mx.compile``.
+
+        The keys and values live in a preallocated buffer and the write
+        position and the offsets are arrays, so the graph of a step keeps
+        the same shapes until the buffer grows (every ``step`` tokens).
+        Attention runs over the whole buffer with the unused positions
+        masked out.
+
+        Args:
+            cache: The cache to view. It must not be empty.
+            num_tokens (int): The number of tokens of the next step.
+        """
+        if isinstance(cache, BatchKVCache):
+            idx = cache._idx
+            self.offset = cache.offset
+            self.left_padding = cache.left_padding
+        else:
+            idx = cache.offset
+            self.offset = mx.array([cache.offset])
+            self.left_padding = mx.array([0])
+        self.keys, self.values = cache.keys, cache.values
+        if idx + num_tokens > self.keys.shape[2]:
+            B, H, _, Dk = self.keys.shape
+            Dv = self.values.shape[3]
+            n_steps = (idx + num_tokens + self.step - 1) // self.step
+            size = n_steps * self.step - idx
+            self.keys = mx.concatenate(
+                [self.keys[..., :idx, :], mx.zeros((B, H, size, Dk), self.keys.dtype)],
+                axis=2,
+            )
+            self.values = mx.concatenate(
+                [
+                    self.values[..., :idx, :],
+                    mx.zeros((B, H, size, Dv), self.values.dtype),
+                ],
+                axis=2,
+            )
+        self.idx = mx.array([idx])
+        self._cache = cache
+
+    def update_and_fetch(self, keys, values):
+        self.keys = mx.slice_update(self.keys, keys, self.idx, axes=(2,))
+        self.values = mx.slice_update(self.values, values, self.idx, axes=(2,))
+        self.offset = self.offset + keys.shape[2]
+        self.idx = self.idx + keys.shape[2]
+        return self.keys, self.values
+
+    def make_mask(
+        self, N: int, return_array: bool = False, window_size: Optional[int] = None
+    ):
+        linds = (self.idx + mx.arange(N))[:, None]
+        rinds = mx.arange(self.keys.shape[2])[None]
+        mask = linds >= rinds
+        if window_size is not None:
+            mask = mask & (linds < rinds + window_size)
+        return mask & (mx.expand_dims(self.left_padding, (1, 2, 3)) <= rinds)
+
+    @property
+    def state(self):
+        return self.keys, self.values, self.offset, self.left_padding, self.idx
+
+    @state.setter
+    def state(self, v):
+        self.keys, self.values, self.offset, self.left_padding, self.idx = v
+
+    def write_back(self, num_tokens: int):
+        """
+        Update the viewed cache after a step of ``num_tokens`` tokens.
+        """
+        cache = self._cache
+        cache.keys, cache.values = self.keys, self.values
+        if isinstance(cache, BatchKVCache):
+            cache.offset = self.offset
+            cache._idx += num_tokens
+        else:
+            cache.offset += num_tokens
+
+
+class PagedKVCache(_BaseCache):
+    step = 256
+
+    def __init__(self, left_padding: List[int], block_size: int = 64):
+        """
+        A batched KV cache which stores the keys and values in fixed size
+        blocks drawn from a shared pool. Each sequence owns a list of blocks
+        (its block table) so adding or removing a sequence only updates the
+        block tables instead of copying the whole batch.
+
+        The inputs are expected to be left-padded as for :obj:`BatchKVCache`.
+        Blocks which only contain padding are returned to the pool so the
+        memory scales with the number of real tokens in each sequence.
+
+        The pool is stored as ``(num_blocks * block_size, n_kv_heads,
+        head_dim)`` and the keys and values are gathered into a dense
+        ``(B, n_kv_heads, L, head_dim)`` array for the attention.
+        """
+        self.block_size = block_size
+        self.keys = None
+        self.values = None
+        self.left_padding = mx.array(left_padding)
+        self.offset = mx.array([-l for l in left_padding])
+
+        self._tables = [[] for _ in left_padding]
+        self._lengths = [0] * len(left_padding)
+        self._padding = list(left_padding)
+        self._free = []
+        self._table = None
+        self._right_padding = None
+
+    @property
+    def num_blocks(self):
+        return 0 if self.keys is None else self.keys.shape[0] // self.block_size
+
+    def _grow(self, n, k_shape, v_shape, dtype):
+        num_blocks = self.num_blocks
+        n = max(n, num_blocks // 2, self.step // self.block_size)
+        new_k = mx.zeros((n * self.block_size, *k_shape), dtype)
+        new_v = mx.zeros((n * self.block_size, *v_shape), dtype)
+        if self.keys is None:
+            self.keys, self.values = new_k, new_v
+        else:
+            self.keys = mx.concatenate([self.keys, new_k])
+            self.values = mx.concatenate([self.values, new_v])
+        self._free.extend(reversed(range(num_blocks, num_blocks + n)))
+
+    def _allocate(self, n):
+        if self._free is None:
+            used = {b for t in self._tables for b in t}
+            self._free = [b for b in reversed(range(self.num_blocks)) if b not in used]
+        if len(self._free) < n:
+            self._grow(
+                n - len(self._free),
+                self.keys.shape[1:],
+                self.values.shape[1:],
+                self.keys.dtype,
+            )
+        self._table = None
+        return [self._free.pop() for _ in range(n)]
+
+    def _release(self, blocks):
+        if self._free is None:
+            self._allocate(0)
+        self._free.extend(blocks)
+        self._table = None
+
+    def _copy_blocks(self, blocks):
+        dst = self._allocate(len(blocks))
+        if blocks:
+            bs = self.block_size
+            src_idx = (mx.array(blocks)[:, None] * bs + mx.arange(bs)).flatten()
+            dst_idx = (mx.array(dst)[:, None] * bs + mx.arange(bs)).flatten()
+            self.keys[dst_idx] = self.keys[src_idx]
+            self.values[dst_idx] = self.values[src_idx]
+        return dst
+
+    def _block_table(self):
+        """
+        The block tables as a ``(B, max_blocks)`` array padded with ``-1``.
+        """
+        if self._table is None:
+            max_blocks = max((len(t) for t in self._tables), default=0)
+            self._table = mx.array(
+                [t + [-1] * (max_blocks - len(t)) for t in self._tables],
+                dtype=mx.int32,
+            ).reshape(len(self._tables), max_blocks)
+        return self._table
+
+    def _gather(self, pool, table, length):
+        bs = self.block_size
+        idx = mx.maximum(table, 0)[..., None] * bs + mx.arange(bs)
+        idx = idx.reshape(table.shape[0], -1)[:, :length]
+        return pool[idx].transpose(0, 2, 1, 3)
+
+    def _release_padding(self):
+        """
+        Return the blocks which only contain left padding to the pool.
+        """
+        bs = self.block_size
+        changed = False
+        for i, table in enumerate(self._tables):
+            n = min(self._padding[i] // bs, len(table))
+            if n > 0:
+                self._release(table[:n])
+                del table[:n]
+                self._padding[i] -= n * bs
+                self._lengths[i] -= n * bs
+                changed = True
+        if changed:
+            self.left_padding = mx.array(self._padding)
+
+    def update_and_fetch(self, keys, values):
+        B, n_kv_heads, S, k_head_dim = keys.shape
+        bs = self.block_size
+        if self.keys is None:
+            self._grow(
+                0, (n_kv_heads, k_head_dim), (n_kv_heads, values.shape[3]), keys.dtype
+            )
+
+        for table, length in zip(self._tables, self._lengths):
+            needed = (length + S + bs - 1) // bs - len(table)
+            if needed > 0:
+                table.extend(self._allocate(needed))
+        table = self._block_table()
+
+        positions = mx.array(self._lengths)[:, None] + mx.arange(S)
+        blocks = mx.take_along_axis(table, positions // bs, axis=1)
+        idx = (blocks * bs + positions % bs).flatten()
+        self.keys[idx] = keys.transpose(0, 2, 1, 3).reshape(B * S, n_kv_heads, -1)
+        self.values[idx] = values.transpose(0, 2, 1, 3).reshape(B * S, n_kv_heads, -1)
+
+        self._lengths = [l + S for l in self._lengths]
+        self.offset += S
+        length = max(self._lengths)
+        keys = self._gather(self.keys, table, length)
+        values = self._gather(self.values, table, length)
+        self._release_padding()
+        return keys, values
+
+    def __len__(self):
+        return max(self._lengths, default=0)
+
+    def prepare(self, *, left_padding=None, lengths=None, right_padding=None):
+        if left_padding is not None:
+            if self.keys is not None:
+                raise ValueError(
+                    "Left padding can only be added to an empty PagedKVCache"
+                )
+            self._padding = [p + l for p, l in zip(self._padding, left_padding)]
+            left_padding = mx.array(left_padding)
+            self.left_padding += left_padding
+            self.offset -= left_padding
+
+        if right_padding is not None and max(right_padding) > 0:
+            self._right_padding = list(right_padding)
+
+    def finalize(self):
+        # Right padding sits at the end of each sequence so it is dropped
+        # rather than rolled to the front as in the BatchKVCache.
+        if self._right_padding is not None:
+            self._trim_rows(self._right_padding)
+            self.offset -= mx.array(self._right_padding)
+            self._right_padding = None
+
+    def _trim_rows(self, amounts):
+        bs = self.block_size
+        for i, n in enumerate(amounts):
+            self._lengths[i] -= n
+            keep = (self._lengths[i] + bs - 1) // bs
+            if keep < len(self._tables[i]):
+                self._release(self._tables[i][keep:])
+                del self._tables[i][keep:]
+
+    @property
+    def state(self):
+        return (
+            self.keys,
+            self.values,
+            self._block_table(),
+            mx.array(self._lengths),
+            self.offset,
+            self.left_padding,
+        )
+
+    @state.setter
+    def state(self, v):
+        self.keys, self.values, table, lengths, self.offset, self.left_padding = v
+        self._tables = [[b for b in t if b >= 0] for t in table.tolist()]
+        self._lengths = lengths.tolist()
+        self._padding = self.left_padding.tolist()
+        self._free = None
+        self._table = None
+        self._right_padding = None
+
+    @property
+    def meta_state(self):
+        return (str(self.block_size),)
+
+    @meta_state.setter
+    def meta_state(self, v):
+        self.block_size = int(v[0])
+
+    def is_trimmable(self):
+        return True
+
+    def trim(self, n):
+        n = min(min(self._lengths, default=0), n)
+        self._trim_rows([n] * len(self._lengths))
+        self.offset -= n
+        return n
+
+    def rewind(self, n):
+        """
+        Trim ``n[i]`` tokens from the end of the ``i``-th sequence.
+        """
+        if isinstance(n, mx.array):
+            n = n.tolist()
+        self._trim_rows(n)
+        self.offset -= mx.array(n)
+
+    def make_mask(
+        self,
+        N: int,
+        return_array: bool = False,
+        window_size: Optional[int] = None,
+        **kwargs,
+    ):
+        lengths = mx.array(self._lengths) + N
+        linds = (lengths[:, None] - N + mx.arange(N))[:, None, :, None]
+        rinds = mx.arange(max(self._lengths, default=0) + N)
+        mask = linds >= rinds
+        mask &= rinds >= self.left_padding[:, None, None, None]
+        if window_size is not None:
+            mask &= linds < rinds + window_size
+        return mask
+
+    def filter(self, batch_indices):
+        """
+        In-place filter to keep just the given indices in the cache.
+        """
+        if isinstance(batch_indices, mx.array):
+            batch_indices = batch_indices.tolist()
+        keep = set(batch_indices)
+        for i, table in enumerate(self._tables):
+            if i not in keep:
+                self._release(table)
+
+        # A sequence kept more than once gets a copy of its blocks
+        tables = []
+        seen = set()
+        for i in batch_indices:
+            table = self._tables[i]
+            if i in seen:
+                table = self._copy_blocks(table)
+            seen.add(i)
+            tables.append(table)
+        self._tables = tables
+        self._lengths = [self._lengths[i] for i in batch_indices]
+        self._padding = [self._padding[i] for i in batch_indices]
+        batch_indices = mx.array(batch_indices, mx.int32)
+        self.offset = self.offset[batch_indices]
+        self.left_padding = self.left_padding[batch_indices]
+        self._table = None
+
+    def extend(self, other):
+        """
+        In-place extend this cache with the other cache.
+
+        Only the blocks used by the sequences in ``other`` are copied into the
+        pool of this cache.
+        """
+        bs = self.block_size
+        if other.block_size != bs:
+            raise ValueError(
+                "PagedKVCache can only extend caches with the same block size"
+            )
+        if self.keys is None:
+            self._grow(
+                0, other.keys.shape[1:], other.values.shape[1:], other.keys.dtype
+            )
+
+        src = [b for t in other._tables for b in t]
+        dst = self._allocate(len(src))
+        if src:
+            src_idx = (mx.array(src)[:, None] * bs + mx.arange(bs)).flatten()
+            dst_idx = (mx.array(dst)[:, None] * bs + mx.arange(bs)).flatten()
+            self.keys[dst_idx] = other.keys[src_idx]
+            self.values[dst_idx] = other.values[src_idx]
+
+        dst = iter(dst)
+        self._tables.extend([next(dst) for _ in t] for t in other._tables)
+        self._lengths.extend(other._lengths)
+        self._padding.extend(other._padding)
+        self.offset = mx.concatenate([self.offset, other.offset])
+        self.left_padding = mx.concatenate([self.left_padding, other.left_padding])
+        self._table = None
+
+    def extract(self, idx):
+        cache = KVCache()
+        padding = self._padding[idx]
+        table = self._block_table()[idx : idx + 1]
+        cache.keys = self._gather(self.keys, table, self._lengths[idx])[
+            ..., padding:, :
+        ]
+        cache.values = self._gather(self.values, table, self._lengths[idx])[
+            ..., padding:, :
+        ]
+        cache.keys = mx.contiguous(cache.keys)
+        cache.values = mx.contiguous(cache.values)
+        cache.offset = cache.keys.shape[2]
+        return cache
+
+    @classmethod
+    def merge(cls, caches, block_size: int = 64):
+        B = len(caches)
+        H = max(c.keys.shape[1] for c in caches if c.keys is not None)
+        Dk = max(c.keys.shape[3] for c in caches if c.keys is not None)
+        Dv = max(c.values.shape[3] for c in caches if c.values is not None)
+        dt = next(iter(c.keys.dtype for c in caches if c.keys is not None))
+
+        cache = cls([0] * B, block_size)
+        num_blocks = sum((c.offset + block_size - 1) // block_size for c in caches)
+        cache._grow(num_blocks, (H, Dk), (H, Dv), dt)
+        for i, c in enumerate(caches):
+            if c.offset == 0:
+                continue
+            n = (c.offset + block_size - 1) // block_size
+            cache._tables[i] = cache._allocate(n)
+            idx = mx.array(cache._tables[i])[:, None] * block_size
+            idx = (idx + mx.arange(block_size)).flatten()[: c.offset]
+            cache.keys[idx] = c.keys[0, :, : c.offset].transpose(1, 0, 2)
+            cache.values[idx] = c.values[0, :, : c.offset].transpose(1, 0, 2)
+            cache._lengths[i] = c.offset
+        cache.offset = mx.array(cache._lengths)
+        return cache
+
+
 class BatchRotatingKVCache(_BaseCache):
     step = 256
 
@@ -1073,6 +1875,25 @@ class BatchRotatingKVCache(_BaseCache):
         self.offset -= n
         return n
 
+    def rewind(self, n):
+        """
+        Trim ``n[i]`` tokens from the end of the ``i``-th sequence.
+
+        Like :meth:`trim` this is only possible before the cache has reached
+        its maximum size.
+        """
+        if not self.is_trimmable():
+            raise ValueError("Cannot rewind a BatchRotatingKVCache which is full")
+        n = mx.array(n)
+        shift = n - n.min()
+        if shift.max().item() > 0:
+            self.keys = dynamic_roll(self.keys, shift[:, None], axis=2)
+            self.values = dynamic_roll(self.values, shift[:, None], axis=2)
+            self.left_padding += shift
+        self._offset -= n.min().item()
+        self._idx -= n.min().item()
+        self.offset -= n
+
     def to_quantized(self, group_size: int = 64, bits: int = 4) -> QuantizedKVCache:
         raise NotImplementedError("BatchRotatingKVCache Quantization NYI")
 
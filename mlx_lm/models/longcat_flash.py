@@ -5,8 +5,9 @@ from typing import Any, Dict, Optional, Tuple
 import mlx.core as mx
 import mlx.nn as nn
 
-from .base import BaseModelArgs, create_attention_mask, scaled_dot_product_attention
+from .base import BaseModelArgs, create_attention_mask
 from .cache import CacheList, KVCache
+from .mla import mla_attention
 from .switch_layers import SwitchGLU
 
 
@@ -124,31 +125,24 @@ class LongcatFlashMLA(nn.Module):
         if self.mla_scale_kv_lora is not None:
             k_pass = k_pass * self.mla_scale_kv_lora
 
-        key_shape = (B, L, -1, self.qk_nope_head_dim + self.v_head_dim)
-        k_pass = self.kv_b_proj(k_pass).reshape(*key_shape).transpose(0, 2, 1, 3)
-        k_pass, value_states = mx.split(k_pass, [self.qk_nope_head_dim], axis=-1)
-
+        # Only the latent and the positional keys are cached
+        k_pass = k_pass[:, None]
         k_rot = k_rot.reshape(B, 1, L, self.qk_rope_head_dim)
 
         if cache is not None:
             q_rot = self.rope(q_rot, cache.offset)
             k_rot = self.rope(k_rot, cache.offset)
+            k_pass, k_rot = cache.update_and_fetch(k_pass, k_rot)
         else:
             q_rot = self.rope(q_rot)
             k_rot = self.rope(k_rot)
 
-        k_rot = mx.broadcast_to(k_rot, (*k_pass.shape[:-1], k_rot.shape[-1]))
-
-        query_states = mx.concatenate([q_pass, q_rot], axis=-1)
-        key_states = mx.concatenate([k_pass, k_rot], axis=-1)
-
-        if cache is not None:
-            key_states, value_states = cache.update_and_fetch(key_states, value_states)
-
-        attn_output = scaled_dot_product_attention(
-            query_states,
-            key_states,
-            value_states,
+        attn_output = mla_attention(
+            q_pass,
+            q_rot,
+            k_pass,
+            k_rot,
+            self.kv_b_proj,
             cache=cache,
             scale=self.scale,
             mask=mask,
@@ -6,7 +6,8 @@ from typing import Any, Dict, Optional, Union
 import mlx.core as mx
 import mlx.nn as nn
 
-from .base import BaseModelArgs, create_attention_mask, scaled_dot_product_attention
+from .base import BaseModelArgs, create_attention_mask
+from .mla import mla_attention
 from .rope_utils import SuScaledRoPE
 
 
@@ -106,43 +107,32 @@ class Attention(nn.Module):
         q = q.reshape(B, L, self.num_heads, -1).transpose(0, 2, 1, 3)
         q_nope, q_pe = mx.split(q, [self.qk_nope_head_dim], axis=-1)
 
-        # Project key and value
+        # Project the key and value latent, only the latent and the
+        # positional keys are cached
         compressed_kv = self.kv_a_proj_with_mqa(x)
-        compressed_kv, k_pe = mx.split(compressed_kv, [self.kv_lora_rank], axis=-1)
+        kv_latent, k_pe = mx.split(compressed_kv, [self.kv_lora_rank], axis=-1)
+        kv_latent = self.kv_a_layernorm(kv_latent)[:, None]
         k_pe = k_pe.reshape(B, L, 1, self.qk_rope_head_dim).transpose(0, 2, 1, 3)
 
-        kv = self.kv_b_proj(self.kv_a_layernorm(compressed_kv))
-        kv = kv.reshape(B, L, self.num_heads, -1).transpose(0, 2, 1, 3)
-
-        k_nope, values = mx.split(kv, [self.qk_nope_head_dim], axis=-1)
-
         # Apply RoPE to the query and key parts that need position embedding
         if cache is not None:
             q_pe = self.rope(q_pe, offset=cache.offset)
             k_pe = self.rope(k_pe, offset=cache.offset)
+            kv_latent, k_pe = cache.update_and_fetch(kv_latent, k_pe)
         else:
             q_pe = self.rope(q_pe)
             k_pe = self.rope(k_pe)
 
-        # Create the full query and key tensors by combining the parts
-        # Broadcast k_pe to all heads
-        k_pe_broadcasted = mx.broadcast_to(
-            k_pe, (B, self.num_heads, L, self.qk_rope_head_dim)
-        )
-
-        # Use concatenate for queries
-        queries = mx.concatenate([q_nope, q_pe], axis=-1)
-
-        # Use concatenate for keys
-        keys = mx.concatenate([k_nope, k_pe_broadcasted], axis=-1)
-
-        # Update cache if needed
-        if cache is not None:
-            keys, values = cache.update_and_fetch(keys, values)
-
         # Perform attention
-        output = scaled_dot_product_attention(
-            queries, keys, values, cache=cache, scale=self.softmax_scale, mask=mask
+        output = mla_attention(
+            q_nope,
+            q_pe,
+            kv_latent,
+            k_pe,
+            self.kv_b_proj,
+            cache=cache,
+            scale=self.softmax_scale,
+            mask=mask,
         )
         output = output.transpose(0, 2, 1, 3).reshape(B, L, -1)
         return self.o_proj(output)
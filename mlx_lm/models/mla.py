@@ -0,0 +1,118 @@
+# Copyright © 2025 Apple Inc.
+
+from typing import Any, Optional
+
+import mlx.core as mx
+import mlx.nn as nn
+
+
+def _head_matmul(x, proj, num_heads, start, stop, transpose):
+    """
+    Multiply ``x`` with the rows ``[start, stop)`` of every head of ``proj``
+    without expanding (or dequantizing) the weight.
+    """
+
+    def heads(w):
+        if w is None:
+            return None
+        return w.reshape(num_heads, -1, w.shape[-1])[:, start:stop]
+
+    if isinstance(proj, nn.QuantizedLinear):
+        return mx.quantized_matmul(
+            x,
+            heads(proj["weight"]),
+            heads(proj["scales"]),
+            heads(proj.get("biases")),
+            transpose=transpose,
+            group_size=proj.group_size,
+            bits=proj.bits,
+            mode=proj.mode,
+        )
+    w = heads(proj["weight"])
+    return x @ (w.swapaxes(-1, -2) if transpose else w)
+
+
+def mla_attention(
+    q_nope: mx.array,
+    q_pe: mx.array,
+    kv_latent: Any,
+    k_pe: Any,
+    kv_b_proj: nn.Module,
+    cache: Optional[Any],
+    scale: float,
+    mask: Optional[mx.array],
+) -> mx.array:
+    """
+    Multi-head latent attention over a cache holding the normalized
+    ``kv_lora_rank`` latent (as keys) and the rotated ``k_pe`` (as values),
+    each with a single head.
+
+    For decoding, ``kv_b_proj`` is absorbed into the queries and the output
+    so attention runs directly on the latent and the positional scores are
+    added as a mask. Otherwise the latent is expanded to per-head keys and
+    values as in the original formulation so that the prompt is processed
+    with the fused causal attention.
+
+    Args:
+        q_nope (mx.array): Queries without positions ``(B, H, L, qk_nope_head_dim)``.
+        q_pe (mx.array): Rotated queries ``(B, H, L, qk_rope_head_dim)``.
+        kv_latent: The latent ``(B, 1, S, kv_lora_rank)``, quantized if the
+          cache is.
+        k_pe: The rotated keys ``(B, 1, S, qk_rope_head_dim)``, quantized if
+          the cache is.
+        kv_b_proj (nn.Module): The projection from the latent to the keys
+          and values.
+
+    Returns:
+        The attention output ``(B, H, L, v_head_dim)``.
+    """
+    B, H, L, qk_nope_head_dim = q_nope.shape
+    quantized = hasattr(cache, "bits")
+    if quantized:
+        qargs = {"group_size": cache.group_size, "bits": cache.bits}
+
+    absorb = L == 1 and isinstance(kv_b_proj, (nn.Linear, nn.QuantizedLinear))
+    if absorb:
+        if quantized:
+            pe_scores = mx.quantized_matmul(
+                q_pe * scale, *k_pe, transpose=True, **qargs
+            )
+        else:
+            pe_scores = (q_pe * scale) @ k_pe.swapaxes(-1, -2)
+
+        # A single query attends to every key so only an explicit mask (e.g.
+        # the left padding of a batch) applies. The positional scores are
+        # added to the attention scores as a mask.
+        if mask is not None and not isinstance(mask, str):
+            if mask.dtype == mx.bool_:
+                pe_scores = mx.where(mask, pe_scores, mx.finfo(pe_scores.dtype).min)
+            else:
+                pe_scores = pe_scores + mask
+
+        q_latent = _head_matmul(q_nope, kv_b_proj, H, 0, qk_nope_head_dim, False)
+        if quantized:
+            scores = mx.quantized_matmul(
+                q_latent * scale, *kv_latent, transpose=True, **qargs
+            )
+            scores = mx.softmax(scores + pe_scores, axis=-1, precise=True)
+            output = mx.quantized_matmul(scores, *kv_latent, transpose=False, **qargs)
+        else:
+            output = mx.fast.scaled_dot_product_attention(
+                q_latent, kv_latent, kv_latent, scale=scale, mask=pe_scores
+            )
+        return _head_matmul(output, kv_b_proj, H, qk_nope_head_dim, None, True)
+
+    # Expand the latent to per-head keys and values for the prompt so the
+    # attention keeps the given (e.g. causal) mask
+    if quantized:
+        kv_latent = mx.dequantize(*kv_latent, **qargs)
+        k_pe = mx.dequantize(*k_pe, **qargs)
+    S = kv_latent.shape[2]
+    kv = kv_b_proj(kv_latent).reshape(B, S, H, -1).transpose(0, 2, 1, 3)
+    k_nope, values = mx.split(kv, [qk_nope_head_dim], axis=-1)
+    k_pe = mx.broadcast_to(k_pe, (B, H, S, k_pe.shape[-1]))
+    keys = mx.concatenate([k_nope, k_pe], axis=-1)
+    queries = mx.concatenate([q_nope, q_pe], axis=-1)
+    return mx.fast.scaled_dot_product_attention(
+        queries, keys, values, scale=scale, mask=mask
+    )
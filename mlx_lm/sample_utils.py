@@ -69,6 +69,55 @@ def make_sampler(
     return sampler
 
 
+def make_batch_sampler(
+    temp: List[float],
+    top_p: List[float],
+    min_p: List[float],
+    top_k: List[int],
+    min_tokens_to_keep: int = 1,
+) -> Callable[[mx.array], mx.array]:
+    """
+    Make a sampler which uses different sampling parameters for each row of a
+    batch. The filters for all the rows are applied in one pass over the
+    ``(B, V)`` log-probabilities.
+
+    Args:
+        temp (List[float]): The temperature for each row, if 0 the argmax is
+          used.
+        top_p (List[float]): Nucleus sampling threshold for each row. A value
+          of 0 or 1 disables it.
+        min_p (List[float]): The min-p threshold for each row. A value of 0
+          disables it.
+        top_k (List[int]): The number of top tokens to sample from for each
+          row. A value of 0 disables it.
+        min_tokens_to_keep (int, optional): Minimum number of tokens that cannot
+          be filtered by min_p sampling.
+
+    Returns:
+        Callable[mx.array, mx.array]:
+            A sampler which takes log-probabilities and returns tokens.
+    """
+    if not all(0 <= p <= 1.0 for p in top_p):
+        raise ValueError(f"`top_p` has to be in the [0, 1] interval, but is {top_p}")
+    if not all(0 <= p <= 1.0 for p in min_p):
+        raise ValueError(f"`min_p` has to be in the [0, 1] interval, but is {min_p}")
+    if not all(isinstance(k, int) and k >= 0 for k in top_k):
+        raise ValueError(f"`top_k` has to be a non-negative integer, but is {top_k}")
+
+    temp = mx.array(temp, mx.float32)[:, None]
+    top_p = mx.array(top_p, mx.float32)[:, None]
+    min_p = mx.array(min_p, mx.float32)[:, None]
+    top_k = mx.array(top_k, mx.int32)[:, None]
+
+    def sampler(logprobs):
+        logprobs = apply_batch_filters(
+            logprobs, top_p, min_p, top_k, min_tokens_to_keep
+        )
+        return batch_categorical_sampling(logprobs, temp)
+
+    return sampler
+
+
 def make_logits_processors(
     logit_bias: Optional[Dict[int, float]] = None,
     repetition_penalty: Optional[float] = None,
@@ -234,6 +283,56 @@ def apply_top_p(logprobs: mx.array, top_p: float) -> mx.array:
     )
 
 
+@partial(mx.compile, inputs=mx.random.state, outputs=mx.random.state)
+def apply_batch_filters(
+    logprobs: mx.array,
+    top_p: mx.array,
+    min_p: mx.array,
+    top_k: mx.array,
+    min_tokens_to_keep: int = 1,
+) -> mx.array:
+    """
+    Apply top-p, min-p and top-k filtering with different parameters for each
+    row. The tokens are sorted once and the filters are combined into a
+    single mask.
+
+    Args:
+        logprobs: A ``(B, V)`` array of log probabilities.
+        top_p: A ``(B, 1)`` array of top-p thresholds, ``0`` or ``1`` disables it.
+        min_p: A ``(B, 1)`` array of min-p thresholds, ``0`` disables it.
+        top_k: A ``(B, 1)`` array of top-k values, ``0`` disables it.
+        min_tokens_to_keep (int, optional): Minimum number of tokens that cannot
+            be filtered by min-p. Default: ``1``.
+    """
+    # Indices sorted in decreasing order
+    sorted_indices = mx.argsort(-logprobs, axis=-1)
+    sorted_logprobs = mx.take_along_axis(logprobs, sorted_indices, axis=-1)
+    ranks = mx.arange(logprobs.shape[-1])
+
+    # Top-k
+    remove = (top_k > 0) & (ranks >= top_k)
+
+    # Top-p keeps the tokens whose more likely tokens hold less than top_p
+    probs = mx.exp(sorted_logprobs)
+    mass = mx.cumsum(probs, axis=-1) - probs
+    remove |= (top_p > 0) & (top_p < 1) & (mass >= top_p)
+
+    # Min-p, the log of a disabled min_p is -inf so nothing is removed
+    scaled_min_p = sorted_logprobs[:, 0:1] + mx.log(min_p)
+    remove |= (sorted_logprobs < scaled_min_p) & (ranks >= min_tokens_to_keep)
+
+    selected_logprobs = mx.where(remove, -float("inf"), sorted_logprobs)
+
+    # Rearrange back to the original order
+    inverse_indices = mx.put_along_axis(
+        mx.zeros_like(sorted_indices),
+        sorted_indices,
+        mx.arange(sorted_indices.shape[-1], dtype=sorted_indices.dtype),
+        axis=-1,
+    )
+    return mx.take_along_axis(selected_logprobs, inverse_indices, axis=-1)
+
+
 @partial(mx.compile, inputs=mx.random.state, outputs=mx.random.state)
 def apply_xtc(
     logits: mx.array,
@@ -276,6 +375,13 @@ def categorical_sampling(logits, temp):
     return mx.random.categorical(logits * (1 / temp))
 
 
+@partial(mx.compile, inputs=mx.random.state, outputs=mx.random.state)
+def batch_categorical_sampling(logits, temp):
+    scale = 1 / mx.where(temp > 0, temp, 1)
+    tokens = mx.random.categorical(logits * scale)
+    return mx.where(temp.squeeze(-1) > 0, tokens, mx.argmax(logits, axis=-1))
+
+
 def make_repetition_penalty(penalty: float, context_size: int = 20):
     """
     Make repetition penalty processor.
@@ -307,3 +413,99 @@ def make_repetition_penalty(penalty: float, context_size: int = 20):
         return logits
 
     return repetition_penalty_processor
+
+
+def make_batch_logits_processors(
+    logit_bias: List[Optional[Dict[int, float]]],
+    repetition_penalty: List[Optional[float]],
+    repetition_context_size: List[int],
+):
+    """
+    Make logits processors for a batch with different parameters for each row.
+
+    Args:
+        logit_bias (List[Dict[int, float]]): Additive logit bias for each row.
+        repetition_penalty (List[float]): The penalty factor for repeating
+          tokens for each row.
+        repetition_context_size (List[int]): The number of tokens to consider
+          for repetition penalty for each row.
+
+    Returns:
+        List[Callable[[mx.array, mx.array], mx.array]]:
+            A list of logits processors. Each processor takes a ``(B, context)``
+            array of previous tokens, left-padded with ``-1``, and the
+            ``(B, V)`` logits and returns the updated logits.
+    """
+    logits_processors = []
+    if any(logit_bias):
+        logits_processors.append(make_batch_logit_bias(logit_bias))
+    if any(repetition_penalty):
+        logits_processors.append(
+            make_batch_repetition_penalty(repetition_penalty, repetition_context_size)
+        )
+    return logits_processors
+
+
+def make_batch_logit_bias(logit_bias: List[Optional[Dict[int, float]]]):
+    """
+    Make a logit bias processor with a different bias for each row.
+
+    Args:
+        logit_bias (List[Dict[int, float]]): Additive logit bias for each row.
+
+    Returns:
+        Callable[[mx.array, mx.array], mx.array]:
+            The logit bias processor.
+    """
+    logit_bias = [b or {} for b in logit_bias]
+    size = max(len(b) for b in logit_bias)
+    indices = mx.array([list(b.keys()) + [0] * (size - len(b)) for b in logit_bias])
+    values = mx.array([list(b.values()) + [0.0] * (size - len(b)) for b in logit_bias])
+    rows = mx.arange(len(logit_bias))[:, None]
+
+    def logit_bias_processor(_, logits):
+        return logits.at[rows, indices].add(values.astype(logits.dtype))
+
+    return logit_bias_processor
+
+
+def make_batch_repetition_penalty(
+    penalty: List[Optional[float]], context_size: List[int]
+):
+    """
+    Make a repetition penalty processor with a different penalty and context
+    size for each row.
+
+    Args:
+        penalty (List[float]): The repetition penalty factor for each row.
+          ``None`` or ``0`` disables it.
+        context_size (List[int]): The number of previous tokens to use for
+          each row.
+
+    Returns:
+        Callable[[mx.array, mx.array], mx.array]:
+            The repetition penalty processor.
+    """
+    if any(p is not None and p < 0 for p in penalty):
+        raise ValueError(f"penalty must be a non-negative float, got {penalty}")
+
+    penalty = mx.array([p or 1.0 for p in penalty], mx.float32)[:, None]
+    context_size = mx.array(context_size)[:, None]
+
+    def repetition_penalty_processor(tokens, logits):
+        if tokens is None or tokens.shape[1] == 0:
+            return logits
+        B, C = tokens.shape
+        valid = (tokens >= 0) & (mx.arange(C) >= C - context_size)
+
+        # Mark the tokens in the context of each row
+        seen = (
+            mx.zeros(logits.shape, mx.int32)
+            .at[mx.arange(B)[:, None], mx.maximum(tokens, 0)]
+            .add(valid.astype(mx.int32))
+        )
+
+        penalized = mx.where(logits < 0, logits * penalty, logits / penalty)
+        return mx.where(seen > 0, penalized.astype(logits.dtype), logits)
+
+    return repetition_penalty_processor
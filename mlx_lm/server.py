@@ -1,21 +1,29 @@
 # Copyright © 2023-2024 Apple Inc.
 
 import argparse
+import asyncio
 import copy
+import hashlib
+import heapq
+import io
 import json
 import logging
+import os
 import platform
+import select
 import socket
 import time
 import uuid
 import warnings
-from collections import deque
+from array import array
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 from queue import Empty as QueueEmpty
 from queue import Queue
-from threading import Condition, Lock, Thread
+from threading import Condition, Event, Lock, Thread
 from typing import (
     Any,
     Callable,
@@ -31,14 +39,19 @@ from typing import (
 
 import mlx.core as mx
 from huggingface_hub import scan_cache_dir
+from mlx.utils import tree_reduce
 
 from ._version import __version__
-from .generate import BatchGenerator, stream_generate
+from .generate import BatchGenerator, _CompiledStep, stream_generate
 from .models.cache import (
+    ArraysCache,
+    CacheList,
     KVCache,
     RotatingKVCache,
     can_trim_prompt_cache,
+    load_prompt_cache,
     make_prompt_cache,
+    save_prompt_cache,
     trim_prompt_cache,
 )
 from .sample_utils import make_logits_processors, make_sampler
@@ -113,6 +126,93 @@ def sequence_overlap(s1: Sequence, s2: Sequence) -> bool:
     return any(s1[-i:] == s2[:i] for i in range(1, max_overlap + 1))
 
 
+class StopMatcher:
+    """
+    Incremental matcher of the stop sequences of a request.
+
+    The stop sequences are compiled once into an Aho-Corasick automaton over
+    the token ids. A state of the automaton stands for the longest end of the
+    generated tokens which is the start of a stop sequence so every new token
+    only advances the state, in amortized constant time, instead of comparing
+    the end of the output with every stop sequence.
+
+    Args:
+        stop_id_sequences (List[List[int]]): The token ids of the stop
+          sequences.
+        stop_words (List[str]): The stop words that correspond to the
+          ``stop_id_sequences``.
+    """
+
+    def __init__(self, stop_id_sequences: List[List[int]], stop_words: List[str]):
+        self._goto = [{}]
+        self._fail = [0]
+        self._depth = [0]
+        # The first stop sequence which ends the output in each state
+        self._match = [-1]
+
+        for i, stop_ids in enumerate(stop_id_sequences):
+            state = 0
+            for token in stop_ids:
+                if token not in self._goto[state]:
+                    self._goto[state][token] = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._depth.append(self._depth[state] + 1)
+                    self._match.append(-1)
+                state = self._goto[state][token]
+            if state > 0 and self._match[state] < 0:
+                self._match[state] = i
+
+        # The failure links in breadth first order so that the matches of the
+        # shorter suffixes are known first
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, child in self._goto[state].items():
+                queue.append(child)
+                if state > 0:
+                    self._fail[child] = self.advance(self._fail[state], token)
+                suffix_match = self._match[self._fail[child]]
+                if suffix_match >= 0 and not 0 <= self._match[child] < suffix_match:
+                    self._match[child] = suffix_match
+
+        self._conditions = [
+            StopCondition(
+                stop_met=True,
+                trim_length=len(stop_ids),
+                trim_text_length=len(stop_word),
+            )
+            for stop_ids, stop_word in zip(stop_id_sequences, stop_words)
+        ]
+
+    def advance(self, state: int, token: int) -> int:
+        """
+        The state after generating ``token`` in ``state``. The initial state
+        is ``0``.
+        """
+        goto = self._goto
+        while state > 0 and token not in goto[state]:
+            state = self._fail[state]
+        return goto[state].get(token, 0)
+
+    def stop_condition(self, state: int) -> StopCondition:
+        """
+        Whether the output ends with a stop sequence in ``state`` and how
+        much of it should be trimmed, see :func:`stopping_criteria`.
+        """
+        match = self._match[state]
+        if match < 0:
+            return StopCondition(stop_met=False, trim_length=0, trim_text_length=0)
+        return self._conditions[match]
+
+    def partial_match(self, state: int) -> bool:
+        """
+        Whether the end of the output in ``state`` may be the start of a stop
+        sequence, see :func:`sequence_overlap`.
+        """
+        return state > 0
+
+
 def convert_chat(messages: List[dict], role_mapping: Optional[dict] = None):
     default_role_mapping = {
         "system_prompt": (
@@ -166,141 +266,564 @@ def process_message_content(messages):
             message["content"] = ""
 
 
+def _nbytes(prompt_cache):
+    return tree_reduce(
+        lambda acc, x: acc + x.nbytes if isinstance(x, mx.array) else acc,
+        [c.state for c in prompt_cache if hasattr(c, "state")],
+        0,
+    )
+
+
+def _top_logprobs(logprobs, num_logprobs):
+    """
+    The ``num_logprobs[i]`` most likely tokens and their log probabilities
+    for each vector in ``logprobs``. All the vectors are processed with a
+    single partition.
+    """
+    top_tokens = [None] * len(logprobs)
+    rows = [i for i, k in enumerate(num_logprobs) if k > 0]
+    if not rows:
+        return top_tokens
+    k = max(num_logprobs[i] for i in rows)
+    logprobs = mx.stack([logprobs[i] for i in rows])
+    top_indices = mx.argpartition(-logprobs, kth=k - 1, axis=-1)[:, :k]
+    top_logprobs = mx.take_along_axis(logprobs, top_indices, axis=-1)
+    order = mx.argsort(-top_logprobs, axis=-1)
+    top_indices = mx.take_along_axis(top_indices, order, axis=-1).tolist()
+    top_logprobs = mx.take_along_axis(top_logprobs, order, axis=-1).tolist()
+    for i, indices, values in zip(rows, top_indices, top_logprobs):
+        n = num_logprobs[i]
+        top_tokens[i] = tuple(zip(indices[:n], values[:n]))
+    return top_tokens
+
+
+class DiskPromptCache:
+    """
+    A bounded on-disk store for the prompt caches evicted from
+    ``LRUPromptCache``.
+
+    Each prompt cache is saved with ``save_prompt_cache`` to a file named
+    after a hash of the model and the prompt tokens. A lookup only hashes the
+    prefixes of the prompt which have the length of a stored prompt, so it
+    costs at most the length of the prompt. The least recently used files are
+    removed once their total size exceeds ``max_bytes``.
+
+    Args:
+        path (str): The directory to store the prompt caches in.
+        max_bytes (int): The maximum total size of the files in bytes.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._files = OrderedDict()
+        self._lengths = Counter()
+        self.nbytes = 0
+        self.hits = 0
+        self.spilled_bytes = 0
+
+        # Pick up the prompt caches saved by a previous run
+        files = sorted(self.path.glob("*.safetensors"), key=os.path.getmtime)
+        for file in files:
+            length, _, digest = file.stem.partition("-")
+            if length.isdigit() and digest:
+                self._add(digest, int(length), file.stat().st_size)
+        self._evict()
+
+    def stats(self):
+        return {
+            "entries": len(self._files),
+            "nbytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "spilled_bytes": self.spilled_bytes,
+        }
+
+    def _file(self, digest, length):
+        return self.path / f"{length}-{digest}.safetensors"
+
+    @staticmethod
+    def _hasher(model):
+        return hashlib.sha256(repr(model).encode())
+
+    def _add(self, digest, length, nbytes):
+        self._files[digest] = (length, nbytes)
+        self._lengths[length] += 1
+        self.nbytes += nbytes
+
+    def _remove(self, digest):
+        length, nbytes = self._files.pop(digest)
+        self._lengths[length] -= 1
+        if self._lengths[length] == 0:
+            del self._lengths[length]
+        self.nbytes -= nbytes
+        self._file(digest, length).unlink(missing_ok=True)
+
+    def _evict(self):
+        while self._files and self.nbytes > self.max_bytes:
+            self._remove(next(iter(self._files)))
+
+    def insert(self, model, tokens, prompt_cache):
+        h = self._hasher(model)
+        h.update(array("q", tokens).tobytes())
+        digest = h.hexdigest()
+        if digest in self._files:
+            self._files.move_to_end(digest)
+            return
+
+        file = self._file(digest, len(tokens))
+        tmp_file = self.path / f"tmp-{digest}.safetensors"
+        save_prompt_cache(str(tmp_file), prompt_cache)
+        os.replace(tmp_file, file)
+        nbytes = file.stat().st_size
+        self._add(digest, len(tokens), nbytes)
+        self.spilled_bytes += nbytes
+        self._evict()
+
+    def fetch(self, model, tokens, min_length=1):
+        """
+        Load the longest stored prompt cache whose tokens are a prefix of
+        ``tokens`` and which has at least ``min_length`` tokens.
+        """
+        h = self._hasher(model)
+        start = 0
+        best = None
+        for length in sorted(self._lengths):
+            if length > len(tokens):
+                break
+            h.update(array("q", tokens[start:length]).tobytes())
+            start = length
+            if length >= min_length and h.hexdigest() in self._files:
+                best = (h.hexdigest(), length)
+        if best is None:
+            return None, tokens
+
+        digest, length = best
+        try:
+            prompt_cache = load_prompt_cache(str(self._file(digest, length)))
+        except (FileNotFoundError, ValueError):
+            self._remove(digest)
+            return None, tokens
+        self._files.move_to_end(digest)
+        self.hits += 1
+        return prompt_cache, tokens[length:]
+
+
 class LRUPromptCache:
+    """
+    A least recently used cache of prompt caches keyed by their tokens.
+
+    The tokens are indexed with a radix tree whose edges are labelled with
+    runs of tokens, so looking up the nearest cached prompt costs at most the
+    length of the prompt regardless of the number of entries.
+
+    Prompt caches made only of ``KVCache`` layers are stored as immutable
+    segments. An entry that extends a shorter cached prompt only stores the
+    keys and values past that prompt and references the shorter entry for the
+    rest, so a shared prefix (e.g. a long system prompt) is held in memory
+    once no matter how many conversations extend it. Fetching such an entry
+    returns a new cache which views the stored segments and copies them only
+    when it is written to.
+
+    Entries are evicted when there are more than ``max_size`` of them or when
+    their total size exceeds ``max_bytes``. The entry to evict is chosen with
+    the Greedy-Dual-Size-Frequency policy which weighs how often an entry is
+    used and how many tokens it would take to recompute it against its size
+    in bytes. Ties are broken by least recent use.
+
+    Evicted entries are saved to ``disk_cache`` if one is given, and loaded
+    back from it when it holds a longer prefix of a prompt than the memory.
+
+    Args:
+        max_size (int): The maximum number of entries. Default: ``10``.
+        max_bytes (int, optional): The maximum size in bytes of the cached
+          keys and values. Default: ``None`` for no limit.
+        disk_cache (DiskPromptCache, optional): A second tier for the evicted
+          entries. Default: ``None``.
+    """
 
     @dataclass
     class CacheEntry:
         prompt_cache: List[Any]
         count: int
+        prefix: Optional["LRUPromptCache.CacheEntry"] = None
+        prefix_length: int = 0
+        nbytes: int = 0
+        cost: int = 0
+        frequency: int = 1
+        priority: float = 0.0
+        refs: int = 1
+
+    @dataclass(eq=False)
+    class Node:
+        tokens: List[int]
+        depth: int
+        parent: Optional["LRUPromptCache.Node"] = None
+        children: Dict[int, "LRUPromptCache.Node"] = field(default_factory=dict)
+        entry: Optional["LRUPromptCache.CacheEntry"] = None
+        nearest: Optional["LRUPromptCache.Node"] = None
+        seq: int = 0
 
     @dataclass
     class SearchResult:
         model: Any
-        exact: List[int]
-        shorter: List[int]
-        longer: List[int]
+        exact: Optional["LRUPromptCache.Node"]
+        shorter: Optional["LRUPromptCache.Node"]
+        longer: Optional["LRUPromptCache.Node"]
         common_prefix: int
 
-    def __init__(self, max_size: int = 10):
+    def __init__(
+        self,
+        max_size: int = 10,
+        max_bytes: Optional[int] = None,
+        disk_cache: Optional[DiskPromptCache] = None,
+    ):
         self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.disk_cache = disk_cache
         self._cache = {}
-        self._lru = deque()
+        self._lru = OrderedDict()
+        self._heap = []
+        self._seq = 0
+        self._clock = 0.0
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    def stats(self):
+        stats = {
+            "entries": len(self._lru),
+            "nbytes": self.nbytes,
+            "max_size": self.max_size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "evicted_bytes": self.evicted_bytes,
+        }
+        if self.disk_cache is not None:
+            stats["disk"] = self.disk_cache.stats()
+        return stats
+
+    @staticmethod
+    def _is_segment(prompt_cache):
+        return len(prompt_cache) > 0 and all(type(c) is KVCache for c in prompt_cache)
+
+    @staticmethod
+    def _segment_length(entry):
+        return entry.prefix_length + entry.prompt_cache[0].offset
+
+    def _make_entry(self, prefix, prompt_cache):
+        """
+        Make an immutable entry which shares the keys and values of the
+        ``prefix`` entry if possible.
+        """
+        if not self._is_segment(prompt_cache):
+            return self.CacheEntry(prompt_cache, 1, nbytes=_nbytes(prompt_cache))
+
+        start = 0
+        if prefix is not None and self._is_segment(prefix.prompt_cache):
+            start = min(self._segment_length(prefix), prompt_cache[0].offset)
+        if start == 0:
+            prefix = None
+
+        segment = []
+        for c in prompt_cache:
+            s = KVCache()
+            s.keys = c.keys[..., start : c.offset, :]
+            s.values = c.values[..., start : c.offset, :]
+            # Copy the suffix out so the shared prefix can be freed
+            if start > 0:
+                s.keys = mx.contiguous(s.keys)
+                s.values = mx.contiguous(s.values)
+            s.offset = c.offset - start
+            segment.append(s)
+        if prefix is not None:
+            prefix.refs += 1
+        return self.CacheEntry(segment, 1, prefix, start, _nbytes(segment))
+
+    def _fork(self, entry, length):
+        """
+        Make a new prompt cache with the first ``length`` tokens of the
+        entry's segments. The arrays are shared with the entry until written.
+        """
+        pieces = []
+        while entry is not None:
+            n = length - entry.prefix_length
+            if n > 0 or (entry.prefix is None and not pieces):
+                n = max(n, 0)
+                pieces.append(
+                    [
+                        (c.keys[..., :n, :], c.values[..., :n, :])
+                        for c in entry.prompt_cache
+                    ]
+                )
+                length = entry.prefix_length
+            entry = entry.prefix
+        pieces.reverse()
+
+        prompt_cache = []
+        for layer in zip(*pieces):
+            keys, values = zip(*layer)
+            c = KVCache()
+            c.keys = keys[0] if len(keys) == 1 else mx.concatenate(keys, axis=2)
+            c.values = values[0] if len(values) == 1 else mx.concatenate(values, axis=2)
+            c.offset = c.keys.shape[2]
+            prompt_cache.append(c)
+        return prompt_cache
+
+    def _walk(self, root, tokens):
+        """
+        Follow ``tokens`` down the radix tree.
+
+        Returns the deepest fully matched node, the child whose edge is only
+        partially matched (or ``None``), the number of matched tokens and the
+        deepest fully matched node with a cache entry (or ``None``).
+        """
+        node = root
+        index = 0
+        last = None
+        while True:
+            if node.entry is not None:
+                last = node
+            if index == len(tokens):
+                return node, None, index, last
+            child = node.children.get(tokens[index])
+            if child is None:
+                return node, None, index, last
+            edge = child.tokens
+            end = min(len(edge), len(tokens) - index)
+            k = 1
+            while k < end and edge[k] == tokens[index + k]:
+                k += 1
+            index += k
+            if k < len(edge):
+                return node, child, index, last
+            node = child
+
+    def _refresh(self, node):
+        """Update the shallowest cached descendant of ``node`` and its parents."""
+        while node is not None:
+            nearest = node if node.entry is not None else None
+            for child in node.children.values():
+                n = child.nearest
+                if n is not None and (nearest is None or n.depth < nearest.depth):
+                    nearest = n
+            if nearest is node.nearest:
+                break
+            node.nearest = nearest
+            node = node.parent
 
     def _search(self, model, tokens):
         """Search the cache for a prompt cache. Return exact or close match."""
         if model not in self._cache:
             return self.SearchResult(model, None, None, None, 0)
 
-        current = self._cache[model]
-        last_cache_index = -1
-        index = 0
-
-        while index < len(tokens) and tokens[index] in current:
-            current = current[tokens[index]]
-            if "cache" in current:
-                last_cache_index = index
-            index += 1
+        node, child, index, last = self._walk(self._cache[model], tokens)
 
         # Exact match no need to search for longer or shorter caches
-        if last_cache_index == len(tokens) - 1:
-            return self.SearchResult(model, tokens, None, None, 0)
+        if last is not None and last.depth == len(tokens):
+            return self.SearchResult(model, last, None, None, 0)
 
         # Find the shorter cache
         shorter = None
-        if last_cache_index > 0:
-            shorter = tokens[: last_cache_index + 1]
+        if last is not None and last.depth > 1:
+            shorter = last
 
         # Check for caches that are longer
         longer = None
         common_prefix = index
-        if index > 0 and last_cache_index <= 0:
-            best = None
-            stack = [(current, [])]
-            while stack:
-                current, extra = stack.pop()
-                if "cache" in current:
-                    if best is None or len(extra) < len(best):
-                        best = extra
-                else:
-                    for tok in current:
-                        stack.append((current[tok], extra + [tok]))
-            longer = tokens[:index] + best
+        if index > 0 and shorter is None:
+            longer = (child or node).nearest
         return self.SearchResult(model, None, shorter, longer, common_prefix)
 
     def _get(self, model, tokens):
-        current = self._cache[model]
-        for tok in tokens:
-            current = current[tok]
-        return current["cache"]
-
-    def _delete(self, model, tokens):
-        path = [self._cache[model]]
-        for tok in tokens:
-            path.append(path[-1][tok])
-        del path[-1]["cache"]
-        for i in reversed(range(len(tokens))):
-            d_prev, d, t = path[i], path[i + 1], tokens[i]
-            if len(d) > 0:
+        _, _, _, last = self._walk(self._cache[model], tokens)
+        if last is None or last.depth != len(tokens):
+            raise KeyError(tokens)
+        return last.entry
+
+    def _delete(self, node):
+        self._release(node.entry)
+        node.entry = None
+        del self._lru[node]
+
+        # Remove the empty branch and merge a node left with a single child
+        while node.parent is not None and node.entry is None and not node.children:
+            del node.parent.children[node.tokens[0]]
+            node = node.parent
+        if node.parent is not None and node.entry is None and len(node.children) == 1:
+            (child,) = node.children.values()
+            child.tokens = node.tokens + child.tokens
+            child.parent = node.parent
+            node.parent.children[child.tokens[0]] = child
+            node = node.parent
+        self._refresh(node)
+
+    def _path(self, node):
+        """Return the model and the tokens of ``node``."""
+        edges = []
+        while node.parent is not None:
+            edges.append(node.tokens)
+            node = node.parent
+        model = next(m for m, root in self._cache.items() if root is node)
+        return model, [t for edge in reversed(edges) for t in edge]
+
+    def _spill(self, node):
+        entry = node.entry
+        if not all(hasattr(c, "meta_state") for c in entry.prompt_cache):
+            return
+        if self._is_segment(entry.prompt_cache):
+            prompt_cache = self._fork(entry, self._segment_length(entry))
+        else:
+            prompt_cache = entry.prompt_cache
+        model, tokens = self._path(node)
+        self.disk_cache.insert(model, tokens, prompt_cache)
+
+    def _release(self, entry):
+        # The keys and values of an entry are freed once neither the cache
+        # nor an entry extending it refer to them
+        while entry is not None:
+            entry.refs -= 1
+            if entry.refs > 0:
                 break
-            del d_prev[t]
+            self.nbytes -= entry.nbytes
+            entry = entry.prefix
 
-    def _extract(self, model, tokens):
-        cache_entry = self._get(model, tokens)
-        if cache_entry.count == 1:
-            self._delete(model, tokens)
-            self._lru.remove((model, tokens))
-            return cache_entry
-
-        cache_entry.count -= 1
-        return self.CacheEntry(
-            copy.deepcopy(cache_entry.prompt_cache),
-            1,
+    def _touch(self, node):
+        entry = node.entry
+        entry.priority = self._clock + entry.frequency * entry.cost / max(
+            entry.nbytes, 1
         )
+        self._seq += 1
+        node.seq = self._seq
+        heapq.heappush(self._heap, (entry.priority, node.seq, node))
+        self._lru[node] = None
+        self._lru.move_to_end(node)
+
+        # Drop stale heap records
+        if len(self._heap) > 2 * len(self._lru) + 64:
+            self._heap = [(n.entry.priority, n.seq, n) for n in self._lru]
+            heapq.heapify(self._heap)
+
+    def _evict(self):
+        def over_budget():
+            if len(self._lru) > self.max_size:
+                return True
+            return self.max_bytes is not None and self.nbytes > self.max_bytes
+
+        while self._lru and over_budget():
+            priority, seq, node = heapq.heappop(self._heap)
+            if node.entry is None or node.seq != seq:
+                continue
+            self._clock = priority
+            if self.disk_cache is not None:
+                self._spill(node)
+            nbytes = self.nbytes
+            self._delete(node)
+            self.evictions += 1
+            self.evicted_bytes += nbytes - self.nbytes
+
+    def _extract(self, node):
+        cache_entry = node.entry
+        if self._is_segment(cache_entry.prompt_cache):
+            length = self._segment_length(cache_entry)
+            prompt_cache = self._fork(cache_entry, length)
+        elif cache_entry.count == 1:
+            prompt_cache = cache_entry.prompt_cache
+        else:
+            prompt_cache = copy.deepcopy(cache_entry.prompt_cache)
+
+        if cache_entry.count == 1:
+            self._delete(node)
+        else:
+            cache_entry.count -= 1
+            cache_entry.frequency += 1
+            self._touch(node)
+
+        return self.CacheEntry(prompt_cache, 1)
 
     def fetch_nearest_cache(self, model, tokens):
         result = self._search(model, tokens)
+        if self.disk_cache is not None and result.exact is None:
+            if result.shorter is not None:
+                matched = result.shorter.depth
+            elif result.longer is not None:
+                matched = min(len(tokens) - 1, result.common_prefix)
+            else:
+                matched = 0
+            prompt_cache, rest = self.disk_cache.fetch(model, tokens, matched + 1)
+            if prompt_cache is not None:
+                self.hits += 1
+                return prompt_cache, rest
+
         if result.exact is not None:
-            cache_entry = self._extract(result.model, result.exact)
+            self.hits += 1
+            cache_entry = self._extract(result.exact)
             return cache_entry.prompt_cache, []
 
         if result.shorter is not None:
-            cache_entry = self._extract(result.model, result.shorter)
-            prefix_len = len(result.shorter)
+            self.hits += 1
+            prefix_len = result.shorter.depth
+            cache_entry = self._extract(result.shorter)
             return cache_entry.prompt_cache, tokens[prefix_len:]
 
         if result.longer is not None:
-            cache_entry = self._get(result.model, result.longer)
+            cache_entry = result.longer.entry
             if can_trim_prompt_cache(cache_entry.prompt_cache):
-                cache_entry = self.CacheEntry(
-                    copy.deepcopy(cache_entry.prompt_cache),
-                    1,
-                )
                 prefix = min(len(tokens) - 1, result.common_prefix)
-                num_to_trim = len(result.longer) - prefix
-                trim_prompt_cache(cache_entry.prompt_cache, num_to_trim)
-                return cache_entry.prompt_cache, tokens[prefix:]
-
+                num_to_trim = result.longer.depth - prefix
+                if self._is_segment(cache_entry.prompt_cache):
+                    length = self._segment_length(cache_entry) - num_to_trim
+                    prompt_cache = self._fork(cache_entry, max(length, 0))
+                else:
+                    prompt_cache = copy.deepcopy(cache_entry.prompt_cache)
+                    trim_prompt_cache(prompt_cache, num_to_trim)
+                self.hits += 1
+                cache_entry.frequency += 1
+                self._touch(result.longer)
+                return prompt_cache, tokens[prefix:]
+
+        self.misses += 1
         return None, tokens
 
     def insert_cache(self, model, tokens, prompt_cache):
         if model not in self._cache:
-            self._cache[model] = {}
-        current = self._cache[model]
-        for tok in tokens:
-            if tok not in current:
-                current[tok] = {}
-            current = current[tok]
-
-        if "cache" in current:
-            current["cache"].count += 1
-            self._lru.remove((model, tokens))
+            self._cache[model] = self.Node([], 0)
+        node, child, index, last = self._walk(self._cache[model], tokens)
+        prefix = last.entry if last is not None and last.depth < len(tokens) else None
+
+        # Split the partially matched edge
+        if child is not None:
+            k = index - node.depth
+            middle = self.Node(child.tokens[:k], index, node)
+            middle.children[child.tokens[k]] = child
+            middle.nearest = child.nearest
+            child.tokens = child.tokens[k:]
+            child.parent = middle
+            node.children[middle.tokens[0]] = middle
+            node = middle
+
+        if index < len(tokens):
+            leaf = self.Node(tokens[index:], len(tokens), node)
+            node.children[tokens[index]] = leaf
+            node = leaf
+
+        if node.entry is not None:
+            entry = node.entry
+            entry.count += 1
+            entry.frequency += 1
         else:
-            current["cache"] = self.CacheEntry(prompt_cache, 1)
-
-        self._lru.append((model, tokens))
-        if len(self._lru) > self.max_size:
-            model, tokens = self._lru.popleft()
-            self._delete(model, tokens)
+            entry = self._make_entry(prefix, prompt_cache)
+            entry.cost = len(tokens)
+            node.entry = entry
+            self.nbytes += entry.nbytes
+            self._refresh(node)
+        self._touch(node)
+        self._evict()
 
 
 @dataclass
@@ -337,6 +860,8 @@ class GenerationArguments:
 
     max_tokens: int
     num_draft_tokens: int
+    prompt_lookup: bool
+    n: int
     logprobs: int
     seed: Optional[int]
 
@@ -360,11 +885,20 @@ class GenerationContext:
     eos_token_id: int
     stop_token_sequences: List[List[int]]
     prompt: List[int]
+    stop_matcher: StopMatcher
+
+    _stopped: set = field(default_factory=set)
+    _cancelled: bool = False
+
+    def stop(self, index: int = 0):
+        self._stopped.add(index)
 
-    _should_stop: bool = False
+    def cancel(self):
+        """Stop all the choices."""
+        self._cancelled = True
 
-    def stop(self):
-        self._should_stop = True
+    def should_stop(self, index: int = 0) -> bool:
+        return self._cancelled or index in self._stopped
 
 
 @dataclass
@@ -374,6 +908,24 @@ class Response:
     logprob: float
     finish_reason: Optional[str]
     top_tokens: Optional[Tuple[int, float]]
+    index: int = 0
+
+
+@dataclass
+class _Choice:
+    """The state of one choice of a completion while it is generated."""
+
+    text: str = ""
+    segment: str = ""
+    tokens: List[int] = field(default_factory=list)
+    token_logprobs: List[float] = field(default_factory=list)
+    top_tokens: List[Any] = field(default_factory=list)
+    in_tool_call: bool = False
+    tool_text: str = ""
+    tool_calls: List[str] = field(default_factory=list)
+    finish_reason: str = "length"
+    done: bool = False
+    stop_state: int = 0
 
 
 class ModelProvider:
@@ -392,6 +944,16 @@ class ModelProvider:
             self.default_model_map[self.cli_args.model] = "default_model"
             self.load(self.cli_args.model, draft_model_path="default_model")
 
+    def loaded_tokenizer(self, model: ModelDescription):
+        """
+        The tokenizer of the model if it is the loaded one, ``None``
+        otherwise.
+        """
+        tokenizer = self.tokenizer
+        model_path = self.default_model_map.get(model.model, model.model)
+        if self.model_key == (model_path, model.adapter, model.draft):
+            return tokenizer
+
     # Added in adapter_path to load dynamically
     def load(self, model_path, adapter_path=None, draft_model_path=None):
         model_path = self.default_model_map.get(model_path, model_path)
@@ -458,28 +1020,227 @@ class ModelProvider:
 
         # Figure out the cache types and save them in a set for anybody that
         # wants to make a decision based on those.
-        for c in make_prompt_cache(self.model):
-            self.cache_types.add(type(c))
-        if self.draft_model is not None:
-            for c in make_prompt_cache(self.draft_model):
+        def add_cache_types(cache):
+            for c in cache:
                 self.cache_types.add(type(c))
+                if isinstance(c, CacheList):
+                    add_cache_types(c.caches)
+
+        add_cache_types(make_prompt_cache(self.model))
+        if self.draft_model is not None:
+            add_cache_types(make_prompt_cache(self.draft_model))
 
         return self.model, self.tokenizer
 
 
+class _ResponseWriter:
+    """
+    Turns the tokens generated by a batch into responses on its own thread.
+
+    The generation thread hands over one record with the uids, tokens, log
+    probabilities and finish reasons of a whole decoding step. The
+    detokenization and the per-request responses are done here, off the
+    critical path between two steps.
+    """
+
+    def __init__(self):
+        self._records = Queue()
+        self._sequences = {}
+        self._thread = Thread(target=self._run)
+        self._thread.start()
+
+    def add(self, uid: int, rqueue: Any, detokenizer: Any, index: int):
+        """Start writing the responses of the sequence ``uid`` to ``rqueue``."""
+        self._records.put(("add", uid, rqueue, detokenizer, index))
+
+    def step(
+        self,
+        uids: List[int],
+        tokens: List[int],
+        logprobs: List[float],
+        finish_reasons: List[Optional[str]],
+        top_tokens: List[Any],
+    ):
+        """Write the tokens of a decoding step, one per sequence."""
+        self._records.put(("step", uids, tokens, logprobs, finish_reasons, top_tokens))
+
+    def remove(self, uids: List[int]):
+        """End the given sequences without a finish reason."""
+        self._records.put(("remove", uids))
+
+    def close(self):
+        self._records.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while (record := self._records.get()) is not None:
+            try:
+                self._write(record)
+            except Exception:
+                # Keep serving the other sequences
+                logging.exception("Error while writing the responses")
+
+    def _write(self, record):
+        sequences = self._sequences
+        if record[0] == "add":
+            _, uid, *sequence = record
+            sequences[uid] = sequence
+        elif record[0] == "remove":
+            # Sequences which finished in the same step are already ended
+            for uid in record[1]:
+                if (sequence := sequences.pop(uid, None)) is not None:
+                    sequence[0].put(None)
+        else:
+            for uid, token, logprob, finish_reason, top_tokens in zip(*record[1:]):
+                # A failed sequence gets tokens until it is removed
+                if uid not in sequences:
+                    continue
+                rqueue, detokenizer, index = sequences[uid]
+                try:
+                    detokenizer.add_token(token)
+                    response = Response(
+                        detokenizer.last_segment,
+                        token,
+                        logprob,
+                        finish_reason,
+                        top_tokens,
+                        index,
+                    )
+                except Exception as e:
+                    # The request fails and the other sequences go on
+                    del sequences[uid]
+                    rqueue.put(e)
+                    continue
+                rqueue.put(response)
+                if finish_reason is not None:
+                    rqueue.put(None)
+                    del sequences[uid]
+
+
+class _AsyncResponseQueue:
+    """
+    The response queue of a request served from an asyncio event loop. The
+    generation thread puts the responses and the event loop gets them.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._queue = asyncio.Queue()
+
+    def put(self, item):
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        except RuntimeError:
+            # The event loop is closed
+            pass
+
+    async def get(self):
+        return await self._queue.get()
+
+    async def get_all(self) -> List[Any]:
+        """
+        Wait for an item and return it with all the other pending items.
+        """
+        items = [await self._queue.get()]
+        while not self._queue.empty():
+            items.append(self._queue.get_nowait())
+        return items
+
+
 class ResponseGenerator:
     def __init__(self, model_provider: ModelProvider, prompt_cache: LRUPromptCache):
         self.model_provider = model_provider
         self.prompt_cache = prompt_cache
         self.requests = Queue()
 
+        # Requests are templated and tokenized by these workers so that the
+        # generation thread only runs the models
+        self._preparation_pool = ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="prepare"
+        )
+
+        self._response_writer = _ResponseWriter()
+
+        # The compiled decoding step of the last model, only used by the
+        # generation thread
+        self._compiled_model = None
+        self._compiled_decode = None
+
+        # Signals the generation thread that requests were cancelled
+        self._cancelled = Queue()
+
         self._stop = False
         self._generation_thread = Thread(target=self._generate)
         self._generation_thread.start()
 
     def stop_and_join(self):
+        self._preparation_pool.shutdown()
         self._stop = True
         self._generation_thread.join()
+        self._response_writer.close()
+
+    def cancel(self, ctx: GenerationContext):
+        """
+        Stop generating the response to a request, for instance because its
+        client disconnected.
+
+        The choices of a batched request are removed from the batch before
+        its next step even if they are still waiting to be processed, so the
+        memory and the place in the batch go to the other requests.
+        """
+        ctx.cancel()
+        self._cancelled.put(ctx)
+
+    def _compiled_step(self, model):
+        """
+        The compiled decoding step of ``model`` if ``--compile-decode`` is
+        set. The model is traced once rather than for every request or batch.
+        """
+        if not self.cli_args.compile_decode:
+            return None
+        if self._compiled_model is not model:
+            self._compiled_model = model
+            self._compiled_decode = _CompiledStep(model)
+        return self._compiled_decode
+
+    def _prepare(self, rqueue, request, args):
+        """
+        Make the generation context of a request on a worker thread with the
+        tokenizer of the loaded model and queue the request for generation.
+        """
+        prepared = None
+        try:
+            tokenizer = self.model_provider.loaded_tokenizer(args.model)
+            if tokenizer is not None:
+                prepared = (tokenizer, self._make_context(tokenizer, request, args))
+        except Exception as e:
+            rqueue.put(e)
+            return
+        self.requests.put((rqueue, request, args, prepared))
+
+    def _context(self, tokenizer, request, args, prepared):
+        """
+        The prepared generation context of a request or a new one if the
+        request was prepared for another model.
+        """
+        if prepared is not None and prepared[0] is tokenizer:
+            return prepared[1]
+        return self._make_context(tokenizer, request, args)
+
+    def _make_context(self, tokenizer, request, args):
+        stop_token_sequences = [
+            tokenizer.encode(stop_word, add_special_tokens=False)
+            for stop_word in args.stop_words
+        ]
+        return GenerationContext(
+            has_tool_calling=tokenizer.has_tool_calling,
+            tool_call_start=tokenizer.tool_call_start,
+            tool_call_end=tokenizer.tool_call_end,
+            eos_token_id=tokenizer.eos_token_id,
+            stop_token_sequences=stop_token_sequences,
+            prompt=self._tokenize(tokenizer, request),
+            stop_matcher=StopMatcher(stop_token_sequences, args.stop_words),
+        )
 
     def _tokenize(self, tokenizer, request):
         if request.request_type == "chat":
@@ -501,29 +1262,72 @@ class ResponseGenerator:
         else:
             return tokenizer.encode(request.prompt)
 
+    def _use_prompt_lookup(self, args):
+        # The rejected draft tokens are trimmed from the cache which only
+        # full attention KV caches can always do
+        return args.prompt_lookup and all(
+            c is KVCache for c in self.model_provider.cache_types
+        )
+
     def _is_batchable(self, args):
-        if (
+        has_draft = (
             args.model.draft != "default_model"
             or self.model_provider.cli_args.draft_model is not None
-        ):
+            or self.model_provider.draft_model is not None
+        )
+        if has_draft and args.num_draft_tokens == 0:
+            return False
+        # Prompt lookup decoding is only supported for single requests
+        if self._use_prompt_lookup(args) and not has_draft:
             return False
         for c in self.model_provider.cache_types:
-            if c not in (KVCache, RotatingKVCache):
+            if c not in (KVCache, RotatingKVCache, CacheList) and not issubclass(
+                c, ArraysCache
+            ):
                 return False
-        if args.logits.logit_bias is not None:
-            return False
-        if args.logits.repetition_penalty != 0:
-            return False
-        if args.logprobs > 0:
+            # Speculative decoding needs to rewind the caches which is not
+            # possible once a rotating cache is full or for recurrent states
+            if has_draft and c is not KVCache:
+                return False
+        # The draft tokens are not passed through the logits processors
+        if has_draft and self._logits_params(args) is not None:
             return False
         if args.seed is not None:
             return False
 
         return True
 
+    def _sampling_params(self, args):
+        """
+        The sampling parameters of a request in a batch. Requests using XTC
+        return ``None`` and are sampled with the sampler of the batch.
+        """
+        if args.sampling.xtc_probability > 0:
+            return None
+        return {
+            "temp": args.sampling.temperature,
+            "top_p": args.sampling.top_p,
+            "min_p": args.sampling.min_p,
+            "top_k": args.sampling.top_k,
+        }
+
+    def _logits_params(self, args):
+        """
+        The logits processing parameters of a request in a batch or ``None``
+        if it doesn't need any.
+        """
+        if args.logits.logit_bias is None and args.logits.repetition_penalty == 0:
+            return None
+        return {
+            "logit_bias": args.logits.logit_bias,
+            "repetition_penalty": args.logits.repetition_penalty,
+            "repetition_context_size": args.logits.repetition_context_size,
+        }
+
     def _generate(self):
         current_model = None
         current_sampling = None
+        current_num_draft_tokens = None
         current_tokenizer = None
         current_model_key = None
         batch_generator = None
@@ -549,6 +1353,22 @@ class ResponseGenerator:
                 if uid in batch_results:
                     batch_results[uid]["rqueue"].put((min(processed, total), total))
 
+        def remove_cancelled():
+            if self._cancelled.empty():
+                return
+            while not self._cancelled.empty():
+                self._cancelled.get_nowait()
+            uids = [
+                uid
+                for uid, result in batch_results.items()
+                if result["ctx"].should_stop(result["index"])
+            ]
+            if uids:
+                batch_generator.remove(uids)
+                self._response_writer.remove(uids)
+                for uid in uids:
+                    del batch_results[uid]
+
         while not self._stop:
             request = None
             if not drain_batch:
@@ -557,7 +1377,7 @@ class ResponseGenerator:
 
             # We got a request
             if request is not None:
-                rqueue, request, args = request
+                rqueue, request, args, prepared = request
 
                 is_batchable = self._is_batchable(args)
 
@@ -565,21 +1385,21 @@ class ResponseGenerator:
                 if (
                     batch_generator is not None
                     and current_model == args.model
-                    and current_sampling == args.sampling
+                    and (
+                        current_sampling == args.sampling
+                        or (
+                            current_sampling.xtc_probability == 0
+                            and args.sampling.xtc_probability == 0
+                        )
+                    )
+                    and (
+                        self.model_provider.draft_model is None
+                        or current_num_draft_tokens == args.num_draft_tokens
+                    )
                     and is_batchable
                 ):
-                    prompt = self._tokenize(current_tokenizer, request)
-                    ctx = GenerationContext(
-                        has_tool_calling=tokenizer.has_tool_calling,
-                        tool_call_start=tokenizer.tool_call_start,
-                        tool_call_end=tokenizer.tool_call_end,
-                        eos_token_id=tokenizer.eos_token_id,
-                        stop_token_sequences=[
-                            tokenizer.encode(stop_word, add_special_tokens=False)
-                            for stop_word in args.stop_words
-                        ],
-                        prompt=prompt,
-                    )
+                    ctx = self._context(current_tokenizer, request, args, prepared)
+                    prompt = ctx.prompt
                     rqueue.put(ctx)
 
                     cache, rest = self.prompt_cache.fetch_nearest_cache(
@@ -587,22 +1407,35 @@ class ResponseGenerator:
                     )
                     if cache is None:
                         cache = make_prompt_cache(self.model_provider.model)
-
-                    (uid,) = batch_generator.insert(
-                        [rest], args.max_tokens, caches=[cache]
+                        if self.model_provider.draft_model is not None:
+                            cache += make_prompt_cache(self.model_provider.draft_model)
+
+                    # The prompt is processed once for all the choices
+                    uids = batch_generator.insert(
+                        [rest],
+                        args.max_tokens,
+                        caches=[cache],
+                        sampling=[self._sampling_params(args)],
+                        logits_params=[self._logits_params(args)],
+                        num_samples=args.n,
                     )
-                    batch_results[uid] = {
-                        "ctx": ctx,
-                        "cache_key": prompt[:],
-                        "rqueue": rqueue,
-                        "detokenizer": tokenizer.detokenizer,
-                    }
+                    for index, uid in enumerate(uids):
+                        batch_results[uid] = {
+                            "ctx": ctx,
+                            "index": index,
+                            "cache_key": prompt[:],
+                            "rqueue": rqueue,
+                            "logprobs": args.logprobs,
+                        }
+                        self._response_writer.add(
+                            uid, rqueue, tokenizer.detokenizer, index
+                        )
                     continue
 
                 # We have no batch and it actually is not a batchable request
                 # so serve single sequence at a time.
                 elif batch_generator is None and not is_batchable:
-                    self._serve_single((rqueue, request, args))
+                    self._serve_single((rqueue, request, args, prepared))
                     continue
 
                 # No batch so make one and serve this batched
@@ -617,6 +1450,7 @@ class ResponseGenerator:
 
                     current_model = args.model
                     current_sampling = args.sampling
+                    current_num_draft_tokens = args.num_draft_tokens
                     current_tokenizer = tokenizer
                     current_model_key = self.model_provider.model_key
                     batch_results = {}
@@ -636,15 +1470,21 @@ class ResponseGenerator:
                             ],
                         ),
                         prompt_progress_callback=progress_callback,
+                        prefill_token_budget=self.cli_args.prefill_token_budget,
+                        draft_model=self.model_provider.draft_model,
+                        num_draft_tokens=args.num_draft_tokens,
+                        compiled_step=self._compiled_step(model),
+                        kv_bits=self.cli_args.kv_bits,
+                        kv_group_size=self.cli_args.kv_group_size,
                     )
-                    unprocessed_requests.append((rqueue, request, args))
+                    unprocessed_requests.append((rqueue, request, args, prepared))
                     continue
 
                 # We have a batch but this request cannot be added to the
                 # batch so drain it to process the request.
                 else:
                     drain_batch = True
-                    unprocessed_requests.append((rqueue, request, args))
+                    unprocessed_requests.append((rqueue, request, args, prepared))
                     continue
 
             # No request so serve from the current batch
@@ -653,6 +1493,7 @@ class ResponseGenerator:
                     if drain_batch:
                         current_model = None
                         current_sampling = None
+                        current_num_draft_tokens = None
                         current_tokenizer = None
                         current_model_key = None
                         batch_generator.close()
@@ -667,51 +1508,50 @@ class ResponseGenerator:
                     if time.time() - start > time_budget:
                         break
 
+                    remove_cancelled()
                     responses = batch_generator.next()
                     if not responses:
                         break
 
+                    # Hand the whole step over to the response writer
+                    logprobs = [r.logprobs for r in responses]
+                    tokens = [r.token for r in responses]
+                    token_logprobs = mx.take_along_axis(
+                        mx.stack(logprobs), mx.array(tokens)[:, None], axis=-1
+                    )
+                    top_tokens = _top_logprobs(
+                        logprobs,
+                        [batch_results[r.uid]["logprobs"] for r in responses],
+                    )
+                    self._response_writer.step(
+                        [r.uid for r in responses],
+                        tokens,
+                        token_logprobs[:, 0].tolist(),
+                        [r.finish_reason for r in responses],
+                        top_tokens,
+                    )
+
                     for r in responses:
                         result = batch_results[r.uid]
                         result["cache_key"].append(r.token)
-                        result["detokenizer"].add_token(r.token)
-
-                        top_tokens = None
-                        if args.logprobs > 0:
-                            sorted_indices = mx.argpartition(
-                                -gen.logprobs, kth=args.logprobs - 1
-                            )
-                            top_indices = sorted_indices[: args.logprobs]
-                            top_logprobs = gen.logprobs[top_indices]
-                            top_token_info = zip(
-                                top_indices.tolist(), top_logprobs.tolist()
-                            )
-                            top_tokens = tuple(top_token_info)
-                        result["rqueue"].put(
-                            Response(
-                                result["detokenizer"].last_segment,
-                                r.token,
-                                r.logprobs[r.token].item(),
-                                r.finish_reason,
-                                top_tokens,
-                            )
-                        )
 
                         if r.finish_reason is not None:
-                            result["rqueue"].put(None)
                             self.prompt_cache.insert_cache(
                                 current_model_key, result["cache_key"], r.prompt_cache
                             )
                             del batch_results[r.uid]
 
-                        if result["ctx"]._should_stop:
+                        elif result["ctx"].should_stop(result["index"]):
                             uids_to_remove.append(r.uid)
+                            del batch_results[r.uid]
 
                     if uids_to_remove:
                         batch_generator.remove(uids_to_remove)
+                        self._response_writer.remove(uids_to_remove)
+                        uids_to_remove = []
 
     def _serve_single(self, request):
-        rqueue, request, args = request
+        rqueue, request, args, prepared = request
 
         # Define the progress callback
         def progress(tokens_processed, tokens_total):
@@ -724,21 +1564,9 @@ class ResponseGenerator:
             )
             draft_model = self.model_provider.draft_model
 
-            # Prepare the prompt
-            prompt = self._tokenize(tokenizer, request)
-
             # Start the generation context
-            ctx = GenerationContext(
-                has_tool_calling=tokenizer.has_tool_calling,
-                tool_call_start=tokenizer.tool_call_start,
-                tool_call_end=tokenizer.tool_call_end,
-                eos_token_id=tokenizer.eos_token_id,
-                stop_token_sequences=[
-                    tokenizer.encode(stop_word, add_special_tokens=False)
-                    for stop_word in args.stop_words
-                ],
-                prompt=prompt,
-            )
+            ctx = self._context(tokenizer, request, args, prepared)
+            prompt = ctx.prompt
             rqueue.put(ctx)
 
             # Seed if requested
@@ -764,59 +1592,68 @@ class ResponseGenerator:
                 args.logits.repetition_context_size,
             )
 
-            # Load the KV cache
-            cache, rest = self.prompt_cache.fetch_nearest_cache(
-                self.model_provider.model_key, prompt
-            )
-            cache_key = prompt[:]
-            if cache is None:
-                cache = make_prompt_cache(self.model_provider.model)
-                if self.model_provider.draft_model is not None:
-                    cache += make_prompt_cache(self.model_provider.draft_model)
-
-            # Process the prompt and generate tokens
-            for gen in stream_generate(
-                model=model,
-                tokenizer=tokenizer,
-                prompt=rest,
-                max_tokens=args.max_tokens,
-                sampler=sampler,
-                logits_processors=logits_processors,
-                prompt_cache=cache,
-                draft_model=draft_model,
-                num_draft_tokens=args.num_draft_tokens,
-                prompt_progress_callback=progress,
-            ):
-                top_tokens = None
-                if args.logprobs > 0:
-                    sorted_indices = mx.argpartition(
-                        -gen.logprobs, kth=args.logprobs - 1
-                    )
-                    top_indices = sorted_indices[: args.logprobs]
-                    top_logprobs = gen.logprobs[top_indices]
-                    top_token_info = zip(top_indices.tolist(), top_logprobs.tolist())
-                    top_tokens = tuple(top_token_info)
-
-                rqueue.put(
-                    Response(
-                        gen.text,
-                        gen.token,
-                        gen.logprobs[gen.token].item(),
-                        gen.finish_reason,
-                        top_tokens,
-                    )
+            for index in range(args.n):
+                # Load the KV cache, the choices after the first one reuse the
+                # cached prompt
+                cache, rest = self.prompt_cache.fetch_nearest_cache(
+                    self.model_provider.model_key, prompt
                 )
-                cache_key.append(gen.token)
+                cache_key = prompt[:]
+                if cache is None:
+                    cache = make_prompt_cache(self.model_provider.model)
+                    if self.model_provider.draft_model is not None:
+                        cache += make_prompt_cache(self.model_provider.draft_model)
+
+                # Process the prompt and generate tokens
+                for gen in stream_generate(
+                    model=model,
+                    tokenizer=tokenizer,
+                    prompt=rest,
+                    max_tokens=args.max_tokens,
+                    sampler=sampler,
+                    logits_processors=logits_processors,
+                    prompt_cache=cache,
+                    draft_model=draft_model,
+                    num_draft_tokens=args.num_draft_tokens,
+                    prompt_lookup=self._use_prompt_lookup(args) and draft_model is None,
+                    prompt_progress_callback=progress,
+                    compiled_step=self._compiled_step(model),
+                    kv_bits=self.cli_args.kv_bits,
+                    kv_group_size=self.cli_args.kv_group_size,
+                ):
+                    top_tokens = None
+                    if args.logprobs > 0:
+                        sorted_indices = mx.argpartition(
+                            -gen.logprobs, kth=args.logprobs - 1
+                        )
+                        top_indices = sorted_indices[: args.logprobs]
+                        top_logprobs = gen.logprobs[top_indices]
+                        top_token_info = zip(
+                            top_indices.tolist(), top_logprobs.tolist()
+                        )
+                        top_tokens = tuple(top_token_info)
+
+                    rqueue.put(
+                        Response(
+                            gen.text,
+                            gen.token,
+                            gen.logprobs[gen.token].item(),
+                            gen.finish_reason,
+                            top_tokens,
+                            index,
+                        )
+                    )
+                    cache_key.append(gen.token)
 
-                if ctx._should_stop:
-                    break
+                    if ctx.should_stop(index):
+                        break
 
-            rqueue.put(None)
+                rqueue.put(None)
 
-            # Save the KV cache again
-            self.prompt_cache.insert_cache(
-                self.model_provider.model_key, cache_key, cache
-            )
+                # Save the KV cache again
+                self.prompt_cache.insert_cache(
+                    self.model_provider.model_key, cache_key, cache
+                )
 
         except Exception as e:
             rqueue.put(e)
@@ -828,13 +1665,18 @@ class ResponseGenerator:
         progress_callback: Optional[Callable[[int, int], None]] = None,
     ):
         response_queue = Queue()
-        self.requests.put((response_queue, request, generation_args))
+        self._preparation_pool.submit(
+            self._prepare, response_queue, request, generation_args
+        )
 
         def _inner():
-            while True:
+            # Every choice ends with a None
+            num_finished = 0
+            while num_finished < generation_args.n:
                 response = response_queue.get()
                 if response is None:
-                    break
+                    num_finished += 1
+                    continue
                 if isinstance(response, Exception):
                     raise response
                 if isinstance(response, tuple):
@@ -849,6 +1691,48 @@ class ResponseGenerator:
 
         return ctx, _inner()
 
+    async def generate_async(
+        self,
+        request: CompletionRequest,
+        generation_args: GenerationArguments,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+    ):
+        """
+        Same as :meth:`generate` from an asyncio event loop.
+
+        The responses are yielded in lists of all the responses available at
+        once so a client which reads slowly gets fewer and larger writes
+        rather than holding back the generation.
+        """
+        response_queue = _AsyncResponseQueue(asyncio.get_running_loop())
+        self._preparation_pool.submit(
+            self._prepare, response_queue, request, generation_args
+        )
+
+        async def _inner():
+            # Every choice ends with a None
+            num_finished = 0
+            while num_finished < generation_args.n:
+                responses = []
+                for response in await response_queue.get_all():
+                    if response is None:
+                        num_finished += 1
+                        continue
+                    if isinstance(response, Exception):
+                        raise response
+                    if isinstance(response, tuple):
+                        if progress_callback is not None:
+                            progress_callback(*response)
+                        continue
+                    responses.append(response)
+                yield responses
+
+        ctx = await response_queue.get()
+        if isinstance(ctx, Exception):
+            raise ctx
+
+        return ctx, _inner()
+
     @property
     def cli_args(self):
         return self.model_provider.cli_args
@@ -933,6 +1817,9 @@ class APIHandler(BaseHTTPRequestHandler):
         self.num_draft_tokens = self.body.get(
             "num_draft_tokens", self.response_generator.cli_args.num_draft_tokens
         )
+        self.prompt_lookup = self.body.get(
+            "prompt_lookup", self.response_generator.cli_args.prompt_lookup
+        )
         self.adapter = self.body.get("adapters", None)
         self.max_tokens = self.body.get("max_completion_tokens", None)
         if self.max_tokens is None:
@@ -951,6 +1838,7 @@ class APIHandler(BaseHTTPRequestHandler):
         self.xtc_threshold = self.body.get("xtc_threshold", 0.0)
         self.logit_bias = self.body.get("logit_bias", None)
         self.logprobs = self.body.get("logprobs", -1)
+        self.n = self.body.get("n", 1)
         self.seed = self.body.get("seed", None)
         self.validate_model_parameters()
 
@@ -988,6 +1876,12 @@ class APIHandler(BaseHTTPRequestHandler):
         if not isinstance(self.num_draft_tokens, int) or self.num_draft_tokens < 0:
             raise ValueError("num_draft_tokens must be a non-negative integer")
 
+        if not isinstance(self.prompt_lookup, bool):
+            raise ValueError("prompt_lookup must be a boolean")
+
+        if not isinstance(self.n, int) or self.n < 1:
+            raise ValueError("n must be a positive integer")
+
         if (
             not isinstance(self.repetition_penalty, (float, int))
             or self.repetition_penalty < 0
@@ -1039,6 +1933,7 @@ class APIHandler(BaseHTTPRequestHandler):
         top_tokens: Optional[List[Dict[int, float]]] = None,
         tokens: Optional[List[int]] = None,
         tool_calls: Optional[List[str]] = None,
+        index: int = 0,
     ) -> dict:
         """
         Generate a single response packet based on response type (stream or
@@ -1058,6 +1953,7 @@ class APIHandler(BaseHTTPRequestHandler):
               tokens to logprobs for the top N tokens at each token position.
             tokens (Optional[List[int]]): List of tokens to return with logprobs structure
             tool_calls (Optional[List[str]]): List of tool calls.
+            index (int): The index of the choice.
 
         Returns:
             dict: A dictionary containing the response, in the same format as
@@ -1087,7 +1983,7 @@ class APIHandler(BaseHTTPRequestHandler):
             "created": self.created,
             "choices": [
                 {
-                    "index": 0,
+                    "index": index,
                     "finish_reason": finish_reason,
                 },
             ],
@@ -1141,7 +2037,64 @@ class APIHandler(BaseHTTPRequestHandler):
             stop_words (List[str]): A list of stop words passed to the
                 stopping_criteria function
         """
-        args = GenerationArguments(
+        args = self.generation_arguments(stop_words)
+
+        # Create the token generator
+        try:
+            ctx, response = self.response_generator.generate(
+                request,
+                args,
+                progress_callback=self.keepalive_callback,
+            )
+        except Exception as e:
+            self._set_completion_headers(404)
+            self.end_headers()
+            self.wfile.write((f"{e}").encode())
+            return
+
+        # Cancel the request as soon as the client is gone
+        done = Event()
+        Thread(target=self._watch_connection, args=(ctx, done), daemon=True).start()
+
+        # Process the generated tokens
+        try:
+            choices = self.start_completion()
+            for gen in response:
+                self.process_generation(ctx, gen, choices, stop_words)
+            self.finish_completion(ctx, choices)
+        except Exception:
+            # Stop generating the other choices too
+            self.response_generator.cancel(ctx)
+            raise
+        finally:
+            done.set()
+
+    def _watch_connection(self, ctx: GenerationContext, done: Event):
+        """
+        Cancel the request if the client closes the connection before
+        ``done`` is set.
+
+        The client sends nothing after the request so the connection becomes
+        readable only when it is closed.
+        """
+        while not done.is_set():
+            readable, _, _ = select.select([self.connection], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                closed = not self.connection.recv(1, socket.MSG_PEEK)
+            except OSError:
+                closed = True
+            if closed and not done.is_set():
+                logging.debug("Client disconnected, cancelling the request")
+                self.response_generator.cancel(ctx)
+            return
+
+    def generation_arguments(self, stop_words: List[str]) -> GenerationArguments:
+        """
+        The generation arguments of the request.
+        """
+        return GenerationArguments(
             model=ModelDescription(
                 model=self.requested_model,
                 draft=self.requested_draft_model,
@@ -1163,40 +2116,32 @@ class APIHandler(BaseHTTPRequestHandler):
             stop_words=stop_words,
             max_tokens=self.max_tokens,
             num_draft_tokens=self.num_draft_tokens,
+            prompt_lookup=self.prompt_lookup,
+            n=self.n,
             logprobs=self.logprobs,
             seed=self.seed,
         )
 
-        # Create keepalive callback to send SSE comments during long prompt processing
-        def keepalive_callback(processed_tokens, total_tokens):
-            logging.info(
-                f"Prompt processing progress: {processed_tokens}/{total_tokens}"
-            )
-            if self.stream:
-                try:
-                    # Send SSE comment for keepalive - invisible to clients but keeps connection alive
-                    self.wfile.write(
-                        f": keepalive {processed_tokens}/{total_tokens}\n\n".encode()
-                    )
-                    self.wfile.flush()
-                except (BrokenPipeError, ConnectionResetError, OSError):
-                    # Client disconnected, ignore
-                    pass
-
-        # Create the token generator
-        try:
-            ctx, response = self.response_generator.generate(
-                request,
-                args,
-                progress_callback=keepalive_callback,
-            )
-        except Exception as e:
-            self._set_completion_headers(404)
-            self.end_headers()
-            self.wfile.write((f"{e}").encode())
-            return
+    def keepalive_callback(self, processed_tokens: int, total_tokens: int):
+        """
+        Send SSE comments during long prompt processing.
+        """
+        logging.info(f"Prompt processing progress: {processed_tokens}/{total_tokens}")
+        if self.stream:
+            try:
+                # Send SSE comment for keepalive - invisible to clients but keeps connection alive
+                self.wfile.write(
+                    f": keepalive {processed_tokens}/{total_tokens}\n\n".encode()
+                )
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError, OSError):
+                # Client disconnected, ignore
+                pass
 
-        # Prepare the headers
+    def start_completion(self) -> List[_Choice]:
+        """
+        Send the response headers and return the state of each choice.
+        """
         if self.stream:
             self._set_stream_headers(200)
             self.end_headers()
@@ -1205,107 +2150,127 @@ class APIHandler(BaseHTTPRequestHandler):
             self._set_completion_headers(200)
             logging.debug("Starting completion:")
 
-        # Variables to save the tool calls in as they are being generated by
-        # the model.
-        in_tool_call = False
-        tool_calls = []
-        tool_text = ""
-
-        # Variables to save the generated tokens and the corresponding probs
-        tokens = []
-        token_logprobs = []
-        top_tokens = []
-
-        # Variables to save the generated text
-        text = ""
-        segment = ""
+        # The state of each choice as it is being generated by the model
+        return [_Choice() for _ in range(self.n)]
 
-        # Well finally save the reason for stopping
-        finish_reason = "length"
+    def process_generation(
+        self,
+        ctx: GenerationContext,
+        gen: Response,
+        choices: List[_Choice],
+        stop_words: List[str],
+    ):
+        """
+        Add a generated token to its choice and stream the new text if
+        requested.
+        """
+        logging.debug(gen.text)
+        choice = choices[gen.index]
+        if choice.done:
+            return
 
-        # Process the generated tokens
-        for gen in response:
-            logging.debug(gen.text)
-
-            # Gather the text in tool calling or text variables
-            if ctx.has_tool_calling and gen.text == ctx.tool_call_start:
-                in_tool_call = True
-            elif in_tool_call:
-                if gen.text == ctx.tool_call_end:
-                    tool_calls.append(tool_text)
-                    tool_text = ""
-                    in_tool_call = False
-                else:
-                    tool_text += gen.text
+        # Gather the text in tool calling or text variables
+        if ctx.has_tool_calling and gen.text == ctx.tool_call_start:
+            choice.in_tool_call = True
+        elif choice.in_tool_call:
+            if gen.text == ctx.tool_call_end:
+                choice.tool_calls.append(choice.tool_text)
+                choice.tool_text = ""
+                choice.in_tool_call = False
             else:
-                text += gen.text
-                segment += gen.text
-
-            # Save the token and its logprob
-            tokens.append(gen.token)
-            token_logprobs.append(gen.logprob)
-
-            # If requested save the k top logprobs
-            if gen.top_tokens is not None:
-                top_tokens.append(gen.top_tokens)
-
-            # Check if we should stop early
-            stop_condition = stopping_criteria(
-                tokens, ctx.stop_token_sequences, stop_words, ctx.eos_token_id
+                choice.tool_text += gen.text
+        else:
+            choice.text += gen.text
+            choice.segment += gen.text
+
+        # Save the token and its logprob
+        tokens = choice.tokens
+        tokens.append(gen.token)
+        choice.token_logprobs.append(gen.logprob)
+
+        # If requested save the k top logprobs
+        if gen.top_tokens is not None:
+            choice.top_tokens.append(gen.top_tokens)
+
+        # Check if we should stop early
+        choice.stop_state = ctx.stop_matcher.advance(choice.stop_state, gen.token)
+        if gen.token == ctx.eos_token_id:
+            stop_condition = StopCondition(
+                stop_met=True, trim_length=0, trim_text_length=0
             )
-            if stop_condition.stop_met:
-                finish_reason = "stop"
-                ctx.stop()
-                tokens = tokens[: len(tokens) - stop_condition.trim_length]
-                text = text[: len(text) - stop_condition.trim_text_length]
-                segment = ""
-                break
+        else:
+            stop_condition = ctx.stop_matcher.stop_condition(choice.stop_state)
+        if stop_condition.stop_met:
+            choice.finish_reason = "stop"
+            choice.done = True
+            ctx.stop(gen.index)
+            choice.tokens = tokens[: len(tokens) - stop_condition.trim_length]
+            choice.text = choice.text[
+                : len(choice.text) - stop_condition.trim_text_length
+            ]
+            choice.segment = ""
+            return
 
-            if self.stream and not in_tool_call:
-                # If the end of tokens overlaps with a stop sequence, generate new
-                # tokens until we know if the stop sequence is hit or not
-                if any(
-                    (
-                        sequence_overlap(tokens, sequence)
-                        for sequence in ctx.stop_token_sequences
-                    )
-                ):
-                    continue
-                elif segment or tool_calls:
-                    response = self.generate_response(
-                        segment, None, tool_calls=tool_calls
-                    )
-                    self.wfile.write(f"data: {json.dumps(response)}\n\n".encode())
-                    self.wfile.flush()
-                    segment = ""
-                    tool_calls = []
+        if self.stream and not choice.in_tool_call:
+            # If the end of tokens overlaps with a stop sequence, generate new
+            # tokens until we know if the stop sequence is hit or not
+            if ctx.stop_matcher.partial_match(choice.stop_state):
+                return
+            elif choice.segment or choice.tool_calls:
+                response = self.generate_response(
+                    choice.segment,
+                    None,
+                    tool_calls=choice.tool_calls,
+                    index=gen.index,
+                )
+                self.wfile.write(f"data: {json.dumps(response)}\n\n".encode())
+                self.wfile.flush()
+                choice.segment = ""
+                choice.tool_calls = []
 
-            if gen.finish_reason is not None:
-                finish_reason = gen.finish_reason
+        if gen.finish_reason is not None:
+            choice.finish_reason = gen.finish_reason
 
+    def finish_completion(self, ctx: GenerationContext, choices: List[_Choice]):
+        """
+        Send the end of the stream or the whole response.
+        """
+        completion_tokens = sum(len(choice.tokens) for choice in choices)
         if self.stream:
-            response = self.generate_response(
-                segment, finish_reason, tool_calls=tool_calls
-            )
-            self.wfile.write(f"data: {json.dumps(response)}\n\n".encode())
-            self.wfile.flush()
+            for index, choice in enumerate(choices):
+                response = self.generate_response(
+                    choice.segment,
+                    choice.finish_reason,
+                    tool_calls=choice.tool_calls,
+                    index=index,
+                )
+                self.wfile.write(f"data: {json.dumps(response)}\n\n".encode())
+                self.wfile.flush()
             if self.stream_options is not None and self.stream_options["include_usage"]:
-                response = self.completion_usage_response(len(ctx.prompt), len(tokens))
+                response = self.completion_usage_response(
+                    len(ctx.prompt), completion_tokens
+                )
                 self.wfile.write(f"data: {json.dumps(response)}\n\n".encode())
                 self.wfile.flush()
             self.wfile.write("data: [DONE]\n\n".encode())
             self.wfile.flush()
         else:
-            response = self.generate_response(
-                text,
-                finish_reason,
-                len(ctx.prompt),
-                len(tokens),
-                token_logprobs=token_logprobs,
-                top_tokens=top_tokens,
-                tokens=tokens,
-                tool_calls=tool_calls,
-            )
+            responses = [
+                self.generate_response(
+                    choice.text,
+                    choice.finish_reason,
+                    len(ctx.prompt),
+                    completion_tokens,
+                    token_logprobs=choice.token_logprobs,
+                    top_tokens=choice.top_tokens,
+                    tokens=choice.tokens,
+                    tool_calls=choice.tool_calls,
+                    index=index,
+                )
+                for index, choice in enumerate(choices)
+            ]
+            response = responses[0]
+            response["choices"] = [r["choices"][0] for r in responses]
             response_json = json.dumps(response).encode()
             indent = "\t"  # Backslashes can't be inside of f-strings
             logging.debug(f"Outgoing Response: {json.dumps(response, indent=indent)}")
@@ -1385,6 +2350,8 @@ class APIHandler(BaseHTTPRequestHandler):
             self.handle_models_request()
         elif self.path == "/health":
             self.handle_health_check()
+        elif self.path == "/stats":
+            self.handle_stats_request()
         else:
             self._set_completion_headers(404)
             self.end_headers()
@@ -1400,6 +2367,17 @@ class APIHandler(BaseHTTPRequestHandler):
         self.wfile.write('{"status": "ok"}'.encode())
         self.wfile.flush()
 
+    def handle_stats_request(self):
+        """
+        Handle a GET request for the /stats endpoint.
+        """
+        self._set_completion_headers(200)
+        self.end_headers()
+
+        response = {"prompt_cache": self.response_generator.prompt_cache.stats()}
+        self.wfile.write(json.dumps(response).encode())
+        self.wfile.flush()
+
     def handle_models_request(self):
         """
         Handle a GET request for the /v1/models endpoint.
@@ -1447,6 +2425,182 @@ class APIHandler(BaseHTTPRequestHandler):
         self.wfile.flush()
 
 
+class AsyncAPIHandler(APIHandler):
+    """
+    The request handler of :class:`AsyncAPIServer`.
+
+    The request is parsed and answered by the methods of :class:`APIHandler`
+    which write to an in-memory buffer. The server sends the buffer to the
+    client and completions are generated with :meth:`handle_completion_async`.
+    """
+
+    def __init__(
+        self,
+        response_generator: ResponseGenerator,
+        request_head: bytes,
+        client_address: Tuple[str, int],
+        system_fingerprint: Optional[str] = None,
+    ):
+        # The connection belongs to the server so the base handler which
+        # would serve it right away is not initialized
+        self.created = int(time.time())
+        self.response_generator = response_generator
+        self.system_fingerprint = system_fingerprint or get_system_fingerprint()
+        self.client_address = client_address
+        self.rfile = io.BytesIO(request_head)
+        self.wfile = io.BytesIO()
+        self.completion = None
+
+    def handle_completion(self, request: CompletionRequest, stop_words: List[str]):
+        # Generated by handle_completion_async once the request is parsed
+        self.completion = (request, stop_words)
+
+    async def flush(self, writer: asyncio.StreamWriter):
+        """
+        Send the buffered output and wait until the client has read enough of
+        it.
+        """
+        data = self.wfile.getvalue()
+        if data:
+            self.wfile.seek(0)
+            self.wfile.truncate()
+            writer.write(data)
+            await writer.drain()
+
+    async def handle_completion_async(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        """
+        Generate the response to the completion request of the handler and
+        send it to the client as it is generated. The request is cancelled as
+        soon as the client closes the connection.
+        """
+        request, stop_words = self.completion
+        args = self.generation_arguments(stop_words)
+
+        try:
+            ctx, response = await self.response_generator.generate_async(
+                request,
+                args,
+                progress_callback=self.keepalive_callback,
+            )
+        except Exception as e:
+            self._set_completion_headers(404)
+            self.end_headers()
+            self.wfile.write((f"{e}").encode())
+            await self.flush(writer)
+            return
+
+        async def watch_connection():
+            # The client sends nothing after the request so the end of the
+            # stream means that it is gone
+            try:
+                while await reader.read(1 << 12):
+                    pass
+            except ConnectionError:
+                pass
+            logging.debug("Client disconnected, cancelling the request")
+            self.response_generator.cancel(ctx)
+
+        watcher = asyncio.ensure_future(watch_connection())
+        choices = self.start_completion()
+        try:
+            await self.flush(writer)
+            async for responses in response:
+                for gen in responses:
+                    self.process_generation(ctx, gen, choices, stop_words)
+                await self.flush(writer)
+            self.finish_completion(ctx, choices)
+            await self.flush(writer)
+        except Exception:
+            # Stop generating for a client which is gone or a failed choice
+            self.response_generator.cancel(ctx)
+            raise
+        finally:
+            watcher.cancel()
+
+
+class AsyncAPIServer:
+    """
+    An HTTP server for the endpoints of :class:`APIHandler` which serves all
+    the connections from one asyncio event loop instead of a thread per
+    connection.
+    """
+
+    def __init__(
+        self,
+        response_generator: ResponseGenerator,
+        handler_class=AsyncAPIHandler,
+        system_fingerprint: Optional[str] = None,
+    ):
+        self.response_generator = response_generator
+        self.handler_class = handler_class
+        self.system_fingerprint = system_fingerprint or get_system_fingerprint()
+
+    async def handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        """
+        Serve one request and close the connection.
+        """
+        try:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                return
+
+            handler = self.handler_class(
+                self.response_generator,
+                head,
+                writer.get_extra_info("peername") or ("", 0),
+                system_fingerprint=self.system_fingerprint,
+            )
+            handler.raw_requestline = handler.rfile.readline(65537)
+            if handler.parse_request():
+                length = int(handler.headers.get("Content-Length", 0))
+                handler.rfile = io.BytesIO(await reader.readexactly(length))
+                method = getattr(handler, f"do_{handler.command}", None)
+                if method is None:
+                    handler.send_error(501, f"Unsupported method ({handler.command!r})")
+                else:
+                    # Handlers can tokenize prompts or read files so keep
+                    # them off the event loop
+                    await asyncio.to_thread(method)
+            await handler.flush(writer)
+            if handler.completion is not None:
+                await handler.handle_completion_async(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            logging.debug("Client disconnected")
+        except Exception:
+            logging.exception("Error while serving a request")
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def serve(self, host: str, port: int):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def _make_response_generator(model_provider: ModelProvider) -> ResponseGenerator:
+    cli_args = model_provider.cli_args
+    disk_cache = None
+    if cli_args.prompt_cache_dir is not None:
+        disk_cache = DiskPromptCache(
+            cli_args.prompt_cache_dir, cli_args.prompt_cache_disk_bytes
+        )
+    prompt_cache = LRUPromptCache(
+        max_size=cli_args.prompt_cache_size,
+        max_bytes=cli_args.prompt_cache_bytes,
+        disk_cache=disk_cache,
+    )
+    return ResponseGenerator(model_provider, prompt_cache)
+
+
 def run(
     host: str,
     port: int,
@@ -1455,7 +2609,7 @@ def run(
     handler_class=APIHandler,
 ):
     server_address = (host, port)
-    response_generator = ResponseGenerator(model_provider, LRUPromptCache())
+    response_generator = _make_response_generator(model_provider)
     infos = socket.getaddrinfo(
         *server_address, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE
     )
@@ -1477,6 +2631,24 @@ def run(
     httpd.serve_forever()
 
 
+def run_async(
+    host: str,
+    port: int,
+    model_provider: ModelProvider,
+    server_class=AsyncAPIServer,
+):
+    response_generator = _make_response_generator(model_provider)
+    server = server_class(
+        response_generator, system_fingerprint=get_system_fingerprint()
+    )
+    warnings.warn(
+        "mlx_lm.server is not recommended for production as "
+        "it only implements basic security checks."
+    )
+    logging.info(f"Starting asyncio httpd at {host} on port {port}...")
+    asyncio.run(server.serve(host, port))
+
+
 def main():
     parser = argparse.ArgumentParser(description="MLX Http Server.")
     parser.add_argument(
@@ -1513,6 +2685,12 @@ def main():
         help="Number of tokens to draft when using speculative decoding.",
         default=3,
     )
+    parser.add_argument(
+        "--prompt-lookup",
+        action="store_true",
+        help="Use prompt lookup decoding by default when no draft model is set. "
+        "Requests can override it with the prompt_lookup field.",
+    )
     parser.add_argument(
         "--trust-remote-code",
         action="store_true",
@@ -1573,13 +2751,70 @@ def main():
         help="""A JSON formatted string of arguments for the tokenizer's apply_chat_template, e.g. '{"enable_thinking":false}'""",
         default="{}",
     )
+    parser.add_argument(
+        "--prefill-token-budget",
+        type=int,
+        default=None,
+        help="Maximum number of prompt tokens to process between two decoding "
+        "steps of a batch (default: process prompts to completion)",
+    )
+    parser.add_argument(
+        "--compile-decode",
+        action="store_true",
+        help="Compile the decoding steps with mx.compile (models with a "
+        "KVCache only)",
+    )
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="Serve all the connections from one asyncio event loop instead "
+        "of a thread per connection",
+    )
+    parser.add_argument(
+        "--kv-bits",
+        type=int,
+        default=None,
+        help="Number of bits to quantize the KV cache to, batched requests "
+        "included (default: no quantization)",
+    )
+    parser.add_argument(
+        "--kv-group-size",
+        type=int,
+        default=64,
+        help="Group size for the KV cache quantization (default: 64)",
+    )
+    parser.add_argument(
+        "--prompt-cache-size",
+        type=int,
+        default=10,
+        help="Maximum number of prompt caches to keep (default: 10)",
+    )
+    parser.add_argument(
+        "--prompt-cache-bytes",
+        type=int,
+        default=None,
+        help="Maximum size in bytes of the cached prompts (default: no limit)",
+    )
+    parser.add_argument(
+        "--prompt-cache-dir",
+        type=str,
+        default=None,
+        help="Directory to save the prompt caches evicted from memory to",
+    )
+    parser.add_argument(
+        "--prompt-cache-disk-bytes",
+        type=int,
+        default=10 * 2**30,
+        help="Maximum size in bytes of --prompt-cache-dir (default: 10 GiB)",
+    )
     args = parser.parse_args()
 
     logging.basicConfig(
         level=getattr(logging, args.log_level.upper(), None),
         format="%(asctime)s - %(levelname)s - %(message)s",
     )
-    run(args.host, args.port, ModelProvider(args))
+    serve = run_async if args.asyncio else run
+    serve(args.host, args.port, ModelProvider(args))
 
 
 if __name__ == "__main__":
@@ -1,5 +1,6 @@
 # Copyright © 2024 Apple Inc.
 
+import copy
 import unittest
 from typing import List
 
@@ -8,10 +9,19 @@ import mlx.core as mx
 from mlx_lm.generate import (
     BatchGenerator,
     GenerationResponse,
+    _CompiledStep,
+    _DraftLength,
+    _PromptLookup,
+    beam_search,
     generate,
+    generate_step,
     stream_generate,
 )
-from mlx_lm.models.cache import RotatingKVCache
+from mlx_lm.models.cache import (
+    QuantizedKVCache,
+    RotatingKVCache,
+    make_prompt_cache,
+)
 from mlx_lm.sample_utils import make_logits_processors, make_sampler
 from mlx_lm.utils import load
 
@@ -112,6 +122,199 @@ class TestGenerate(unittest.TestCase):
         # from the target model, and last two should be drafts
         self.assertEqual(drafted, [True, True, False, True, True])
 
+    def test_speculative_prefill_last_token(self):
+        class Model:
+            def __init__(self, model):
+                self.model = model
+                self.layers = model.layers
+                self.lengths = []
+
+            def __call__(self, inputs, cache=None):
+                self.lengths.append(inputs.shape[1])
+                return self.model(inputs, cache=cache)
+
+        model = Model(self.model)
+        draft_model = Model(self.model)
+        prompt = self.tokenizer.encode("hello " * 10)
+        for _ in stream_generate(
+            model=model,
+            tokenizer=self.tokenizer,
+            prompt=prompt,
+            max_tokens=1,
+            draft_model=draft_model,
+            num_draft_tokens=2,
+            prefill_step_size=4,
+        ):
+            pass
+
+        # The prompt is processed in chunks and only the last token is left
+        # for the steps which compute the logits
+        n = len(prompt) - 1
+        chunks = [4] * (n // 4) + ([n % 4] if n % 4 else [])
+        self.assertEqual(draft_model.lengths, chunks + [1])
+        self.assertEqual(model.lengths, chunks + [2])
+
+    def test_adaptive_draft_length(self):
+        prompt = self.tokenizer.encode("hello")
+        expected = [
+            r.token
+            for r in stream_generate(self.model, self.tokenizer, prompt, max_tokens=16)
+        ]
+        # The draft model is the same so every draft token is accepted and
+        # the draft length grows
+        results = list(
+            stream_generate(
+                self.model,
+                self.tokenizer,
+                prompt,
+                max_tokens=16,
+                draft_model=self.model,
+                num_draft_tokens=2,
+                max_draft_tokens=6,
+            )
+        )
+        self.assertEqual([r.token for r in results], expected)
+        draft_lengths = [r.draft_stats.num_draft_tokens for r in results]
+        self.assertEqual(draft_lengths[0], 2)
+        self.assertEqual(max(draft_lengths), 6)
+        stats = results[-1].draft_stats
+        self.assertEqual(stats.accepted_tokens, stats.drafted_tokens)
+        self.assertEqual(stats.acceptance_rate, 1.0)
+
+        # The draft length shrinks when the draft tokens are rejected
+        draft_length = _DraftLength(4, max_draft_tokens=8)
+        for _ in range(5):
+            draft_length.update(draft_length.value, 0)
+        self.assertEqual(draft_length.value, 1)
+        for _ in range(10):
+            draft_length.update(draft_length.value, draft_length.value)
+        self.assertEqual(draft_length.value, 8)
+
+        # The initial draft length is within [1, max_draft_tokens]
+        draft_length = _DraftLength(0, max_draft_tokens=4)
+        self.assertEqual(draft_length.value, 1)
+        draft_length.update(1, 1)
+        self.assertGreater(draft_length.value, 1)
+        self.assertEqual(_DraftLength(6, max_draft_tokens=4).value, 4)
+        with self.assertRaises(ValueError):
+            _DraftLength(2, max_draft_tokens=0)
+
+        # Without max_draft_tokens the draft length is fixed
+        draft_length = _DraftLength(4)
+        draft_length.update(4, 0)
+        self.assertEqual(draft_length.value, 4)
+
+    def test_prompt_lookup(self):
+        prompt = self.tokenizer.encode("one two three four five one two three")
+        logits_processors = make_logits_processors(repetition_penalty=1.1)
+        for processors in [None, logits_processors]:
+            expected = [
+                r.token
+                for r in stream_generate(
+                    self.model,
+                    self.tokenizer,
+                    prompt,
+                    max_tokens=12,
+                    logits_processors=processors,
+                )
+            ]
+            prompt_cache = make_prompt_cache(self.model)
+            results = list(
+                stream_generate(
+                    self.model,
+                    self.tokenizer,
+                    prompt,
+                    max_tokens=12,
+                    logits_processors=processors,
+                    prompt_lookup=True,
+                    num_draft_tokens=4,
+                    prompt_cache=prompt_cache,
+                )
+            )
+            self.assertEqual([r.token for r in results], expected)
+            self.assertEqual(prompt_cache[0].offset, len(prompt) + len(expected) - 1)
+
+        # The prompt repeats so the continuation is drafted
+        lookup = _PromptLookup([1, 2, 3, 4, 5, 1, 2], ngram_size=2)
+        self.assertEqual(lookup.draft(2), [3, 4])
+        lookup.extend([7])
+        self.assertEqual(lookup.draft(2), [])
+        lookup.extend([1])
+        self.assertEqual(lookup.draft(3), [2, 7, 1])
+
+        with self.assertRaises(ValueError):
+            next(
+                stream_generate(
+                    self.model,
+                    self.tokenizer,
+                    prompt,
+                    draft_model=self.model,
+                    prompt_lookup=True,
+                )
+            )
+
+        # Rotating caches can't drop the rejected draft tokens once full
+        with self.assertRaises(ValueError):
+            next(
+                stream_generate(
+                    self.model,
+                    self.tokenizer,
+                    prompt,
+                    prompt_lookup=True,
+                    prompt_cache=[
+                        RotatingKVCache(max_size=4) for _ in self.model.layers
+                    ],
+                )
+            )
+
+    def test_compile_decode(self):
+        prompt = self.tokenizer.encode("hello")
+        expected = [
+            r.logprobs
+            for r in stream_generate(self.model, self.tokenizer, prompt, max_tokens=5)
+        ]
+        logprobs = [
+            r.logprobs
+            for r in stream_generate(
+                self.model, self.tokenizer, prompt, max_tokens=5, compile_decode=True
+            )
+        ]
+        self.assertEqual(len(logprobs), len(expected))
+        for lp, elp in zip(logprobs, expected):
+            self.assertTrue(mx.allclose(lp, elp, atol=1e-4))
+
+        # The compiled step is shared by the following generations
+        compiled_step = _CompiledStep(self.model)
+        for _ in range(2):
+            logprobs = [
+                r.logprobs
+                for r in stream_generate(
+                    self.model,
+                    self.tokenizer,
+                    prompt,
+                    max_tokens=5,
+                    compiled_step=compiled_step,
+                )
+            ]
+            for lp, elp in zip(logprobs, expected):
+                self.assertTrue(mx.allclose(lp, elp, atol=1e-4))
+
+        prompts = [prompt, self.tokenizer.encode("hello, how are you doing?")]
+        results = []
+        for kwargs in [{}, {"compile_decode": True}, {"compiled_step": compiled_step}]:
+            gen = BatchGenerator(self.model, stop_tokens=set(), **kwargs)
+            uids = gen.insert(prompts, max_tokens=5)
+            logprobs = {uid: [] for uid in uids}
+            while responses := gen.next():
+                for r in responses:
+                    logprobs[r.uid].append(r.logprobs)
+            results.append([logprobs[uid] for uid in uids])
+        for result in results[1:]:
+            for lps, elps in zip(result, results[0]):
+                self.assertEqual(len(lps), 5)
+                for lp, elp in zip(lps, elps):
+                    self.assertTrue(mx.allclose(lp, elp, atol=1e-4))
+
     def test_stream_generate_input_embeddings(self):
         sampler = make_sampler(temp=0.0)  # determinate sampler
 
@@ -305,6 +508,409 @@ class TestGenerate(unittest.TestCase):
             batch_tokens = batch_responses[uids[e]]
             self.assertEqual(tokens, batch_tokens)
 
+    def test_batch_paged_kv_cache(self):
+        prompts = [
+            "Write a story about Einstein",
+            "Hi",
+            "What time is it?",
+            "How tall is Mt Everest?",
+        ]
+        prompts = [
+            self.tokenizer.apply_chat_template(
+                [{"role": "user", "content": p}],
+                tokenize=True,
+                add_generation_prompt=True,
+            )
+            for p in prompts
+        ]
+
+        gen = BatchGenerator(
+            self.model,
+            stop_tokens=self.tokenizer.eos_token_ids,
+            prefill_batch_size=2,
+            prefill_step_size=8,
+            completion_batch_size=3,
+            kv_block_size=4,
+        )
+        num_toks = [2, 3, 4, 5]
+        uids = gen.insert(prompts, max_tokens=num_toks)
+        batch_responses = {uid: [] for uid in uids}
+        caches = {}
+        while responses := gen.next():
+            for r in responses:
+                batch_responses[r.uid].append(r.logprobs)
+                if r.finish_reason is not None:
+                    caches[r.uid] = r.prompt_cache
+
+        for e, prompt in enumerate(prompts):
+            for i, response in enumerate(
+                stream_generate(
+                    self.model,
+                    self.tokenizer,
+                    prompt,
+                    max_tokens=num_toks[e],
+                )
+            ):
+                batch_logprobs = batch_responses[uids[e]][i]
+                self.assertTrue(
+                    mx.allclose(batch_logprobs, response.logprobs, rtol=1e-4, atol=1e-4)
+                )
+
+        # Continue from the extracted caches
+        caches = [caches[uid] for uid in uids]
+        uids = gen.insert([[1, 2, 3], [4], [5, 6], [7, 8, 9, 10]], caches=caches)
+        batch_responses = {}
+        while responses := gen.next():
+            for r in responses:
+                batch_responses.setdefault(r.uid, r.logprobs)
+        self.assertEqual(len(batch_responses), len(uids))
+
+    def test_batch_quantized_kv_cache(self):
+        prompts = [
+            "Write a story about Einstein",
+            "Hi",
+            "What time is it?",
+            "How tall is Mt Everest?",
+        ]
+        prompts = [
+            self.tokenizer.apply_chat_template(
+                [{"role": "user", "content": p}],
+                tokenize=True,
+                add_generation_prompt=True,
+            )
+            for p in prompts
+        ]
+
+        def run(prompts, caches=None, **kwargs):
+            gen = BatchGenerator(
+                self.model,
+                stop_tokens=self.tokenizer.eos_token_ids,
+                max_tokens=3,
+                kv_bits=8,
+                kv_group_size=32,
+                **kwargs,
+            )
+            uids = gen.insert(prompts, caches=caches)
+            logprobs = {uid: [] for uid in uids}
+            caches = {}
+            while responses := gen.next():
+                for r in responses:
+                    logprobs[r.uid].append(r.logprobs)
+                    if r.finish_reason is not None:
+                        caches[r.uid] = r.prompt_cache
+            return [logprobs[uid] for uid in uids], [caches[uid] for uid in uids]
+
+        batch_logprobs, caches = run(
+            prompts, prefill_batch_size=2, completion_batch_size=3
+        )
+        self.assertIsInstance(caches[0][0], QuantizedKVCache)
+        for prompt, logprobs in zip(prompts, batch_logprobs):
+            (expected,), _ = run([prompt])
+            for lp, elp in zip(logprobs, expected):
+                self.assertTrue(mx.allclose(lp, elp, rtol=1e-4, atol=1e-4))
+
+        # Continue from the extracted quantized caches
+        batch_logprobs, _ = run([[1, 2, 3], [4], [5, 6], [7, 8, 9, 10]], caches)
+        self.assertEqual([len(lp) for lp in batch_logprobs], [3] * 4)
+
+        with self.assertRaises(ValueError):
+            BatchGenerator(self.model, kv_bits=8, kv_block_size=4)
+
+    def test_batch_interleaved_prefill(self):
+        prompts = [
+            "Hi",
+            "Write a story about Einstein",
+            "How tall is Mt Everest?",
+        ]
+        prompts = [
+            self.tokenizer.apply_chat_template(
+                [{"role": "user", "content": p}],
+                tokenize=True,
+                add_generation_prompt=True,
+            )
+            for p in prompts
+        ]
+
+        progress = []
+        gen = BatchGenerator(
+            self.model,
+            stop_tokens=self.tokenizer.eos_token_ids,
+            prefill_batch_size=1,
+            completion_batch_size=3,
+            prefill_token_budget=4,
+            prompt_progress_callback=lambda p: progress.append(p[0][1:]),
+        )
+        num_toks = [12, 6, 6]
+        uids = gen.insert(prompts[:1], max_tokens=num_toks[:1])
+        batch_responses = {uid: [] for uid in uids}
+        for r in gen.next():
+            batch_responses[r.uid].append(r.logprobs)
+
+        # The running completion gets a token for every chunk of the prompt
+        uids += gen.insert(prompts[1:], max_tokens=num_toks[1:])
+        batch_responses.update({uid: [] for uid in uids[1:]})
+        progress.clear()
+        for _ in range(3):
+            responses = gen.next()
+            self.assertEqual([r.uid for r in responses], [uids[0]])
+            batch_responses[uids[0]].append(responses[0].logprobs)
+        self.assertGreater(len(prompts[1]), 13)
+        self.assertEqual(progress, [(4 * (i + 1), len(prompts[1])) for i in range(3)])
+
+        while responses := gen.next():
+            for r in responses:
+                batch_responses[r.uid].append(r.logprobs)
+
+        for e, prompt in enumerate(prompts):
+            responses = list(
+                stream_generate(
+                    self.model, self.tokenizer, prompt, max_tokens=num_toks[e]
+                )
+            )
+            self.assertEqual(len(batch_responses[uids[e]]), len(responses))
+            for batch_logprobs, response in zip(batch_responses[uids[e]], responses):
+                self.assertTrue(
+                    mx.allclose(batch_logprobs, response.logprobs, rtol=1e-4, atol=1e-4)
+                )
+
+    def test_batch_remove_pending(self):
+        prompts = [
+            "Hi",
+            "Write a story about Einstein",
+            "How tall is Mt Everest?",
+            "What time is it?",
+        ]
+        prompts = [
+            self.tokenizer.apply_chat_template(
+                [{"role": "user", "content": p}],
+                tokenize=True,
+                add_generation_prompt=True,
+            )
+            for p in prompts
+        ]
+
+        gen = BatchGenerator(
+            self.model,
+            stop_tokens=self.tokenizer.eos_token_ids,
+            max_tokens=6,
+            prefill_batch_size=2,
+            completion_batch_size=4,
+            prefill_token_budget=8,
+        )
+        uids = gen.insert(prompts[:2])
+        batch_responses = {uid: [] for uid in uids}
+        for r in gen.next():
+            batch_responses[r.uid].append(r.logprobs)
+
+        # Two prompts are being processed and one is waiting
+        uids += gen.insert(prompts[1:])
+        for r in gen.next():
+            batch_responses[r.uid].append(r.logprobs)
+        prefill = gen.prefill_batch
+        (waiting,) = [p[0] for p in gen.unprocessed_prompts]
+        self.assertEqual(sorted(prefill.uids + [waiting]), uids[2:])
+
+        # Removed prompts stop being processed right away
+        longest = prefill.uids[prefill.lengths.index(max(prefill.lengths))]
+        removed = [uid for uid in prefill.uids if uid != longest]
+        gen.remove(removed + [waiting])
+        self.assertEqual(gen.prefill_batch.uids, [longest])
+        self.assertEqual(gen.prefill_batch.inputs.shape[0], 1)
+        self.assertEqual(gen.unprocessed_prompts, [])
+        gen.remove([longest])
+        self.assertIsNone(gen.prefill_batch)
+
+        uids += gen.insert(prompts[2:3])
+        batch_responses.update({uid: [] for uid in uids[2:]})
+        while responses := gen.next():
+            for r in responses:
+                batch_responses[r.uid].append(r.logprobs)
+        for uid in uids[2:5]:
+            self.assertEqual(batch_responses[uid], [])
+
+        for uid, prompt in [(uids[0], prompts[0]), (uids[5], prompts[2])]:
+            responses = list(
+                stream_generate(self.model, self.tokenizer, prompt, max_tokens=6)
+            )
+            self.assertEqual(len(batch_responses[uid]), len(responses))
+            for batch_logprobs, response in zip(batch_responses[uid], responses):
+                self.assertTrue(
+                    mx.allclose(batch_logprobs, response.logprobs, rtol=1e-4, atol=1e-4)
+                )
+
+    def test_batch_per_request_sampling(self):
+        prompts = [
+            "Write a story about Einstein",
+            "Hi",
+            "What time is it?",
+        ]
+        prompts = [
+            self.tokenizer.apply_chat_template(
+                [{"role": "user", "content": p}],
+                tokenize=True,
+                add_generation_prompt=True,
+            )
+            for p in prompts
+        ]
+
+        # Every sequence is effectively greedy but uses different parameters
+        sampling = [
+            {"temp": 0.0},
+            {"temp": 1.0, "top_k": 1},
+            None,
+        ]
+        gen = BatchGenerator(
+            self.model, stop_tokens=self.tokenizer.eos_token_ids, max_tokens=8
+        )
+        uids = gen.insert(prompts, sampling=sampling)
+        batch_tokens = {uid: [] for uid in uids}
+        while responses := gen.next():
+            for r in responses:
+                batch_tokens[r.uid].append(r.token)
+
+        for e, uid in enumerate(uids):
+            tokens = [
+                r.token
+                for r in stream_generate(
+                    self.model, self.tokenizer, prompts[e], max_tokens=8
+                )
+            ]
+            self.assertEqual(batch_tokens[uid], tokens)
+
+    def test_batch_logits_processors(self):
+        prompts = [
+            "Write a story about Einstein",
+            "Hi",
+            "What time is it?",
+        ]
+        prompts = [
+            self.tokenizer.apply_chat_template(
+                [{"role": "user", "content": p}],
+                tokenize=True,
+                add_generation_prompt=True,
+            )
+            for p in prompts
+        ]
+        logits_params = [
+            {"repetition_penalty": 1.5, "repetition_context_size": 5},
+            {"logit_bias": {198: -100.0}, "repetition_penalty": 1.2},
+            None,
+        ]
+        gen = BatchGenerator(
+            self.model,
+            stop_tokens=self.tokenizer.eos_token_ids,
+            max_tokens=8,
+            prefill_batch_size=2,
+        )
+        uids = gen.insert(prompts, logits_params=logits_params)
+        batch_logprobs = {uid: [] for uid in uids}
+        while responses := gen.next():
+            for r in responses:
+                batch_logprobs[r.uid].append(r.logprobs)
+
+        for e, uid in enumerate(uids):
+            params = logits_params[e] or {}
+            logits_processors = make_logits_processors(
+                params.get("logit_bias"),
+                params.get("repetition_penalty"),
+                params.get("repetition_context_size", 20),
+            )
+            responses = list(
+                stream_generate(
+                    self.model,
+                    self.tokenizer,
+                    prompts[e],
+                    max_tokens=8,
+                    logits_processors=logits_processors,
+                )
+            )
+            self.assertEqual(len(batch_logprobs[uid]), len(responses))
+            for logprobs, response in zip(batch_logprobs[uid], responses):
+                self.assertTrue(
+                    mx.allclose(logprobs, response.logprobs, rtol=1e-4, atol=1e-4)
+                )
+
+    def test_batch_speculative(self):
+        prompts = [
+            "Write a story about Einstein",
+            "Hi",
+            "What time is it?",
+            "How tall is Mt Everest?",
+        ]
+        prompts = [
+            self.tokenizer.apply_chat_template(
+                [{"role": "user", "content": p}],
+                tokenize=True,
+                add_generation_prompt=True,
+            )
+            for p in prompts
+        ]
+
+        model = self.model
+
+        # A draft model which gets some of the tokens wrong so that the
+        # sequences accept a different number of draft tokens
+        class DraftModel:
+            layers = model.layers
+
+            def __call__(self, inputs, cache=None):
+                logits = model(inputs, cache=cache)
+                wrong = mx.random.uniform(shape=inputs.shape) < 0.4
+                return mx.where(wrong[..., None], mx.roll(logits, 1, axis=-1), logits)
+
+        mx.random.seed(0)
+        num_toks = [20, 8, 15, 30]
+        gen = BatchGenerator(
+            self.model,
+            stop_tokens=self.tokenizer.eos_token_ids,
+            draft_model=DraftModel(),
+            num_draft_tokens=3,
+            prefill_batch_size=2,
+            completion_batch_size=4,
+        )
+        uids = gen.insert(prompts, max_tokens=num_toks)
+        batch_responses = {uid: [] for uid in uids}
+        num_steps = 0
+        while responses := gen.next():
+            num_steps += 1
+            for r in responses:
+                batch_responses[r.uid].append(r)
+        self.assertLess(num_steps, max(num_toks))
+
+        for e, uid in enumerate(uids):
+            responses = list(
+                stream_generate(
+                    self.model, self.tokenizer, prompts[e], max_tokens=num_toks[e]
+                )
+            )
+            self.assertEqual(
+                [r.token for r in batch_responses[uid]], [r.token for r in responses]
+            )
+            for batch_response, response in zip(batch_responses[uid], responses):
+                self.assertTrue(
+                    mx.allclose(
+                        batch_response.logprobs, response.logprobs, rtol=1e-4, atol=1e-4
+                    )
+                )
+            prompt_cache = batch_responses[uid][-1].prompt_cache
+            self.assertEqual(prompt_cache[0].offset, len(prompts[e]) + len(responses))
+
+        # Full rotating caches can't rewind the rejected draft tokens
+        class SlidingWindowModel(DraftModel):
+            def make_cache(self):
+                return [RotatingKVCache(max_size=8) for _ in model.layers]
+
+        with self.assertRaises(ValueError):
+            BatchGenerator(self.model, draft_model=SlidingWindowModel())
+        gen = BatchGenerator(self.model, draft_model=DraftModel())
+        with self.assertRaises(ValueError):
+            gen.insert(
+                prompts[:1],
+                caches=[
+                    [RotatingKVCache(max_size=8) for _ in range(2 * len(model.layers))]
+                ],
+            )
+
     def test_batch_sliding_window(self):
         prompts = [
             "Write a story about Einstein",
@@ -355,6 +961,141 @@ class TestGenerate(unittest.TestCase):
 
         del self.model.make_cache
 
+    def test_batch_hybrid_cache_with_history(self):
+        from mlx_lm.models import lfm2
+
+        args = lfm2.ModelArgs(
+            model_type="lfm2",
+            hidden_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            num_key_value_heads=2,
+            norm_eps=1e-5,
+            vocab_size=100,
+            full_attn_idxs=[1],
+            rope_theta=10000,
+            block_dim=64,
+            block_ffn_dim_multiplier=1.5,
+            block_auto_adjust_ff_dim=True,
+            block_ff_dim=128,
+            block_multiple_of=32,
+            max_position_embeddings=1000,
+            conv_bias=True,
+            conv_L_cache=3,
+        )
+        model = lfm2.Model(args)
+        mx.eval(model.parameters())
+
+        histories = [[1, 2, 3, 4, 5], [6, 7], None]
+        prompts = [[8, 9, 10], [11, 12, 13, 14, 15, 16], [17, 18, 19, 20]]
+        caches = []
+        for h in histories:
+            c = make_prompt_cache(model)
+            if h is not None:
+                model(mx.array([h]), cache=c)
+            caches.append(c)
+
+        expected = []
+        for p, c in zip(prompts, caches):
+            logprobs = []
+            for _, lp in generate_step(
+                mx.array(p), model, prompt_cache=copy.deepcopy(c), max_tokens=3
+            ):
+                logprobs.append(lp)
+            expected.append(logprobs)
+
+        gen = BatchGenerator(model, stop_tokens=set(), prefill_step_size=2)
+        uids = gen.insert(
+            prompts, max_tokens=3, caches=[copy.deepcopy(c) for c in caches]
+        )
+        results = {uid: [] for uid in uids}
+        while responses := gen.next():
+            for r in responses:
+                results[r.uid].append(r.logprobs)
+        for uid, logprobs in zip(uids, expected):
+            self.assertEqual(len(results[uid]), 3)
+            for lp, elp in zip(results[uid], logprobs):
+                self.assertTrue(mx.allclose(lp, elp, atol=1e-5))
+
+    def test_batch_num_samples(self):
+        prompts = [
+            self.tokenizer.apply_chat_template(
+                [{"role": "user", "content": p}],
+                tokenize=True,
+                add_generation_prompt=True,
+            )
+            for p in ["Write a story about Einstein", "Hi"]
+        ]
+        expected = [
+            [r.logprobs for r in stream_generate(self.model, self.tokenizer, p, 4)]
+            for p in prompts
+        ]
+        for kv_block_size in [None, 4]:
+            gen = BatchGenerator(
+                self.model,
+                stop_tokens=set(),
+                max_tokens=4,
+                kv_block_size=kv_block_size,
+            )
+            uids = gen.insert(prompts, num_samples=[3, 2])
+            self.assertEqual(uids, [0, 1, 2, 3, 4])
+            # Removing a prompt keeps its other samples
+            gen.remove([0, 4])
+            batch_responses = {}
+            while responses := gen.next():
+                for r in responses:
+                    batch_responses.setdefault(r.uid, []).append(r.logprobs)
+            self.assertEqual(sorted(batch_responses), [1, 2, 3])
+            # Every prompt is processed once
+            self.assertEqual(gen.stats().prompt_tokens, sum(len(p) for p in prompts))
+            for uid, e in [(1, 0), (2, 0), (3, 1)]:
+                for lp, elp in zip(batch_responses[uid], expected[e]):
+                    self.assertTrue(mx.allclose(lp, elp, rtol=1e-4, atol=1e-4))
+
+        # The samples count towards the size of the batch
+        for prefill_token_budget in [None, 8]:
+            gen = BatchGenerator(
+                self.model,
+                stop_tokens=set(),
+                max_tokens=4,
+                prefill_batch_size=2,
+                completion_batch_size=6,
+                prefill_token_budget=prefill_token_budget,
+            )
+            uids = gen.insert(prompts * 2, num_samples=4)
+            num_tokens = {uid: 0 for uid in uids}
+            while responses := gen.next():
+                if gen.active_batch is not None:
+                    self.assertLessEqual(len(gen.active_batch), 6)
+                for r in responses:
+                    num_tokens[r.uid] += 1
+            self.assertEqual(list(num_tokens.values()), [4] * 16)
+
+    def test_beam_search(self):
+        prompt = self.tokenizer.encode("hello")
+        greedy = [
+            r.token
+            for r in stream_generate(self.model, self.tokenizer, prompt, max_tokens=8)
+        ]
+        response = beam_search(
+            self.model, self.tokenizer, prompt, num_beams=1, max_tokens=8
+        )
+        self.assertEqual(response.tokens[0], greedy[: len(response.tokens[0])])
+
+        response = beam_search(
+            self.model, self.tokenizer, prompt, num_beams=3, max_tokens=8
+        )
+        self.assertEqual(len(response.texts), 3)
+        self.assertEqual(response.scores, sorted(response.scores, reverse=True))
+        # The scores are the length normalized log probabilities
+        for tokens, score in zip(response.tokens, response.scores):
+            inputs = mx.array([prompt + tokens])
+            logits = self.model(inputs[:, :-1])[0, len(prompt) - 1 :]
+            logprobs = logits - mx.logsumexp(logits, axis=-1, keepdims=True)
+            logprob = logprobs[mx.arange(len(tokens)), inputs[0, len(prompt) :]].sum()
+            if len(tokens) == 8:
+                self.assertAlmostEqual(logprob.item() / 8, score, places=3)
+
     def test_batch_continued_generation(self):
         for rotating in [False, True]:
             if rotating:
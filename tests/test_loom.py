@@ -0,0 +1,130 @@
+# Copyright © 2025 Apple Inc.
+
+import importlib.util
+import io
+import json
+import unittest
+from pathlib import Path
+
+from mlx_lm.utils import load
+
+LOOM_PATH = Path(__file__).parent.parent / "loom.py"
+spec = importlib.util.spec_from_file_location("loom", LOOM_PATH)
+loom = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(loom)
+
+
+class ScaledModel:
+    """Divides the logits of a model by a temperature."""
+
+    def __init__(self, model, temperature):
+        self.model = model
+        self.temperature = temperature
+
+    def __call__(self, *args, **kwargs):
+        return self.model(*args, **kwargs) / self.temperature
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+
+class TestLoom(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.HF_MODEL_PATH = "mlx-community/Qwen1.5-0.5B-Chat-4bit"
+        cls.model, cls.tokenizer = load(cls.HF_MODEL_PATH)
+        cls.prompt = "The meaning of life is"
+
+    def make_loom(self, **kwargs):
+        kwargs = {"depth": 4, "width": 3, **kwargs}
+        return loom.Loom(self.model, self.tokenizer, self.prompt, **kwargs)
+
+    def tree(self, l):
+        nodes = l.nodes
+        return {
+            tuple(nodes.path_tokens(n)): nodes.probability[n] for n in range(len(nodes))
+        }
+
+    def test_strategies_build_same_tree(self):
+        ref = self.make_loom()
+        ref.start()
+        expected = self.tree(ref)
+        self.assertEqual(len(expected), 1 + 3 + 9 + 27 + 81)
+
+        for kwargs in [
+            {"strategy": "best", "batch_size": 4},
+            {"strategy": "best", "batch_size": 4, "max_cached_nodes": 1},
+        ]:
+            with self.subTest(**kwargs):
+                l = self.make_loom(**kwargs)
+                l.start()
+                tree = self.tree(l)
+                self.assertEqual(set(tree), set(expected))
+                for path, prob in expected.items():
+                    self.assertAlmostEqual(tree[path], prob, places=3)
+                self.assertEqual(len(l.node_caches), 0)
+
+    def test_max_nodes(self):
+        for strategy in ["breadth", "best"]:
+            with self.subTest(strategy=strategy):
+                l = self.make_loom(depth=6, strategy=strategy, max_nodes=20)
+                l.start()
+                self.assertEqual(len(l.nodes), 20)
+
+    def test_child_cutoffs(self):
+        # Soften the next token distributions of the test model so that the
+        # cutoffs leave a varying number of children
+        model = ScaledModel(self.model, 6.0)
+
+        def children(**kwargs):
+            l = loom.Loom(
+                model, self.tokenizer, self.prompt, depth=4, width=3, **kwargs
+            )
+            l.start()
+            nodes = l.nodes
+            return {
+                tuple(nodes.path_tokens(n)): [
+                    nodes.probability[c] for c in nodes.children(n)
+                ]
+                for n in range(len(nodes))
+                if nodes.depth[n] < l.depth
+            }
+
+        full = children()
+        for top_p, min_probability in [(0.7, 0.0), (1.0, 0.008), (0.7, 0.008)]:
+            with self.subTest(top_p=top_p, min_probability=min_probability):
+                tree = children(top_p=top_p, min_probability=min_probability)
+                self.assertLess(len(tree), len(full))
+                for path, probs in tree.items():
+                    all_probs = full[path]
+                    keep = 1
+                    while (
+                        keep < len(all_probs)
+                        and sum(all_probs[:keep]) < top_p
+                        and all_probs[keep] >= min_probability
+                    ):
+                        keep += 1
+                    self.assertEqual(len(probs), keep)
+                    for p, q in zip(probs, all_probs):
+                        self.assertAlmostEqual(p, q, places=3)
+
+    def test_write_ndjson(self):
+        l = self.make_loom(depth=3, strategy="best", batch_size=2)
+        out = io.StringIO()
+        l.write_ndjson(out)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(records), len(l.nodes))
+        self.assertEqual(len({r["id"] for r in records}), len(records))
+
+        seen = set()
+        for r in records:
+            if r["parent_id"] is None:
+                self.assertEqual(r["layer"], 0)
+            else:
+                self.assertIn(r["parent_id"], seen)
+            seen.add(r["id"])
+
+
+if __name__ == "__main__":
+    unittest.main()
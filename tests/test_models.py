@@ -9,7 +9,12 @@ from mlx.utils import tree_map
 
 from mlx_lm.models import rope_utils
 from mlx_lm.models.base import create_causal_mask, scaled_dot_product_attention
-from mlx_lm.models.cache import KVCache, RotatingKVCache, make_prompt_cache
+from mlx_lm.models.cache import (
+    KVCache,
+    QuantizedKVCache,
+    RotatingKVCache,
+    make_prompt_cache,
+)
 from mlx_lm.models.gated_delta import gated_delta_kernel, gated_delta_ops
 from mlx_lm.models.ssm import ssm_attn, ssm_update
 
@@ -975,6 +980,111 @@ class TestModels(unittest.TestCase):
             model, args.model_type, args.vocab_size, args.num_hidden_layers
         )
 
+    def test_deepseek_v3_latent_cache(self):
+        from mlx_lm.models import deepseek_v3
+
+        args = deepseek_v3.ModelArgs(
+            model_type="deepseek_v3",
+            vocab_size=1024,
+            hidden_size=128,
+            intermediate_size=256,
+            moe_intermediate_size=256,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            num_key_value_heads=4,
+            n_routed_experts=4,
+            n_group=2,
+            topk_group=1,
+            num_experts_per_tok=2,
+            n_shared_experts=1,
+            kv_lora_rank=64,
+            q_lora_rank=32,
+            qk_rope_head_dim=32,
+            v_head_dim=16,
+            qk_nope_head_dim=32,
+        )
+        model = deepseek_v3.Model(args)
+        inputs = mx.array([[1, 2, 3, 4, 5, 6]])
+        expected = model(inputs)
+
+        for quantize in [False, True]:
+            if quantize:
+                nn.quantize(model, group_size=32, bits=8)
+                expected = model(inputs)
+            cache = make_prompt_cache(model)
+            model(inputs[:, :4], cache=cache)
+            for i in range(4, 6):
+                out = model(inputs[:, i : i + 1], cache=cache)
+                self.assertTrue(mx.allclose(out[0, 0], expected[0, i], atol=1e-4))
+
+            # Only the latent and the positional keys are cached
+            keys, values = cache[0].state
+            self.assertEqual(keys.shape, (1, 1, 6, args.kv_lora_rank))
+            self.assertEqual(values.shape, (1, 1, 6, args.qk_rope_head_dim))
+
+            cache[0].trim(2)
+            cache[1].trim(2)
+            out = model(inputs[:, 4:], cache=cache)
+            self.assertTrue(mx.allclose(out[0, -1], expected[0, -1], atol=1e-4))
+
+    def test_minicpm3_latent_attention(self):
+        from mlx_lm.models import minicpm3
+
+        args = minicpm3.ModelArgs(
+            model_type="minicpm3",
+            hidden_size=128,
+            dim_model_base=128,
+            num_hidden_layers=1,
+            intermediate_size=256,
+            num_attention_heads=4,
+            rms_norm_eps=1e-5,
+            vocab_size=1024,
+            num_key_value_heads=4,
+            q_lora_rank=32,
+            qk_nope_head_dim=32,
+            qk_rope_head_dim=32,
+            kv_lora_rank=64,
+            scale_depth=1.4,
+            scale_emb=12,
+            max_position_embeddings=1024,
+            rope_scaling={"original_max_position_embeddings": 1024},
+        )
+        attn = minicpm3.Attention(args)
+        x = mx.random.normal((1, 8, args.hidden_size))
+
+        # The original formulation with per-head keys and values
+        H = args.num_attention_heads
+        q = attn.q_b_proj(attn.q_a_layernorm(attn.q_a_proj(x)))
+        q = q.reshape(1, 8, H, -1).transpose(0, 2, 1, 3)
+        q_nope, q_pe = mx.split(q, [args.qk_nope_head_dim], axis=-1)
+        latent, k_pe = mx.split(attn.kv_a_proj_with_mqa(x), [args.kv_lora_rank], -1)
+        kv = attn.kv_b_proj(attn.kv_a_layernorm(latent))
+        kv = kv.reshape(1, 8, H, -1).transpose(0, 2, 1, 3)
+        k_nope, values = mx.split(kv, [args.qk_nope_head_dim], axis=-1)
+        k_pe = attn.rope(k_pe[:, None])
+        keys = mx.concatenate([k_nope, mx.repeat(k_pe, H, axis=1)], axis=-1)
+        queries = mx.concatenate([q_nope, attn.rope(q_pe)], axis=-1)
+        scores = (queries * attn.softmax_scale) @ keys.swapaxes(-1, -2)
+        scores = mx.where(create_causal_mask(8), scores, -float("inf"))
+        expected = mx.softmax(scores, axis=-1) @ values
+        expected = attn.o_proj(expected.transpose(0, 2, 1, 3).reshape(1, 8, -1))
+
+        out = attn(x, mask="causal")
+        self.assertTrue(mx.allclose(out, expected, atol=1e-4))
+
+        # Prompt chunks and decoding from the latent cache
+        for cache in [KVCache(), QuantizedKVCache(group_size=32, bits=8)]:
+            out = mx.concatenate(
+                [
+                    attn(x[:, :3], mask="causal", cache=cache),
+                    attn(x[:, 3:7], mask="causal", cache=cache),
+                    attn(x[:, 7:], mask=None, cache=cache),
+                ],
+                axis=1,
+            )
+            atol = 1e-4 if isinstance(cache, KVCache) else 1e-2
+            self.assertTrue(mx.allclose(out, expected, atol=atol))
+
     def test_gemma2(self):
         from mlx_lm.models import gemma2
 
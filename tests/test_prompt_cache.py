@@ -8,16 +8,23 @@ import unittest
 import mlx.core as mx
 
 from mlx_lm.generate import generate_step
-from mlx_lm.models.base import create_attention_mask, create_causal_mask
+from mlx_lm.models.base import (
+    create_attention_mask,
+    create_causal_mask,
+    quantized_scaled_dot_product_attention,
+)
 from mlx_lm.models.cache import (
     BatchKVCache,
+    BatchQuantizedKVCache,
     BatchRotatingKVCache,
     CacheList,
     ChunkedKVCache,
     KVCache,
     MambaCache,
+    PagedKVCache,
     QuantizedKVCache,
     RotatingKVCache,
+    StaticKVCache,
     load_prompt_cache,
     make_prompt_cache,
     save_prompt_cache,
@@ -460,6 +467,139 @@ class TestPromptCache(unittest.TestCase):
         self.assertEqual(cache_a.offset.tolist(), [6, 7, 6, 1, 4])
         self.assertEqual(cache_a.left_padding.tolist(), [2, 1, 2, 7, 4])
 
+    def test_paged_kv_cache(self):
+        def attend(cache, q, k, v):
+            mask = cache.make_mask(q.shape[2])
+            k, v = cache.update_and_fetch(k, v)
+            return mx.fast.scaled_dot_product_attention(q, k, v, scale=1.0, mask=mask)
+
+        batch_cache = BatchKVCache(left_padding=[2, 5, 0])
+        paged_cache = PagedKVCache(left_padding=[2, 5, 0], block_size=4)
+        for N in [7, 1, 3, 1]:
+            q, k, v = mx.random.normal((3, 3, 2, N, 8))
+            out = attend(batch_cache, q, k, v)[..., -1, :]
+            paged_out = attend(paged_cache, q, k, v)[..., -1, :]
+            self.assertTrue(mx.allclose(out, paged_out, atol=1e-5))
+            self.assertEqual(batch_cache.offset.tolist(), paged_cache.offset.tolist())
+
+        # Blocks holding only padding are returned to the pool
+        self.assertEqual(paged_cache._padding, [2, 1, 0])
+
+        # Test filtering and extension
+        batch_cache.filter(mx.array([0, 2]))
+        paged_cache.filter(mx.array([0, 2]))
+        self.assertEqual(paged_cache._lengths, [12, 12])
+
+        other_batch = BatchKVCache(left_padding=[1, 0])
+        other_paged = PagedKVCache(left_padding=[1, 0], block_size=4)
+        k = mx.random.normal((2, 2, 5, 8))
+        other_batch.update_and_fetch(k, k)
+        other_paged.update_and_fetch(k, k)
+        batch_cache.extend(other_batch)
+        paged_cache.extend(other_paged)
+
+        q, k, v = mx.random.normal((3, 4, 2, 1, 8))
+        out = attend(batch_cache, q, k, v)
+        paged_out = attend(paged_cache, q, k, v)
+        self.assertTrue(mx.allclose(out, paged_out, atol=1e-5))
+
+        # Test extraction and merging
+        caches = [batch_cache.extract(i) for i in range(4)]
+        for i, c in enumerate(caches):
+            self.assertTrue(mx.array_equal(c.keys, paged_cache.extract(i).keys))
+
+        batch_cache = BatchKVCache.merge(caches)
+        paged_cache = PagedKVCache.merge(caches, block_size=4)
+        self.assertEqual(batch_cache.offset.tolist(), paged_cache.offset.tolist())
+        out = attend(batch_cache, q, k, v)
+        paged_out = attend(paged_cache, q, k, v)
+        self.assertTrue(mx.allclose(out, paged_out, atol=1e-5))
+
+        # Test trimming
+        lengths = list(paged_cache._lengths)
+        self.assertEqual(paged_cache.trim(2), 2)
+        self.assertEqual(paged_cache._lengths, [l - 2 for l in lengths])
+
+        # Test saving and loading
+        cache_file = os.path.join(self.test_dir, "prompt_cache.safetensors")
+        save_prompt_cache(cache_file, [paged_cache])
+        (loaded_cache,) = load_prompt_cache(cache_file)
+        self.assertEqual(loaded_cache.block_size, 4)
+        self.assertEqual(loaded_cache._tables, paged_cache._tables)
+        for i in range(4):
+            self.assertTrue(
+                mx.array_equal(
+                    loaded_cache.extract(i).keys, paged_cache.extract(i).keys
+                )
+            )
+
+    def test_batch_quantized_kv_cache(self):
+        def attend(cache, q, k, v, mask=None):
+            k, v = cache.update_and_fetch(k, v)
+            return quantized_scaled_dot_product_attention(
+                q, k, v, scale=1.0, mask=mask, group_size=32, bits=8
+            )
+
+        left_padding = [2, 5, 0]
+        batch_cache = BatchQuantizedKVCache(left_padding, group_size=32, bits=8)
+        caches = [QuantizedKVCache(group_size=32, bits=8) for _ in left_padding]
+        for N in [7, 1, 3, 1]:
+            q = mx.random.normal((3, 4, N, 32))
+            k, v = mx.random.normal((2, 3, 2, N, 32))
+            mask = batch_cache.make_mask(N)
+            out = attend(batch_cache, q, k, v, mask)[..., -1:, :]
+            for i, c in enumerate(caches):
+                # The last query attends to all the keys of its sequence
+                p = left_padding[i] if c.offset == 0 else 0
+                expected = attend(
+                    c, q[i : i + 1, :, -1:], k[i : i + 1, :, p:], v[i : i + 1, :, p:]
+                )
+                self.assertTrue(mx.allclose(out[i : i + 1], expected, atol=1e-4))
+        self.assertEqual(batch_cache.offset.tolist(), [c.offset for c in caches])
+
+        # Test extraction and merging
+        for i, c in enumerate(caches):
+            extracted = batch_cache.extract(i)
+            self.assertEqual(extracted.offset, c.offset)
+            for a, b in zip(extracted.state[0], c.state[0]):
+                self.assertTrue(mx.array_equal(a, b))
+
+        merged = BatchQuantizedKVCache.merge(caches, group_size=32, bits=8)
+        self.assertEqual(merged.offset.tolist(), batch_cache.offset.tolist())
+        self.assertEqual(merged.left_padding.tolist(), [2, 5, 0])
+
+        # Regular caches are quantized when merged
+        kv_cache = KVCache()
+        kv_cache.update_and_fetch(*mx.random.normal((2, 1, 2, 4, 32)))
+        merged = BatchQuantizedKVCache.merge([kv_cache] + caches, 32, 8)
+        self.assertEqual(merged.left_padding.tolist(), [8, 2, 5, 0])
+        with self.assertRaises(ValueError):
+            BatchQuantizedKVCache.merge(caches, group_size=64, bits=4)
+
+        # Test filtering and extension
+        batch_cache.filter(mx.array([1, 2]))
+        self.assertEqual(batch_cache.left_padding.tolist(), [5, 0])
+        other = BatchQuantizedKVCache([1, 0], group_size=32, bits=8)
+        other.update_and_fetch(*mx.random.normal((2, 2, 2, 5, 32)))
+        batch_cache.extend(other)
+        self.assertEqual(batch_cache.offset.tolist(), [7, 12, 4, 5])
+        self.assertEqual(batch_cache.left_padding.tolist(), [5, 0, 8, 7])
+
+        # Test rewinding
+        batch_cache.rewind([1, 3, 0, 2])
+        self.assertEqual(batch_cache.offset.tolist(), [6, 9, 4, 3])
+        self.assertEqual(len(batch_cache), 12)
+        for a, b in zip(batch_cache.extract(1).state[0], caches[2].state[0]):
+            self.assertTrue(mx.array_equal(a, b[..., :9, :]))
+
+        # Test saving and loading
+        cache_file = os.path.join(self.test_dir, "prompt_cache.safetensors")
+        save_prompt_cache(cache_file, [batch_cache])
+        (loaded_cache,) = load_prompt_cache(cache_file)
+        self.assertEqual(loaded_cache.bits, 8)
+        self.assertEqual(loaded_cache.group_size, 32)
+        self.assertEqual(loaded_cache.offset.tolist(), batch_cache.offset.tolist())
+
     def test_batch_rotating_kv_cache(self):
         cache = BatchRotatingKVCache(max_size=4, left_padding=[2, 0])
         mask = cache.make_mask(4)
@@ -532,6 +672,99 @@ class TestPromptCache(unittest.TestCase):
         )
         self.assertTrue(mx.array_equal(mask.squeeze(), expected))
 
+    def test_batch_cache_rewind(self):
+        left_padding = [2, 0, 1]
+        k = mx.random.normal((3, 2, 9, 8))
+        q, new_k = mx.random.normal((2, 3, 2, 1, 8))
+        for batch_cache in [
+            BatchKVCache(left_padding),
+            PagedKVCache(left_padding, block_size=4),
+            BatchRotatingKVCache(32, left_padding),
+        ]:
+            batch_cache.update_and_fetch(k[..., :6, :], k[..., :6, :])
+            batch_cache.update_and_fetch(k[..., 6:, :], k[..., 6:, :])
+            batch_cache.rewind([1, 3, 0])
+            self.assertEqual(batch_cache.offset.tolist(), [6, 6, 8])
+
+            mask = batch_cache.make_mask(1)
+            keys, values = batch_cache.update_and_fetch(new_k, new_k)
+            out = mx.fast.scaled_dot_product_attention(
+                q, keys, values, scale=1.0, mask=mask
+            )
+            for i, (lp, n) in enumerate(zip(left_padding, [1, 3, 0])):
+                cache = KVCache()
+                cache.update_and_fetch(
+                    k[i : i + 1, :, lp : 9 - n], k[i : i + 1, :, lp : 9 - n]
+                )
+                keys, values = cache.update_and_fetch(
+                    new_k[i : i + 1], new_k[i : i + 1]
+                )
+                expected = mx.fast.scaled_dot_product_attention(
+                    q[i : i + 1], keys, values, scale=1.0
+                )
+                self.assertTrue(mx.allclose(out[i : i + 1], expected, atol=1e-5))
+                self.assertTrue(mx.array_equal(batch_cache.extract(i).keys, keys))
+
+    def test_batch_arrays_cache(self):
+        caches = [MambaCache(), MambaCache(), MambaCache()]
+        caches[0][0] = mx.random.normal((1, 2, 4))
+        caches[0][1] = mx.random.normal((1, 4, 4))
+        caches[2][0] = mx.random.normal((1, 2, 4))
+        caches[2][1] = mx.random.normal((1, 4, 4))
+        batch_cache = MambaCache.merge(caches)
+        self.assertIsInstance(batch_cache, MambaCache)
+        self.assertTrue(mx.array_equal(batch_cache[0][1], mx.zeros((2, 4))))
+        for i in [0, 2]:
+            extracted = batch_cache.extract(i)
+            self.assertIsInstance(extracted, MambaCache)
+            self.assertTrue(mx.array_equal(extracted[1], caches[i][1]))
+
+        # Right padded prompts of lengths 3, 1 and 2 with a fake state update
+        batch_cache.prepare(lengths=[3, 1, 2], right_padding=[0, 2, 1])
+        states = []
+        for _ in range(2):
+            states.append(batch_cache[1])
+            batch_cache[0] = batch_cache[0] + 1
+            batch_cache[1] = batch_cache[1] + 1
+            batch_cache.advance(1)
+        batch_cache.finalize()
+        self.assertTrue(mx.allclose(batch_cache[1][0], states[0][0] + 2))
+        self.assertTrue(mx.array_equal(batch_cache[1][1], states[0][1]))
+        self.assertTrue(mx.array_equal(batch_cache[1][2], states[1][2]))
+
+        c = CacheList(MambaCache(), KVCache())
+        c[0][0] = mx.zeros((1, 2, 4))
+        c[1].update_and_fetch(mx.zeros((1, 2, 3, 4)), mx.zeros((1, 2, 3, 4)))
+        batch_cache = CacheList(MambaCache.merge([c[0]]), BatchKVCache.merge([c[1]]))
+        extracted = batch_cache.extract(0)
+        self.assertIsInstance(extracted, CacheList)
+        self.assertEqual(extracted[1].offset, 3)
+
+    def test_static_kv_cache(self):
+        k = mx.random.normal((2, 2, 5, 8))
+        q, new_k = mx.random.normal((2, 2, 2, 1, 8))
+        for cache in [KVCache(), BatchKVCache([1, 0])]:
+            cache.update_and_fetch(k[..., :4, :], k[..., :4, :])
+            expected = copy.deepcopy(cache)
+            mask = expected.make_mask(1, return_array=True, window_size=None)
+            keys, values = expected.update_and_fetch(new_k, new_k)
+            expected_out = mx.fast.scaled_dot_product_attention(
+                q, keys, values, scale=1.0, mask=mask
+            )
+
+            static_cache = StaticKVCache(cache)
+            mask = static_cache.make_mask(1)
+            keys, values = static_cache.update_and_fetch(new_k, new_k)
+            self.assertEqual(keys.shape[2], StaticKVCache.step)
+            out = mx.fast.scaled_dot_product_attention(
+                q, keys, values, scale=1.0, mask=mask
+            )
+            self.assertTrue(mx.allclose(out, expected_out, atol=1e-5))
+
+            static_cache.write_back(1)
+            self.assertEqual(len(cache), 5)
+            self.assertTrue(mx.array_equal(cache.state[0], expected.state[0]))
+
     def test_save_load_batch_caches(self):
         cache_file = os.path.join(self.test_dir, "prompt_cache.safetensors")
 
@@ -2,7 +2,16 @@ import unittest
 
 import mlx.core as mx
 
-from mlx_lm.sample_utils import apply_min_p, apply_top_k, apply_top_p, apply_xtc
+from mlx_lm.sample_utils import (
+    apply_batch_filters,
+    apply_min_p,
+    apply_top_k,
+    apply_top_p,
+    apply_xtc,
+    make_batch_logits_processors,
+    make_batch_sampler,
+    make_logits_processors,
+)
 
 
 class TestSampleUtils(unittest.TestCase):
@@ -94,6 +103,79 @@ class TestSampleUtils(unittest.TestCase):
             actual_probs.tolist(), [[1.0, 0.0, 0.0, 0.0], [0.0, 1.0, 0.0, 0.0]]
         )
 
+    def test_apply_batch_filters(self):
+        probs = mx.array([[0.9, 0.0, 0.0, 0.1], [0.6, 0.0, 0.1, 0.3]])
+        logits = mx.log(probs)
+
+        # Each row matches the corresponding unbatched filter
+        top_p = mx.array([[0.3], [0.95]])
+        new_logits = apply_batch_filters(
+            logits, top_p, mx.zeros((2, 1)), mx.zeros((2, 1))
+        )
+        expected = mx.concatenate(
+            [apply_top_p(logits[i : i + 1], top_p[i].item()) for i in range(2)]
+        )
+        self.assertTrue(mx.array_equal(new_logits, expected))
+
+        min_p = mx.array([[0.2], [0.2]])
+        new_logits = apply_batch_filters(
+            logits, mx.zeros((2, 1)), min_p, mx.zeros((2, 1))
+        )
+        self.assertTrue(mx.array_equal(new_logits, apply_min_p(logits, 0.2)))
+
+        top_k = mx.array([[1], [2]])
+        new_logits = apply_batch_filters(
+            logits, mx.zeros((2, 1)), mx.zeros((2, 1)), top_k
+        )
+        expected = mx.concatenate(
+            [apply_top_k(logits[i : i + 1], top_k[i].item()) for i in range(2)]
+        )
+        self.assertTrue(mx.array_equal(new_logits, expected))
+
+        # Disabled filters keep everything
+        new_logits = apply_batch_filters(
+            logits,
+            mx.array([[0.0], [1.0]]),
+            mx.array([[0.0], [0.0]]),
+            mx.array([[0], [0]]),
+        )
+        self.assertTrue(mx.array_equal(new_logits, logits))
+
+    def test_batch_sampler(self):
+        probs = mx.array([[0.5, 0.0, 0.0, 0.5], [0.1, 0.6, 0.0, 0.3]])
+        logits = mx.log(probs)
+
+        sampler = make_batch_sampler([0.0, 1.0], [0.0, 0.0], [0.0, 0.0], [0, 1])
+        self.assertEqual(sampler(logits).tolist(), [0, 1])
+
+        sampler = make_batch_sampler([1.0, 0.0], [0.0, 0.0], [0.0, 0.0], [0, 0])
+        tokens = mx.stack([sampler(logits) for _ in range(50)])
+        self.assertEqual(set(tokens[:, 0].tolist()), {0, 3})
+        self.assertEqual(set(tokens[:, 1].tolist()), {1})
+
+        with self.assertRaises(ValueError):
+            make_batch_sampler([1.0], [1.5], [0.0], [0])
+
+    def test_batch_logits_processors(self):
+        logits = mx.random.normal((3, 16))
+        tokens = mx.array([[-1, -1, 4, 5], [1, 2, 2, 3], [-1, 7, 8, 9]])
+        params = [
+            (None, 1.5, 2),
+            ({3: -5.0, 15: 2.0}, 1.2, 4),
+            ({0: 1.0}, None, 20),
+        ]
+        processors = make_batch_logits_processors(*zip(*params))
+        out = logits
+        for processor in processors:
+            out = processor(tokens, out)
+
+        for i, (logit_bias, penalty, context_size) in enumerate(params):
+            expected = logits[i : i + 1]
+            row_tokens = mx.array([t for t in tokens[i].tolist() if t >= 0])
+            for processor in make_logits_processors(logit_bias, penalty, context_size):
+                expected = processor(row_tokens, expected)
+            self.assertTrue(mx.allclose(out[i : i + 1], expected))
+
     def test_apply_xtc(self):
         # Test the threshold
         probs = mx.array([[0.4, 0.3, 0.15, 0.15]])
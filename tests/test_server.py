@@ -1,16 +1,32 @@
 # Copyright © 2024 Apple Inc.
 
+import asyncio
+import copy
 import http
 import io
 import json
+import random
+import socket
+import tempfile
 import threading
 import unittest
+from queue import Queue
 
 import mlx.core as mx
 import requests
 
-from mlx_lm.models.cache import KVCache
-from mlx_lm.server import APIHandler, LRUPromptCache, ResponseGenerator
+from mlx_lm.models.cache import KVCache, RotatingKVCache
+from mlx_lm.server import (
+    APIHandler,
+    AsyncAPIServer,
+    DiskPromptCache,
+    LRUPromptCache,
+    ModelDescription,
+    ModelProvider,
+    Response,
+    ResponseGenerator,
+    _ResponseWriter,
+)
 from mlx_lm.utils import load
 
 
@@ -34,12 +50,17 @@ class DummyModelProvider:
                 "trust_remote_code": False,
                 "draft_model": None,
                 "num_draft_tokens": 3,
+                "prompt_lookup": False,
                 "temp": 0.0,
                 "top_p": 1.0,
                 "top_k": 0,
                 "min_p": 0.0,
                 "max_tokens": 512,
                 "chat_template_args": {},
+                "prefill_token_budget": None,
+                "compile_decode": False,
+                "kv_bits": None,
+                "kv_group_size": 64,
             },
         )
 
@@ -53,6 +74,43 @@ class DummyModelProvider:
         assert model in ["default_model", "chat_model"]
         return self.model, self.tokenizer
 
+    def loaded_tokenizer(self, model):
+        return self.tokenizer
+
+
+def disconnect_during_completion(response_generator, port, stream=False):
+    """
+    Send a long completion request, close the connection and return whether
+    the request was removed from the batch.
+    """
+    writer = response_generator._response_writer
+    removed = threading.Event()
+    remove = writer.remove
+
+    def remove_and_notify(uids):
+        remove(uids)
+        removed.set()
+
+    writer.remove = remove_and_notify
+    try:
+        body = json.dumps(
+            {
+                "model": "default_model",
+                "prompt": "Once upon a time",
+                "max_tokens": 100000,
+                "stream": stream,
+            }
+        ).encode()
+        with socket.create_connection(("localhost", port)) as conn:
+            conn.sendall(
+                b"POST /v1/completions HTTP/1.1\r\n"
+                + f"Content-Length: {len(body)}\r\n\r\n".encode()
+                + body
+            )
+        return removed.wait(timeout=30)
+    finally:
+        writer.remove = remove
+
 
 class TestServer(unittest.TestCase):
     @classmethod
@@ -104,6 +162,57 @@ class TestServer(unittest.TestCase):
             json.loads(requests.post(url, json=post_data).text)["choices"][0]["text"],
         )
 
+    def test_handle_completions_logprobs(self):
+        url = f"http://localhost:{self.port}/v1/completions"
+
+        post_data = {
+            "model": "default_model",
+            "prompt": "Once upon a time",
+            "max_tokens": 5,
+            "temperature": 0.0,
+            "repetition_penalty": 1.3,
+            "logit_bias": {"11": 2.0},
+            "logprobs": 3,
+        }
+
+        response = requests.post(url, json=post_data)
+        logprobs = json.loads(response.text)["choices"][0]["logprobs"]
+        self.assertEqual(len(logprobs["token_logprobs"]), 5)
+        self.assertEqual(len(logprobs["top_logprobs"]), 5)
+        for top in logprobs["top_logprobs"]:
+            self.assertEqual(len(top), 3)
+
+    def test_handle_completions_n(self):
+        url = f"http://localhost:{self.port}/v1/completions"
+
+        post_data = {
+            "model": "default_model",
+            "prompt": "Once upon a time",
+            "max_tokens": 5,
+            "temperature": 0.0,
+        }
+        expected = json.loads(requests.post(url, json=post_data).text)
+        expected = expected["choices"][0]["text"]
+
+        # Batched and single sequence (with a seed) generation
+        for extra in [{}, {"seed": 0}]:
+            post_data.update(n=3, **extra)
+            response_body = json.loads(requests.post(url, json=post_data).text)
+            choices = response_body["choices"]
+            self.assertEqual([c["index"] for c in choices], [0, 1, 2])
+            self.assertEqual([c["text"] for c in choices], [expected] * 3)
+            self.assertEqual(response_body["usage"]["completion_tokens"], 15)
+
+        post_data.update(stream=True)
+        texts = ["", "", ""]
+        with requests.post(url, json=post_data, stream=True) as response:
+            for line in response.iter_lines():
+                if not line.startswith(b"data: {"):
+                    continue
+                for choice in json.loads(line[6:])["choices"]:
+                    texts[choice["index"]] += choice["text"]
+        self.assertEqual(texts, [expected] * 3)
+
     def test_handle_chat_completions(self):
         url = f"http://localhost:{self.port}/v1/chat/completions"
         chat_post_data = {
@@ -190,6 +299,127 @@ class TestServer(unittest.TestCase):
         self.assertEqual(model["object"], "model")
         self.assertIn("created", model)
 
+    def test_handle_stats(self):
+        url = f"http://localhost:{self.port}/stats"
+        response = requests.get(url)
+        self.assertEqual(response.status_code, 200)
+        stats = json.loads(response.text)["prompt_cache"]
+        for key in ["hits", "misses", "evicted_bytes", "nbytes"]:
+            self.assertIn(key, stats)
+
+    def test_loaded_tokenizer(self):
+        cli_args = type("obj", (object,), {"model": None})
+        provider = ModelProvider(cli_args)
+        self.assertIsNone(
+            provider.loaded_tokenizer(ModelDescription("model", None, None))
+        )
+
+        provider.tokenizer = "tokenizer"
+        provider.model_key = ("model", None, "default_model")
+        provider.default_model_map = {"model": "model", "path": "model"}
+        for model, tokenizer in [
+            (ModelDescription("model", "default_model", None), "tokenizer"),
+            (ModelDescription("path", "default_model", None), "tokenizer"),
+            (ModelDescription("model", "default_model", "adapter"), None),
+            (ModelDescription("model", "draft", None), None),
+            (ModelDescription("other", "default_model", None), None),
+        ]:
+            self.assertEqual(provider.loaded_tokenizer(model), tokenizer)
+
+    def test_prepared_for_another_model(self):
+        response_generator = self.response_generator
+        tokenizer = response_generator.model_provider.tokenizer
+        stale_tokenizer = copy.copy(tokenizer)
+
+        # The model is switched after the request was prepared
+        calls = []
+        make_context = response_generator._make_context
+
+        def record_make_context(tokenizer, request, args):
+            calls.append((tokenizer, threading.current_thread()))
+            return make_context(tokenizer, request, args)
+
+        response_generator._make_context = record_make_context
+        response_generator.model_provider.loaded_tokenizer = lambda _: stale_tokenizer
+        try:
+            url = f"http://localhost:{self.port}/v1/completions"
+            post_data = {"model": "default_model", "prompt": "Hi", "max_tokens": 2}
+            response = requests.post(url, json=post_data)
+        finally:
+            del response_generator._make_context
+            del response_generator.model_provider.loaded_tokenizer
+        self.assertEqual(response.status_code, 200)
+
+        # The context is rebuilt with the serving tokenizer on the generation
+        # thread
+        self.assertEqual(len(calls), 2)
+        self.assertIs(calls[0][0], stale_tokenizer)
+        self.assertIsNot(calls[0][1], response_generator._generation_thread)
+        self.assertIs(calls[1][0], tokenizer)
+        self.assertIs(calls[1][1], response_generator._generation_thread)
+
+    def test_prompt_lookup_cache_types(self):
+        response_generator = self.response_generator
+        provider = response_generator.model_provider
+        args = type("obj", (object,), {"prompt_lookup": True})
+        self.assertTrue(response_generator._use_prompt_lookup(args))
+
+        # Caches which can't be trimmed once full ignore prompt lookup
+        cache_types = provider.cache_types
+        provider.cache_types = {KVCache, RotatingKVCache}
+        try:
+            self.assertFalse(response_generator._use_prompt_lookup(args))
+        finally:
+            provider.cache_types = cache_types
+
+    def test_compiled_step(self):
+        response_generator = self.response_generator
+        model = response_generator.model_provider.model
+        self.assertIsNone(response_generator._compiled_step(model))
+
+        cli_args = response_generator.cli_args
+        cli_args.compile_decode = True
+        try:
+            # The model is compiled once and not for every request
+            step = response_generator._compiled_step(model)
+            self.assertIsNotNone(step)
+            self.assertIs(response_generator._compiled_step(model), step)
+        finally:
+            cli_args.compile_decode = False
+
+    def test_cancel_disconnected_client(self):
+        self.assertTrue(
+            disconnect_during_completion(self.response_generator, self.port)
+        )
+        self.assertTrue(
+            disconnect_during_completion(self.response_generator, self.port, True)
+        )
+
+    def test_stop_matcher(self):
+        from mlx_lm.server import StopMatcher, sequence_overlap, stopping_criteria
+
+        random.seed(0)
+        for _ in range(50):
+            stop_id_sequences = [
+                [random.randrange(4) for _ in range(random.randrange(1, 5))]
+                for _ in range(random.randrange(1, 5))
+            ]
+            stop_words = ["x" * random.randrange(1, 9) for _ in stop_id_sequences]
+            matcher = StopMatcher(stop_id_sequences, stop_words)
+            tokens = []
+            state = 0
+            for _ in range(20):
+                tokens.append(random.randrange(4))
+                state = matcher.advance(state, tokens[-1])
+                self.assertEqual(
+                    matcher.stop_condition(state),
+                    stopping_criteria(tokens, stop_id_sequences, stop_words, None),
+                )
+                self.assertEqual(
+                    matcher.partial_match(state),
+                    any(sequence_overlap(tokens, s) for s in stop_id_sequences),
+                )
+
     def test_sequence_overlap(self):
         from mlx_lm.server import sequence_overlap
 
@@ -203,6 +433,74 @@ class TestServer(unittest.TestCase):
         self.assertFalse(sequence_overlap([1, 2, 3], [4, 1, 2, 3]))
 
 
+class TestAsyncServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.response_generator = ResponseGenerator(
+            DummyModelProvider(), LRUPromptCache()
+        )
+        server = AsyncAPIServer(cls.response_generator)
+        cls.loop = asyncio.new_event_loop()
+        cls.server = cls.loop.run_until_complete(
+            asyncio.start_server(server.handle_connection, "localhost", 0)
+        )
+        cls.port = cls.server.sockets[0].getsockname()[1]
+        cls.server_thread = threading.Thread(target=cls.loop.run_forever)
+        cls.server_thread.daemon = True
+        cls.server_thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        cls.server_thread.join()
+        cls.server.close()
+        cls.loop.run_until_complete(cls.server.wait_closed())
+        cls.loop.close()
+        cls.response_generator.stop_and_join()
+
+    def test_handle_completions(self):
+        url = f"http://localhost:{self.port}/v1/completions"
+        post_data = {
+            "model": "default_model",
+            "prompt": "Once upon a time",
+            "max_tokens": 5,
+            "temperature": 0.0,
+            "n": 2,
+        }
+        response = requests.post(url, json=post_data)
+        self.assertEqual(response.status_code, 200)
+        choices = response.json()["choices"]
+        self.assertEqual(len(choices), 2)
+        self.assertEqual(choices[0]["text"], choices[1]["text"])
+
+        # Streaming sends the same text
+        post_data.update(stream=True)
+        texts = ["", ""]
+        with requests.post(url, json=post_data, stream=True) as response:
+            self.assertEqual(response.headers["Content-type"], "text/event-stream")
+            lines = [line for line in response.iter_lines() if line]
+        for line in lines:
+            if line.startswith(b"data: {"):
+                for choice in json.loads(line[6:])["choices"]:
+                    texts[choice["index"]] += choice["text"]
+        self.assertEqual(lines[-1], b"data: [DONE]")
+        self.assertEqual(texts, [c["text"] for c in choices])
+
+    def test_cancel_disconnected_client(self):
+        self.assertTrue(
+            disconnect_during_completion(self.response_generator, self.port)
+        )
+        self.assertTrue(
+            disconnect_during_completion(self.response_generator, self.port, True)
+        )
+
+    def test_handle_get_requests(self):
+        response = requests.get(f"http://localhost:{self.port}/health")
+        self.assertEqual(response.json(), {"status": "ok"})
+        response = requests.get(f"http://localhost:{self.port}/unknown")
+        self.assertEqual(response.status_code, 404)
+
+
 class TestServerWithDraftModel(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -350,6 +648,84 @@ class TestServerWithDraftModel(unittest.TestCase):
         self.assertIsNotNone(second_response_body["choices"][0]["message"]["content"])
 
 
+class TestResponseWriter(unittest.TestCase):
+    class Detokenizer:
+        def __init__(self, fail_on=None):
+            self.fail_on = fail_on
+            self.last_segment = ""
+
+        def add_token(self, token):
+            if token == self.fail_on:
+                raise ValueError("Can't detokenize")
+            self.last_segment = str(token)
+
+    def write(self, records):
+        writer = _ResponseWriter()
+        queues = {}
+        for record in records:
+            if record[0] == "add":
+                _, uid, fail_on = record
+                queues[uid] = Queue()
+                writer.add(uid, queues[uid], self.Detokenizer(fail_on), uid)
+            elif record[0] == "remove":
+                writer.remove(record[1])
+            else:
+                uids, tokens, finish_reasons = record
+                n = len(uids)
+                writer.step(uids, tokens, [0.0] * n, finish_reasons, [None] * n)
+        writer.close()
+
+        outputs = {}
+        for uid, q in queues.items():
+            outputs[uid] = []
+            while not q.empty():
+                item = q.get()
+                if isinstance(item, Response):
+                    item = (item.text, item.finish_reason, item.index)
+                outputs[uid].append(item)
+        return outputs
+
+    def test_add_step_remove(self):
+        outputs = self.write(
+            [
+                ("add", 0, None),
+                ("add", 1, None),
+                ([0, 1], [5, 6], [None, None]),
+                ("add", 2, None),
+                ([0, 1, 2], [7, 8, 9], [None, "stop", None]),
+                # The first sequence finished in the same step as the removal
+                ("remove", [1, 2]),
+                ([0], [10], ["length"]),
+            ]
+        )
+        self.assertEqual(
+            outputs,
+            {
+                0: [("5", None, 0), ("7", None, 0), ("10", "length", 0), None],
+                1: [("6", None, 1), ("8", "stop", 1), None],
+                2: [("9", None, 2), None],
+            },
+        )
+
+    def test_errors(self):
+        outputs = self.write(
+            [
+                ("add", 0, None),
+                ("add", 1, 6),
+                ([0, 1], [5, 6], [None, None]),
+                # Unknown and failed sequences don't stop the writer
+                ([0, 1, 3], [7, 8, 9], [None, None, None]),
+                ("remove", [1, 3]),
+                ([0], [10], ["stop"]),
+            ]
+        )
+        self.assertEqual(
+            outputs[0], [("5", None, 0), ("7", None, 0), ("10", "stop", 0), None]
+        )
+        (error,) = outputs[1]
+        self.assertIsInstance(error, ValueError)
+
+
 class TestKeepalive(unittest.TestCase):
 
     def test_keepalive_callback(self):
@@ -472,6 +848,165 @@ class TestLRUPromptCache(unittest.TestCase):
         self.assertEqual(c, ["test3"])
         self.assertEqual(t, [])
 
+    def test_radix_tree(self):
+        cache = LRUPromptCache(max_size=10)
+        model = ("test", None, None)
+        cache.insert_cache(model, [1, 2, 3, 4], ["a"])
+        cache.insert_cache(model, [1, 2, 5, 6], ["b"])
+        cache.insert_cache(model, [1, 2], ["c"])
+
+        root = cache._cache[model]
+        (node,) = root.children.values()
+        self.assertEqual(node.tokens, [1, 2])
+        self.assertEqual(node.entry.prompt_cache, ["c"])
+        self.assertEqual(
+            sorted(c.tokens for c in node.children.values()), [[3, 4], [5, 6]]
+        )
+
+        # The longer match is the shallowest cached descendant
+        result = cache._search(model, [1, 7])
+        self.assertIs(result.longer, node)
+        self.assertEqual(result.common_prefix, 1)
+
+        # Removing an entry merges the edges back together
+        c, t = cache.fetch_nearest_cache(model, [1, 2])
+        self.assertEqual(c, ["c"])
+        self.assertEqual(len(root.children), 1)
+        c, t = cache.fetch_nearest_cache(model, [1, 2, 3, 4, 8])
+        self.assertEqual(c, ["a"])
+        self.assertEqual(t, [8])
+        (node,) = root.children.values()
+        self.assertEqual(node.tokens, [1, 2, 5, 6])
+        self.assertIs(root.nearest, node)
+        self.assertEqual(len(cache._lru), 1)
+
+    def test_shared_prefix(self):
+        cache = LRUPromptCache(max_size=10)
+        model = ("test", None, None)
+
+        def get_kv(start, n):
+            keys = mx.arange(start, start + n).reshape(1, 1, n, 1)
+            return keys, keys
+
+        system = [1] * 16
+        c = [KVCache()]
+        c[0].update_and_fetch(*get_kv(0, 16))
+        for _ in range(3):
+            cache.insert_cache(model, system, c)
+
+        # Two conversations extend the same prefix
+        for i in range(2):
+            c, t = cache.fetch_nearest_cache(model, system + [2 + i] * 4)
+            self.assertEqual(t, [2 + i] * 4)
+            c[0].update_and_fetch(*get_kv(16 + 4 * i, 4))
+            cache.insert_cache(model, system + [2 + i] * 4, c)
+
+        # Writing to the fetched caches does not touch the stored prefix
+        prefix = cache._get(model, system)
+        self.assertTrue((prefix.prompt_cache[0].keys.flatten() == mx.arange(16)).all())
+
+        # The extended entries only store their own tokens
+        for i in range(2):
+            entry = cache._get(model, system + [2 + i] * 4)
+            self.assertIs(entry.prefix, prefix)
+            self.assertEqual(entry.prefix_length, 16)
+            self.assertEqual(entry.prompt_cache[0].keys.shape[2], 4)
+
+        # Fetching rebuilds the full cache
+        c, t = cache.fetch_nearest_cache(model, system + [3] * 4 + [5])
+        self.assertEqual(t, [5])
+        k, v = c[0].state
+        expected = mx.concatenate([mx.arange(16), mx.arange(20, 24)])
+        self.assertEqual(c[0].offset, 20)
+        self.assertTrue((k.flatten() == expected).all())
+        self.assertTrue((v.flatten() == expected).all())
+
+        # Fetching a trimmed longer entry only views the common prefix
+        c, t = cache.fetch_nearest_cache(model, system[:12] + [6])
+        self.assertEqual(t, [6])
+        k, v = c[0].state
+        self.assertTrue((k.flatten() == mx.arange(12)).all())
+        c[0].update_and_fetch(*get_kv(0, 4))
+        self.assertTrue((prefix.prompt_cache[0].keys.flatten() == mx.arange(16)).all())
+        self.assertEqual(len(cache._lru), 2)
+
+    def test_byte_budget(self):
+        model = ("test", None, None)
+
+        def make_cache(n):
+            c = KVCache()
+            c.update_and_fetch(mx.zeros((1, 1, n, 4)), mx.zeros((1, 1, n, 4)))
+            return [c]
+
+        nbytes = 2 * 4 * 4
+        cache = LRUPromptCache(max_size=10, max_bytes=24 * nbytes)
+
+        # Frequently used entries are kept over recently inserted ones
+        cache.insert_cache(model, [1] * 8, make_cache(8))
+        cache.insert_cache(model, [1] * 8, make_cache(8))
+        cache.insert_cache(model, [2] * 8, make_cache(8))
+        self.assertEqual(cache.nbytes, 16 * nbytes)
+        cache.insert_cache(model, [3] * 16, make_cache(16))
+        self.assertEqual(len(cache._lru), 2)
+        self.assertEqual(cache.nbytes, 24 * nbytes)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.evicted_bytes, 8 * nbytes)
+
+        c, t = cache.fetch_nearest_cache(model, [2] * 8)
+        self.assertIsNone(c)
+        c, t = cache.fetch_nearest_cache(model, [1] * 8)
+        self.assertEqual(c[0].offset, 8)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+        # A shared prefix is only freed with the last entry extending it
+        cache = LRUPromptCache(max_size=10)
+        cache.insert_cache(model, [1] * 8, make_cache(8))
+        cache.insert_cache(model, [1] * 12, make_cache(12))
+        self.assertEqual(cache.nbytes, 12 * nbytes)
+        cache.fetch_nearest_cache(model, [1] * 8)
+        self.assertEqual(cache.nbytes, 12 * nbytes)
+        cache.fetch_nearest_cache(model, [1] * 12)
+        self.assertEqual(cache.nbytes, 0)
+
+    def test_disk_cache(self):
+        model = ("test", None, None)
+
+        def make_cache(n):
+            c = KVCache()
+            x = mx.arange(n).reshape(1, 1, n, 1).astype(mx.float32)
+            c.update_and_fetch(x, x)
+            return [c]
+
+        with tempfile.TemporaryDirectory() as path:
+            disk_cache = DiskPromptCache(path, max_bytes=2**20)
+            cache = LRUPromptCache(max_size=1, disk_cache=disk_cache)
+            cache.insert_cache(model, [1] * 8, make_cache(8))
+            cache.insert_cache(model, [2] * 8, make_cache(8))
+            self.assertEqual(disk_cache.stats()["entries"], 1)
+
+            # The evicted entry is loaded back from disk
+            c, t = cache.fetch_nearest_cache(model, [1] * 8 + [3])
+            self.assertEqual(t, [3])
+            self.assertEqual(c[0].offset, 8)
+            self.assertTrue((c[0].state[0].flatten() == mx.arange(8)).all())
+            self.assertEqual(disk_cache.hits, 1)
+
+            # A different model does not match
+            c, t = cache.fetch_nearest_cache(("other", None, None), [1] * 8)
+            self.assertIsNone(c)
+
+            # Stored caches are found again by a new store
+            disk_cache = DiskPromptCache(path, max_bytes=2**20)
+            c, t = disk_cache.fetch(model, [1] * 9)
+            self.assertEqual(t, [1])
+
+            # The store is bounded
+            disk_cache.max_bytes = 0
+            disk_cache.insert(model, [4] * 8, make_cache(8))
+            self.assertEqual(disk_cache.stats()["entries"], 0)
+            self.assertEqual(disk_cache.nbytes, 0)
+
 
 if __name__ == "__main__":
     unittest.main()